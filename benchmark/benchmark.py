@@ -0,0 +1,439 @@
+import os
+import re
+import sys
+import json
+import math
+import time
+import yaml
+import random
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from os.path import join, dirname, abspath, exists
+
+BENCHMARK_DIR = dirname(abspath(__file__))
+BASELINES_DIR = join(BENCHMARK_DIR, 'baselines')
+
+# The scripts in src import each other as top level modules
+sys.path.insert(0, join(BENCHMARK_DIR, '..', 'src'))
+
+# Median (bytes), sigma and maximum of the lognormal distribution of the
+# file sizes
+SIZES = {
+    'small': (2 << 10, 1.0, 1 << 20),
+    'mixed': (16 << 10, 2.0, 64 << 20),
+    'large': (1 << 20, 1.5, 256 << 20),
+}
+
+# Measures of each stage, compared with the baselines
+MEASURES = ('seconds', 'calls', 'processes', 'remote_ops', 'files', 'bytes')
+
+
+class SyntheticTree:
+    '''
+    Source tree with sizes drawn from a distribution, reproducible from its
+    seed, which changes a fraction of its files on every churn. Files are
+    spread in two levels of directories of per_dir entries each
+    '''
+
+    def __init__(self, root: str, files: int, sizes: str = 'mixed', seed: int = 0,
+                 per_dir: int = 100):
+        self.root = root
+        self.random = random.Random(seed)
+        self.median, self.sigma, self.max = SIZES[sizes]
+        self.per_dir = per_dir
+        # Contents are slices of a random pool behind a unique header
+        self.pool = self.random.randbytes(4 << 20)
+        self.paths = []
+        self.created = 0
+        for _ in range(files):
+            self.create()
+
+    def _size(self) -> int:
+        return min(int(self.random.lognormvariate(math.log(self.median), self.sigma)), self.max)
+
+    def _write(self, path: str):
+        size, offset = self._size(), self.random.randrange(len(self.pool))
+        with open(join(self.root, path), 'wb') as f:
+            f.write(header := self.random.randbytes(min(16, size)))
+            remaining = size - len(header)
+            while remaining > 0:
+                n = min(remaining, len(self.pool) - offset)
+                f.write(memoryview(self.pool)[offset:offset+n])
+                remaining, offset = remaining - n, 0
+
+    def create(self):
+        n, k = self.created, self.per_dir
+        path = join(f'd{n // k // k:04d}', f'd{n // k % k:02d}', f'f{n:07d}.bin')
+        os.makedirs(join(self.root, os.path.dirname(path)), exist_ok=True)
+        self._write(path)
+        self.paths.append(path)
+        self.created += 1
+
+    def churn(self, rate: float) -> dict:
+        '''
+        Change a fraction rate of the files: 70% are modified, 15% deleted
+        and as many new files created
+        '''
+        n = max(1, round(rate * len(self.paths)))
+        modified = min(round(n * 0.7), len(self.paths))
+        deleted = min((n - modified) // 2, len(self.paths))
+        for path in self.random.sample(self.paths, modified):
+            self._write(path)
+        for _ in range(deleted):
+            i = self.random.randrange(len(self.paths))
+            self.paths[i], self.paths[-1] = self.paths[-1], self.paths[i]
+            os.remove(join(self.root, self.paths.pop()))
+        # As many files are created as deleted, so the tree keeps its size
+        for _ in range(deleted):
+            self.create()
+        return {'modified': modified, 'deleted': deleted, 'created': deleted}
+
+
+class LatencyProxy:
+    '''
+    TCP proxy in front of an rclone server that delays every HTTP request
+    by latency seconds and records when it was made, the remote operations
+    of the benchmark. Requests are recognized by their request line
+    '''
+
+    REQUEST = re.compile(rb'(?:^|\r\n)[A-Z]+ \S+ HTTP/1\.[01]\r\n')
+
+    def __init__(self, upstream_port: int, latency: float = 0):
+        self.upstream_port = upstream_port
+        self.latency = latency
+        self.requests = []
+        self.lock = threading.Lock()
+        self.server = socket.create_server(('127.0.0.1', 0))
+        self.port = self.server.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self.server.accept()
+                upstream = socket.create_connection(('127.0.0.1', self.upstream_port))
+            except OSError:
+                return
+            for args in ((client, upstream, True), (upstream, client, False)):
+                threading.Thread(target=self._pump, args=args, daemon=True).start()
+
+    def _pump(self, src: socket.socket, dst: socket.socket, requests: bool):
+        try:
+            while data := src.recv(1 << 16):
+                if requests and (n := len(self.REQUEST.findall(data))):
+                    with self.lock: self.requests.extend([time.time()] * n)
+                    time.sleep(self.latency)
+                dst.sendall(data)
+        except OSError:
+            pass
+        finally:
+            # The other pump fails on the closed sockets and ends too
+            src.close()
+            dst.close()
+
+    def close(self):
+        self.server.close()
+
+
+class ProcessCounter:
+    '''
+    Records when each subprocess started inside the block is started
+    '''
+
+    def __init__(self):
+        self.starts = []
+        self.popen = subprocess.Popen
+
+    def __enter__(self):
+        counter = self
+
+        class Popen(self.popen):
+            def __init__(self, *args, **kwargs):
+                counter.starts.append(time.time())
+                super().__init__(*args, **kwargs)
+
+        subprocess.Popen = Popen
+        return self
+
+    def __exit__(self, *exc):
+        subprocess.Popen = self.popen
+
+
+def free_port() -> int:
+    with socket.create_server(('127.0.0.1', 0)) as s:
+        return s.getsockname()[1]
+
+
+@contextmanager
+def stand_in(kind: str, work: str, latency: float = 0):
+    '''
+    Yield the job options of the destination and the proxy recording the
+    remote operations, if any: a local path written by LocalEngine
+    ("local"), by rclone ("rclone"), or an "rclone serve webdav" server
+    behind a LatencyProxy ("serve")
+    '''
+    if kind == 'local':
+        yield {'destination': join(work, 'dest')}, None
+    elif kind == 'rclone':
+        yield {'destination': join(work, 'dest'), 'local_engine': 'rclone'}, None
+    elif kind == 'serve':
+        os.makedirs(served := join(work, 'served'))
+        port = free_port()
+        server = subprocess.Popen(
+            ['rclone', 'serve', 'webdav', served, '--addr', f'127.0.0.1:{port}'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        proxy = None
+        try:
+            for _ in range(100):
+                try: socket.create_connection(('127.0.0.1', port)).close(); break
+                except OSError: time.sleep(0.1)
+            proxy = LatencyProxy(port, latency)
+            # Remotes defined in the environment reach every rclone process
+            os.environ['RCLONE_CONFIG_BENCHSERVE_TYPE'] = 'webdav'
+            os.environ['RCLONE_CONFIG_BENCHSERVE_URL'] = f'http://127.0.0.1:{proxy.port}'
+            yield {'destination': 'benchserve:dest'}, proxy
+        finally:
+            if proxy: proxy.close()
+            server.terminate()
+            server.wait()
+    else:
+        raise ValueError(f'Unknown destination {kind}')
+
+
+def attribute(events: list, runs: list) -> dict:
+    '''
+    Count the events (timestamps) made during each stage of the runs, by
+    stage kind. Events outside every stage are counted as "other"
+    '''
+    counts, attributed = {}, 0
+    for metrics in runs:
+        for record in metrics.stages:
+            start, end = record['start'], record['start'] + record['seconds']
+            n = sum(1 for t in events if start <= t <= end)
+            kind = record['stage'].split()[0]
+            counts[kind] = counts.get(kind, 0) + n
+            attributed += n
+    counts['other'] = counts.get('other', 0) + len(events) - attributed
+    return counts
+
+
+def aggregate(runs: list, processes: list, requests: list = None) -> dict:
+    '''
+    Sum the measures of the stages of the runs by stage kind (sync, copy,
+    rotate...). Remote operations are the requests seen by the proxy, or
+    the engine calls when the destination is not behind one
+    '''
+    stages = {}
+    for metrics in runs:
+        for record in metrics.stages:
+            stage = stages.setdefault(record['stage'].split()[0], dict.fromkeys(MEASURES, 0))
+            stage['seconds'] += record['seconds']
+            for measure in ('calls', 'files', 'bytes'):
+                stage[measure] += record[measure]
+    for measure, events in (('processes', processes), ('remote_ops', requests)):
+        if events is None: continue
+        for kind, n in attribute(events, runs).items():
+            stages.setdefault(kind, dict.fromkeys(MEASURES, 0))[measure] += n
+    if requests is None:
+        for stage in stages.values(): stage['remote_ops'] = stage['calls']
+    total = {measure: sum(s[measure] for s in stages.values()) for measure in MEASURES}
+    return {'stages': stages, 'total': total}
+
+
+def run_scenario(name: str, scenario: dict, work: str, engine_name: str = 'subprocess') -> dict:
+    '''
+    Back up a synthetic tree, changing it before every run, at every backup
+    hour of the simulated days, and return the measures of the stages
+    '''
+    work = join(work, name)
+    if exists(work): shutil.rmtree(work)
+    os.makedirs(work)
+
+    # snapback reads the backup hours from the config.yaml of the working directory
+    with open(join(work, 'config.yaml'), 'w') as f:
+        yaml.dump({'jobs': {}, 'daily_backup_hours': ['00', '12', '16', '20']}, f)
+    os.chdir(work)
+    from engine import create_engine
+    from snapback import SnapBackJob, LastSnapBackData, HOURS
+
+    generating = time.perf_counter()
+    tree = SyntheticTree(join(work, 'source'), scenario['files'],
+        scenario.get('sizes', 'mixed'), scenario.get('seed', 0))
+    generating = time.perf_counter() - generating
+
+    with open(state := join(work, 'last_snapback.yaml'), 'w') as f:
+        yaml.dump({}, f)
+    data = LastSnapBackData(state)
+    options = {
+        key: scenario[key] for key in
+        ('rotation', 'change_detection', 'storage', 'chunk_threshold', 'chunk_size')
+        if key in scenario
+    }
+    start = datetime.fromisoformat(str(scenario.get('start', '2024-12-20')))
+    hours = sorted(HOURS, key=lambda h: int(h) % 24)
+
+    runs, failures = [], 0
+    with stand_in(scenario.get('destination', 'local'), work, scenario.get('latency_ms', 0) / 1000) \
+            as (destination, proxy), create_engine(engine_name) as engine, \
+            ProcessCounter() as processes:
+        job_data = {**options, **destination, 'directories': {'source': tree.root}}
+        started = time.perf_counter()
+        for day in range(scenario.get('days', 7)):
+            for hour in hours:
+                if runs: tree.churn(scenario.get('churn', 0.01))
+                now = start + timedelta(days=day, hours=int(hour) % 24)
+                job = SnapBackJob(name, job_data, data, engine, clock=lambda now=now: now)
+                job.perform(hour)
+                runs.extend(job.metrics)
+                failures += sum(1 for m in job.metrics if m.failing_point is not None)
+        seconds = time.perf_counter() - started
+
+    report = aggregate(runs, processes.starts, proxy.requests if proxy else None)
+    report.update(
+        scenario=name, engine=engine_name, files=scenario['files'], runs=len(runs),
+        failures=failures, seconds=seconds, generating=generating
+    )
+    return report
+
+
+def compare(report: dict, baseline: dict,
+    tolerance: float = 0.25,
+    count_tolerance: float = 0.05,
+    slack: float = 0.1
+) -> list:
+    '''
+    Return the regressions of a report against its baseline: a time more
+    than tolerance (and slack seconds) over it, or a count more than
+    count_tolerance over it. Counts hardly change between runs of a
+    scenario, only the requests rclone retries or splits do
+    '''
+    regressions = []
+    rows = [('total', report['total'], baseline['total'])] + [
+        (kind, stage, baseline['stages'][kind])
+        for kind, stage in report['stages'].items() if kind in baseline['stages']
+    ]
+    for kind, now, before in rows:
+        for measure in MEASURES:
+            if measure == 'seconds':
+                worse = now[measure] > before[measure] * (1 + tolerance) + slack
+            else:
+                worse = now[measure] > before[measure] * (1 + count_tolerance)
+            if worse:
+                regressions.append(f'{kind} {measure}: {before[measure]:g} -> {now[measure]:g}')
+    if report['failures'] > baseline['failures']:
+        regressions.append(f'failed runs: {baseline["failures"]} -> {report["failures"]}')
+    return regressions
+
+
+def format_report(report: dict) -> str:
+    lines = [
+        f'{report["scenario"]}: {report["files"]} files, {report["runs"]} runs '
+        f'({report["failures"]} failed) in {report["seconds"]:.2f} s with the '
+        f'{report["engine"]} engine, tree generated in {report["generating"]:.2f} s',
+        f'  {"Stage":<12} {"Seconds":>9} {"Calls":>7} {"Processes":>9} '
+        f'{"Remote ops":>10} {"Files":>8} {"Bytes":>13}'
+    ]
+    rows = sorted(report['stages'].items(), key=lambda row: row[1]['seconds'], reverse=True)
+    for kind, s in rows + [('total', report['total'])]:
+        lines.append(
+            f'  {kind:<12} {s["seconds"]:>9.3f} {s["calls"]:>7} {s["processes"]:>9} '
+            f'{s["remote_ops"]:>10} {s["files"]:>8} {s["bytes"]:>13}'
+        )
+    return '\n'.join(lines)
+
+
+def command_parser(scenarios: dict) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="snapBack benchmarks")
+    parser.add_argument('scenarios',
+        nargs='*',
+        help='Scenarios of benchmark/scenarios.yaml to run (default: the '
+             f'default ones). Available: {", ".join(scenarios)}'
+    )
+    parser.add_argument('--engine',
+        type=str,
+        choices=['subprocess', 'daemon'],
+        default='subprocess',
+        help='How rclone is run (default: subprocess)'
+    )
+    parser.add_argument('--files',
+        type=int,
+        default=None,
+        help='Override the number of files of the scenarios'
+    )
+    parser.add_argument('--days',
+        type=int,
+        default=None,
+        help='Override the number of simulated days of the scenarios'
+    )
+    parser.add_argument('--workdir',
+        type=str,
+        default=None,
+        help='Directory for the trees and destinations (default: a temporary '
+             'directory, removed at the end)'
+    )
+    parser.add_argument('--save-baseline',
+        action='store_true',
+        help='Save the results as the baselines of the scenarios'
+    )
+    parser.add_argument('--tolerance',
+        type=float,
+        default=0.25,
+        help='Fraction a stage may be slower than its baseline before it is '
+             'flagged (default: 0.25)'
+    )
+    return parser.parse_args()
+
+
+def main():
+    with open(join(BENCHMARK_DIR, 'scenarios.yaml'), 'r') as f:
+        config = yaml.safe_load(f)
+    args = command_parser(config['scenarios'])
+
+    names = args.scenarios or config['default']
+    if unknown := [name for name in names if name not in config['scenarios']]:
+        sys.exit(f'Unknown scenarios: {", ".join(unknown)}')
+    work = args.workdir or tempfile.mkdtemp(prefix='snapback-benchmark-')
+    work, cwd = abspath(work), os.getcwd()
+    regressions = 0
+    try:
+        for name in names:
+            scenario = dict(config['scenarios'][name])
+            if args.files: scenario['files'] = args.files
+            if args.days: scenario['days'] = args.days
+
+            report = run_scenario(name, scenario, work, args.engine)
+            print(format_report(report))
+
+            baseline_file = join(BASELINES_DIR, f'{name}.{args.engine}.json')
+            if args.save_baseline:
+                os.makedirs(BASELINES_DIR, exist_ok=True)
+                with open(baseline_file, 'w') as f:
+                    json.dump(report, f, indent=2)
+                print(f'  Baseline saved to {baseline_file}')
+            elif exists(baseline_file):
+                with open(baseline_file, 'r') as f:
+                    baseline = json.load(f)
+                if baseline['files'] != report['files'] or baseline['runs'] != report['runs']:
+                    print('  The baseline was made with other files or days, not compared')
+                elif found := compare(report, baseline, args.tolerance):
+                    regressions += len(found)
+                    print('  Regressions against the baseline:')
+                    for regression in found: print(f'    {regression}')
+                else:
+                    print('  No regressions against the baseline')
+    finally:
+        os.chdir(cwd)
+        if args.workdir is None:
+            shutil.rmtree(work, ignore_errors=True)
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
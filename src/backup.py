@@ -1,9 +1,16 @@
 import os
+import sys
 import yaml
 import argparse
 import logging as log
 from datetime import datetime
+from engine import create_engine
+from executor import SnapBackExecutor
 from snapback import SnapBackJob, LastSnapBackData
+from metrics import export, summary
+from tuning import Tuner
+from costs import CostLedger
+from lock import FileLock, Locked
 
 
 def command_parser():
@@ -17,16 +24,50 @@ def command_parser():
         default='ERROR',
         help='Set the logging level (default: ERROR)'
     )
+    parser.add_argument(
+        '--engine',
+        type=str,
+        choices=['subprocess', 'daemon'],
+        default=None,
+        help='How rclone is run: a process per operation or a single rclone '
+             'daemon for the whole run (default: from config.yaml, subprocess '
+             'if not set)'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=None,
+        help='Number of directories updated concurrently (default: from '
+             'config.yaml, 1 if not set)'
+    )
+    parser.add_argument(
+        '--plan',
+        action='store_true',
+        help='Print the operations each directory would run at this hour, '
+             'with an estimate of the engine calls, and exit'
+    )
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='Print the slowest stages of the run when it ends'
+    )
     
     return parser.parse_args()
 
 
-def main():
-    # Load the configuration
+# Held while the jobs run, so that runs never overlap
+RUN_LOCK = 'snapback.run.lock'
+
+
+def load_config() -> dict:
     with open('config.yaml', 'r') as f:
-        config = yaml.safe_load(f)
+        return yaml.safe_load(f)
 
-    # Create data file if it doesn't exist
+
+def create_data_file():
+    '''
+    Create the data file if it doesn't exist
+    '''
     if not os.path.exists('last_snapback.yaml'):
         with open('last_snapback.yaml', 'w') as f:
             yaml.dump({
@@ -34,6 +75,56 @@ def main():
                 'failing_point': None, 'success': False
             }, f)
 
+
+def run(config: dict, engine, hour: str, workers: int = 1, profile: bool = False) -> list:
+    '''
+    Perform every job of the config at the given hour and export the
+    metrics of the run. Returns the errors of the concurrent updates
+    '''
+    last_snapback_data = LastSnapBackData()
+    concurrency = config.get('concurrency', {})
+    tuning = config.get('tuning', {})
+    tuner = None if tuning is False else Tuner(last_snapback_data.tuning_file(), tuning)
+    ledger = CostLedger(last_snapback_data.costs_file(), (config.get('costs') or {}).get('budget'))
+
+    # Jobs select themselves in last_snapback_data, so each one is
+    # created right before it performs
+    jobs, errors = [], []
+    if workers <= 1:
+        for job_name, job_data in config['jobs'].items():
+            jobs.append(job := SnapBackJob(
+                job_name, job_data, last_snapback_data, engine, tuner=tuner, ledger=ledger
+            ))
+            job.perform(hour)
+    else:
+        with SnapBackExecutor(
+            max_workers=workers,
+            remote_limits=concurrency.get('remotes', {}),
+            default_limit=concurrency.get('per_remote')
+        ) as executor:
+            for job_name, job_data in config['jobs'].items():
+                jobs.append(job := SnapBackJob(
+                    job_name, job_data, last_snapback_data, engine, tuner=tuner, ledger=ledger
+                ))
+                job.perform(hour, executor)
+            errors = executor.wait()
+
+    runs = [metrics for job in jobs for metrics in job.metrics]
+    export(runs, config.get('metrics') or {})
+    if profile:
+        print(summary(runs))
+
+    if errors:
+        log.error(f'{len(errors)} directory updates failed')
+    else:
+        log.info('All jobs completed successfully')
+    return errors
+
+
+def main():
+    config = load_config()
+    create_data_file()
+
     # Create the argument parser
     args = command_parser()
 
@@ -45,15 +136,26 @@ def main():
         format='%(asctime)s [%(levelname)s] %(message)s'
     )
 
-    last_snapback_data = LastSnapBackData()
+    hour = str(datetime.now().hour).zfill(2)
+    workers = args.workers or config.get('concurrency', {}).get('max_workers', 1)
+
+    with create_engine(args.engine or config.get('engine', 'subprocess')) as engine:
 
-    for job_name, job_data in config['jobs'].items():
-        SnapBackJob(job_name, job_data, last_snapback_data).perform(
-            hour=str(datetime.now().hour).zfill(2)
-        )
+        if args.plan:
+            last_snapback_data = LastSnapBackData()
+            for job_name, job_data in config['jobs'].items():
+                plans = SnapBackJob(job_name, job_data, last_snapback_data, engine).plan(hour)
+                for dir_name, description in plans.items():
+                    print(f'{job_name}/{dir_name}: {description}')
+            return
 
-    log.info('All jobs completed successfully')
+        try:
+            with FileLock(RUN_LOCK, blocking=False):
+                run(config, engine, hour, workers, args.profile)
+        except Locked as e:
+            log.error(f'Another run is in progress, skipping this one ({e})')
+            sys.exit('Another run is in progress')
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,368 @@
+import yaml
+import sqlite3
+import argparse
+import threading
+import logging as log
+from os.path import join
+from datetime import datetime, timedelta, timezone
+from rotation import TIERS, SlotManifest
+from content_store import ContentStore, HASH_TYPES
+from chunking import CHUNKS_DIR, RECIPE_SUFFIX
+from packing import PackStore, is_packed
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS versions (
+    job   TEXT NOT NULL,
+    dir   TEXT NOT NULL,
+    tier  TEXT NOT NULL,
+    path  TEXT NOT NULL,
+    size  INTEGER,
+    mtime INTEGER,
+    hash  TEXT,
+    PRIMARY KEY (job, dir, tier, path)
+);
+CREATE INDEX IF NOT EXISTS versions_path ON versions (job, dir, path);
+CREATE TABLE IF NOT EXISTS complete (
+    job TEXT NOT NULL,
+    dir TEXT NOT NULL,
+    PRIMARY KEY (job, dir)
+);
+'''
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# Name of the main directory among the tiers of the catalog
+MAIN = 'main'
+
+
+def mtime_us(mtime) -> int:
+    '''
+    Convert a listing ModTime (ISO 8601) or a local mtime in nanoseconds
+    to whole microseconds since the epoch, the precision of the catalog
+    '''
+    if isinstance(mtime, int):
+        return mtime // 1000
+    return (datetime.fromisoformat(mtime) - EPOCH) // timedelta(microseconds=1)
+
+
+def entry_hash(entry: dict) -> str:
+    '''
+    Return the preferred hash of a listing entry as "<type>:<value>", or
+    None if the backend provides none
+    '''
+    hashes = entry.get('Hashes') or {}
+    for hash_type in HASH_TYPES:
+        if hashes.get(hash_type):
+            return f'{hash_type}:{hashes[hash_type]}'
+    return None
+
+
+def from_listing(entries: list) -> dict:
+    return {
+        e['Path']: (e['Size'], mtime_us(e['ModTime']), entry_hash(e))
+        for e in entries
+    }
+
+
+def blob_hash(key: str) -> str:
+    '''
+    Return the hash of a content store blob key as "<type>:<value>"
+    '''
+    hash_type, _, value = key.partition('-')
+    return None if hash_type == 'nohash' else f'{hash_type}:{value}'
+
+
+class Catalog:
+    '''
+    Local SQLite catalog of the file versions held by the main directory
+    and every snapback of each directory, so that the history of a file or
+    the differences between snapbacks are answered without listing the
+    destination. SnapBackUpdate mirrors each operation it makes on the
+    destination, and rebuild() starts over from a listing.
+
+    Snapbacks are recorded by their logical name (daily.1, ...) whatever the
+    rotation mode, and mtimes in microseconds since the epoch.
+    '''
+
+    def __init__(self, file: str):
+        self.file = file
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(file, timeout=30, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _execute(self, *statements):
+        '''
+        Run (sql, parameters) statements in a single transaction
+        '''
+        with self.lock, self.db:
+            for sql, params in statements:
+                self.db.execute(sql, params)
+
+    def set_tier(self, job: str, dir: str, tier: str, entries: dict):
+        '''
+        Replace the versions of a tier with entries, {path: (size, mtime, hash)}
+        '''
+        with self.lock, self.db:
+            self.db.execute(
+                'DELETE FROM versions WHERE job=? AND dir=? AND tier=?',
+                (job, dir, tier)
+            )
+            self.db.executemany(
+                'INSERT INTO versions VALUES (?, ?, ?, ?, ?, ?, ?)',
+                ((job, dir, tier, path, *e) for path, e in entries.items())
+            )
+
+    def update_tier(self, job: str, dir: str, tier: str, entries: dict, deleted: list = ()):
+        '''
+        Set the versions of entries, {path: (size, mtime, hash)}, in a tier
+        and remove the versions of the deleted paths, leaving the others
+        '''
+        with self.lock, self.db:
+            self.db.executemany(
+                'DELETE FROM versions WHERE job=? AND dir=? AND tier=? AND path=?',
+                ((job, dir, tier, path) for path in deleted)
+            )
+            self.db.executemany(
+                'INSERT OR REPLACE INTO versions VALUES (?, ?, ?, ?, ?, ?, ?)',
+                ((job, dir, tier, path, *e) for path, e in entries.items())
+            )
+
+    def copy(self, job: str, dir: str, a: str, b: str):
+        '''
+        Copy the versions of tier a into tier b, replacing those with the
+        same path
+        '''
+        self._execute((
+            'INSERT OR REPLACE INTO versions SELECT job, dir, ?, path, size, mtime, hash '
+            'FROM versions WHERE job=? AND dir=? AND tier=?', (b, job, dir, a)
+        ))
+
+    def accumulate(self, job: str, dir: str, a: str, b: str):
+        '''
+        Add the versions of tier a whose path is not in tier b and empty a
+        '''
+        self._execute((
+            'INSERT OR IGNORE INTO versions SELECT job, dir, ?, path, size, mtime, hash '
+            'FROM versions WHERE job=? AND dir=? AND tier=?', (b, job, dir, a)
+        ), (
+            'DELETE FROM versions WHERE job=? AND dir=? AND tier=?', (job, dir, a)
+        ))
+
+    def move(self, job: str, dir: str, a: str, b: str):
+        '''
+        Move the versions of tier a into tier b, replacing those with the
+        same path
+        '''
+        self._execute((
+            'INSERT OR REPLACE INTO versions SELECT job, dir, ?, path, size, mtime, hash '
+            'FROM versions WHERE job=? AND dir=? AND tier=?', (b, job, dir, a)
+        ), (
+            'DELETE FROM versions WHERE job=? AND dir=? AND tier=?', (job, dir, a)
+        ))
+
+    def rotate(self, job: str, dir: str, tier: str):
+        '''
+        Shift the snapbacks of a manifest rotated tier one position,
+        discarding the oldest one
+        '''
+        n = TIERS[tier]
+        self._execute((
+            'DELETE FROM versions WHERE job=? AND dir=? AND tier=?',
+            (job, dir, f'{tier}.{n}')
+        ), *[(
+            'UPDATE versions SET tier=? WHERE job=? AND dir=? AND tier=?',
+            (f'{tier}.{i+1}', job, dir, f'{tier}.{i}')
+        ) for i in range(n-1, 0, -1)])
+
+    def set_complete(self, job: str, dir: str, complete: bool = True):
+        '''
+        Mark whether the versions of a directory are known to match the
+        destination, so the planner can rely on them
+        '''
+        if complete:
+            self._execute(('INSERT OR IGNORE INTO complete VALUES (?, ?)', (job, dir)))
+        else:
+            self._execute(('DELETE FROM complete WHERE job=? AND dir=?', (job, dir)))
+
+    def is_complete(self, job: str, dir: str) -> bool:
+        with self.lock:
+            return self.db.execute(
+                'SELECT 1 FROM complete WHERE job=? AND dir=?', (job, dir)
+            ).fetchone() is not None
+
+    def tier_counts(self, job: str, dir: str) -> dict:
+        '''
+        Return the number of versions held by each tier of a directory
+        '''
+        with self.lock:
+            return dict(self.db.execute(
+                'SELECT tier, COUNT(*) FROM versions WHERE job=? AND dir=? GROUP BY tier',
+                (job, dir)
+            ).fetchall())
+
+    def versions(self, job: str, dir: str, path: str) -> list:
+        '''
+        Return the (tier, size, mtime, hash) of every version of a file,
+        chunked versions included
+        '''
+        with self.lock:
+            return self.db.execute(
+                'SELECT tier, size, mtime, hash FROM versions '
+                'WHERE job=? AND dir=? AND path IN (?, ?) ORDER BY tier',
+                (job, dir, path, path + RECIPE_SUFFIX)
+            ).fetchall()
+
+    def diff(self, job: str, dir: str, a: str, b: str) -> dict:
+        '''
+        Compare two tiers: the paths only in a, only in b, and in both with
+        a different version
+        '''
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT tier, path, size, mtime, hash FROM versions '
+                'WHERE job=? AND dir=? AND tier IN (?, ?)', (job, dir, a, b)
+            ).fetchall()
+        tiers = {a: {}, b: {}}
+        for tier, path, *version in rows:
+            tiers[tier][path] = version
+        return {
+            'only_' + a: sorted(tiers[a].keys() - tiers[b].keys()),
+            'only_' + b: sorted(tiers[b].keys() - tiers[a].keys()),
+            'changed': sorted(
+                p for p in tiers[a].keys() & tiers[b].keys()
+                if tiers[a][p] != tiers[b][p]
+            )
+        }
+
+    def rebuild(self, job: str, dir: str, engine, dest_path: str,
+                rotation: str = 'move', storage: str = 'files'):
+        '''
+        Replace everything known about a directory with a listing of its
+        main directory and snapbacks on the destination
+        '''
+        backup_dir = join(dest_path, '.snapbacks', dir)
+        logical = {}
+        if rotation == 'manifest':
+            tiers = SlotManifest.load(engine, backup_dir).tiers()
+            logical = {slot: name for name, slot in tiers.items()}
+
+        # Snapbacks are the first level directories of a single listing
+        tiers = {}
+        if storage == 'content':
+            for slot, entries in ContentStore(engine, backup_dir).index.items():
+                tiers[slot] = {
+                    path: (e['size'], mtime_us(e['mtime']), blob_hash(e['blob']))
+                    for path, e in entries.items()
+                }
+        else:
+            packed = {}
+            for e in engine.iter_list(backup_dir, hashes=True):
+                slot, _, e['Path'] = e['Path'].partition('/')
+                if not e['Path'] or slot == CHUNKS_DIR:
+                    continue
+                if is_packed(e['Path']):
+                    packed.setdefault(slot, []).append(e)
+                else:
+                    tiers.setdefault(slot, {})[e['Path']] = \
+                        (e['Size'], mtime_us(e['ModTime']), entry_hash(e))
+            packs = PackStore(engine, backup_dir)
+            for slot, entries in packed.items():
+                tiers.setdefault(slot, {}).update({
+                    path: (e['size'], mtime_us(e['mtime']), f'sha1:{e["sha1"]}')
+                    for path, e in packs.files(slot, entries).items()
+                })
+
+        self._execute(('DELETE FROM versions WHERE job=? AND dir=?', (job, dir)))
+        self.set_tier(job, dir, MAIN,
+            from_listing(engine.iter_list(join(dest_path, dir), hashes=True))
+        )
+        for slot, entries in tiers.items():
+            self.set_tier(job, dir, logical.get(slot, slot), entries)
+        self.set_complete(job, dir)
+
+
+def command_parser(config: dict) -> argparse.Namespace:
+    from replicas import replicas
+
+    # The replicas of a job with several destinations have their own catalog
+    names = [name for job, data in config['jobs'].items() for name, _ in replicas(job, data)]
+
+    parser = argparse.ArgumentParser(description="snapBack version catalog")
+    parser.add_argument('--catalog',
+        type=str,
+        default='last_snapback.catalog.db',
+        help='Catalog file (default: last_snapback.catalog.db)'
+    )
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    versions = commands.add_parser('versions', help='List the versions of a file')
+    versions.add_argument('job', choices=names)
+    versions.add_argument('directory')
+    versions.add_argument('path', help='Path of the file inside the directory')
+
+    diff = commands.add_parser('diff', help='Compare two snapbacks')
+    diff.add_argument('job', choices=names)
+    diff.add_argument('directory')
+    diff.add_argument('a', help='Snapback, or main for the main directory')
+    diff.add_argument('b', help='Snapback, or main for the main directory')
+
+    rebuild = commands.add_parser('rebuild', help='Rebuild from the destination')
+    rebuild.add_argument('job', choices=config['jobs'].keys())
+    rebuild.add_argument('directory', nargs='?', default=None,
+        help='Directory to rebuild (default: every directory of the job)')
+
+    return parser.parse_args()
+
+
+def main():
+    from engine import create_engine, engine_for
+    from replicas import replicas
+
+    with open('config.yaml', 'r') as f:
+        config = yaml.safe_load(f)
+
+    args = command_parser(config)
+    log.basicConfig(
+        level=log.ERROR,
+        filename='snapback.log',
+        filemode='a',
+        format='%(asctime)s Catalog: [%(levelname)s] %(message)s'
+    )
+
+    with Catalog(args.catalog) as catalog:
+        if args.command == 'versions':
+            for tier, size, mtime, hash in catalog.versions(args.job, args.directory, args.path):
+                modified = datetime.fromtimestamp(mtime / 1e6).isoformat(' ', 'seconds')
+                print(f'{tier:<10} {size:>12} {modified}  {hash or ""}')
+
+        elif args.command == 'diff':
+            for key, paths in catalog.diff(args.job, args.directory, args.a, args.b).items():
+                for path in paths: print(f'{key}: {path}')
+
+        elif args.command == 'rebuild':
+            job_data = config['jobs'][args.job]
+            directories = [args.directory] if args.directory else job_data['directories']
+            with create_engine(config.get('engine', 'subprocess')) as rclone:
+                # Every replica has its own catalog
+                for name, destination in replicas(args.job, job_data):
+                    engine = engine_for(destination, rclone,
+                        job_data.get('local_engine', 'hardlink'))
+                    for dir_name in directories:
+                        catalog.rebuild(name, dir_name, engine, destination,
+                            job_data.get('rotation', 'move'), job_data.get('storage', 'files'))
+                        print(f'Rebuilt {dir_name} ({name})')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+import os
+import yaml
+from os.path import dirname
+from planner import Operation
+
+
+class Checkpoint:
+    '''
+    Progress of the tier operations of a run: the planned operations and how
+    many of them are done. It is saved after every operation and cleared when
+    the run completes, so a run that fails or dies halfway is resumed by the
+    next one at the operation where it stopped, without redoing the ones
+    already made on the destination.
+    '''
+
+    def __init__(self, file: str):
+        self.file = file
+
+    def load(self) -> dict:
+        '''
+        Return the checkpoint of an unfinished run, with its operations
+        rebuilt, or None if the last run completed
+        '''
+        try:
+            with open(self.file, 'r') as f:
+                data = yaml.safe_load(f)
+        except FileNotFoundError:
+            return None
+        if not data:
+            return None
+        data['ops'] = [Operation(*op) for op in data['ops']]
+        return data
+
+    def save(self, hour: str, ops: list, done: int, attempts: int = 0):
+        '''
+        Replace the checkpoint atomically, so a crash never leaves it half
+        written
+        '''
+        os.makedirs(dirname(self.file), exist_ok=True)
+        temp_file = self.file + '.tmp'
+        with open(temp_file, 'w') as f:
+            yaml.dump({
+                'hour': hour,
+                'ops': [[op.kind, op.a, op.b, op.value] for op in ops],
+                'done': done,
+                'attempts': attempts
+            }, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file, self.file)
+
+    def clear(self):
+        try: os.remove(self.file)
+        except FileNotFoundError: pass
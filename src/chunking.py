@@ -0,0 +1,266 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import logging as log
+from os.path import join, exists, dirname
+from concurrent.futures import ThreadPoolExecutor
+
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+CHUNKS_DIR = '.chunks'
+RECIPE_SUFFIX = '.snapchunks'
+
+MASK64 = (1 << 64) - 1
+
+# Random but fixed table of the gear rolling hash
+GEAR = [
+    int.from_bytes(hashlib.sha256(i.to_bytes(2, 'big')).digest()[:8], 'big')
+    for i in range(256)
+]
+GEAR_ARRAY = np.array(GEAR, dtype=np.uint64) if np else None
+
+# Bytes hashed at a time by the vectorised boundary search, so that the
+# hashes of a block stay in the CPU cache
+SEARCH_BLOCK = 64 << 10
+
+
+def gear_hashes(data: bytes, start: int, end: int) -> 'np.ndarray':
+    '''
+    Return the gear hash at each byte of data[start:end], hashing from
+    start. The hash at a byte is the sum of the gears of the 64 bytes up to
+    it, each shifted by its distance, so it is built in 6 doubling steps
+    over the whole block instead of a step per byte
+    '''
+    h = GEAR_ARRAY[np.frombuffer(data, dtype=np.uint8, count=end - start, offset=start)]
+    shifted = np.empty_like(h)
+    shift = 1
+    while shift < min(64, len(h)):
+        np.left_shift(h[:-shift], np.uint64(shift), out=shifted[:len(h) - shift])
+        np.add(h[shift:], shifted[:len(h) - shift], out=h[shift:])
+        shift *= 2
+    return h
+
+
+def find_cut(data: bytes, start: int, end: int, min_size: int, mask: int) -> int:
+    '''
+    Return the end of the chunk of data starting at start and ending at
+    most at end: one byte past the first byte from min_size on whose gear
+    hash has none of the bits of mask set, or end if there is none
+    '''
+    # The hash only depends on the last 64 bytes, start just before
+    first = start + max(min_size - 64, 0)
+    lo = start + min_size
+    if np is None:
+        h, gear = 0, GEAR
+        for i in range(first, end):
+            h = ((h << 1) + gear[data[i]]) & MASK64
+            if i >= lo and not h & mask:
+                return i + 1
+        return end
+    mask = np.uint64(mask)
+    while lo < end:
+        # Each block is hashed from up to 63 bytes before it, so that its
+        # first hash covers a whole window
+        hi = min(lo + SEARCH_BLOCK, end)
+        from_ = max(lo - 63, first)
+        h = gear_hashes(data, from_, hi)[lo - from_:]
+        if len(hits := np.flatnonzero((h & mask) == 0)):
+            return lo + int(hits[0]) + 1
+        lo = hi
+    return end
+
+
+def iter_chunks(f, average: int = 4 << 20):
+    '''
+    Split a binary file into content defined chunks with a gear rolling
+    hash, so that an insertion only changes the chunks around it. Chunks are
+    between a quarter and four times the average size. The boundaries are
+    searched with numpy when it is installed, byte by byte otherwise
+    '''
+    min_size, max_size = average // 4, average * 4
+    mask = (1 << max(average.bit_length() - 1, 1)) - 1
+    mask <<= 64 - mask.bit_length()
+    buffer, start = b'', 0
+    eof = False
+    while True:
+        if not eof and len(buffer) - start < max_size:
+            data = f.read(max_size * 2)
+            eof = not data
+            buffer, start = buffer[start:] + data, 0
+        if start == len(buffer):
+            return
+        end = min(len(buffer), start + max_size)
+        cut = find_cut(buffer, start, end, min_size, mask) if end - start > min_size else end
+        if cut == end and not eof and len(buffer) - start < max_size:
+            continue
+        yield buffer[start:cut]
+        start = cut
+
+
+def rebuild(engine, chunks_dir: str, recipe: dict, out, workers: int = 4):
+    '''
+    Write the file described by a recipe to the binary stream out, fetching
+    up to workers chunks ahead in parallel so only those are held in memory
+    '''
+    paths = [join(chunks_dir, d[:2], d) for d, _ in recipe['chunks']]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        window = []
+        for path in paths:
+            window.append(pool.submit(engine.read_bytes, path))
+            if len(window) > workers:
+                out.write(window.pop(0).result())
+        for future in window:
+            out.write(future.result())
+
+
+class ChunkStore:
+    '''
+    Stores the files of a directory that are larger than a threshold as
+    content defined chunks under .snapbacks/<dir>/.chunks/. In the main
+    directory each of those files is replaced by a small recipe, <file>
+    .snapchunks, listing its chunks. When the file changes only the new
+    chunks are uploaded and the old recipe is moved to .temp like any
+    replaced file, so every snapback keeps the chunk list of its version.
+
+    The chunks already uploaded and the stat signature of every chunked
+    file are kept in a local cache, next to last_snapback.yaml.
+    '''
+
+    def __init__(self,
+        engine,
+        dest_path: str,
+        backup_dir: str,
+        cache_file: str,
+        threshold: int,
+        average: int = 4 << 20,
+        staging_limit: int = 256 << 20
+    ):
+        self.engine = engine
+        self.dest_path = dest_path
+        self.chunks_dir = join(backup_dir, CHUNKS_DIR)
+        self.cache_file = cache_file
+        self.threshold = threshold
+        self.average = average
+        self.staging_limit = staging_limit
+        self.files, self.known = {}, set()
+        if exists(cache_file):
+            with open(cache_file, 'r') as f: cache = json.load(f)
+            self.files, self.known = cache['files'], set(cache['chunks'])
+        else:
+            self.known = {
+                e['Path'].rsplit('/', 1)[-1]
+                for e in engine.iter_list(self.chunks_dir)
+            }
+
+    def chunk_path(self, digest: str) -> str:
+        return join(self.chunks_dir, digest[:2], digest)
+
+    def _save_cache(self):
+        os.makedirs(dirname(self.cache_file) or '.', exist_ok=True)
+        with open(temp := self.cache_file + '.tmp', 'w') as f:
+            json.dump({'files': self.files, 'chunks': sorted(self.known)}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.cache_file)
+
+    def _recipe(self, path: str, size: int, mtime: int, staging: str, staged: set) -> dict:
+        '''
+        Chunk a file, writing its unknown chunks to the staging directory
+        '''
+        chunks = []
+        with open(path, 'rb') as f:
+            for data in iter_chunks(f, self.average):
+                digest = hashlib.sha256(data).hexdigest()
+                chunks.append([digest, len(data)])
+                if digest in self.known or digest in staged:
+                    continue
+                os.makedirs(join(staging, digest[:2]), exist_ok=True)
+                with open(join(staging, digest[:2], digest), 'wb') as c: c.write(data)
+                staged.add(digest)
+                if len(staged) * self.average >= self.staging_limit:
+                    self._flush(staging, staged)
+        return {'size': size, 'mtime': mtime, 'chunks': chunks}
+
+    def _flush(self, staging: str, staged: set):
+        '''
+        Upload the staged chunks with a single copy
+        '''
+        if staged:
+            self.engine.copy(staging, self.chunks_dir)
+            self.known.update(staged)
+            staged.clear()
+            for name in os.listdir(staging):
+                shutil.rmtree(join(staging, name))
+
+    def update(self, source: str, entries: dict, temp_dir: str, complete: bool = True) -> bool:
+        '''
+        Chunk the files of entries ({path: [size, mtime_ns]}) above the
+        threshold that changed since the last run, upload their new chunks
+        and replace their recipes, moving the old ones to temp_dir. Returns
+        whether any recipe changed. Entries of a scan that is not complete
+        may miss files, so no file is taken as deleted
+        '''
+        large = {p: e for p, e in entries.items() if e[0] > self.threshold}
+        changed = {
+            p: e for p, e in large.items() if self.files.get(p, [None])[:2] != e
+        }
+        deleted = [p for p in self.files if p not in large] if complete else []
+        if not changed and not deleted:
+            return False
+
+        staging = tempfile.mkdtemp(prefix='snapback-chunks-')
+        try:
+            recipes, staged = {}, set()
+            for path, (size, mtime) in changed.items():
+                recipes[path] = self._recipe(
+                    join(source, path), size, mtime, staging, staged
+                )
+            self._flush(staging, staged)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+        for path in [*changed, *deleted]:
+            if path in self.files:
+                try:
+                    self.engine.move_file(
+                        join(self.dest_path, path + RECIPE_SUFFIX),
+                        join(temp_dir, path + RECIPE_SUFFIX)
+                    )
+                except Exception:
+                    log.exception(f'Error moving the recipe of {path} to .temp')
+        for path, recipe in recipes.items():
+            self.engine.write_file(
+                join(self.dest_path, path + RECIPE_SUFFIX), json.dumps(recipe)
+            )
+            self.files[path] = [recipe['size'], recipe['mtime']]
+        for path in deleted:
+            del self.files[path]
+        self._save_cache()
+        log.info(f'{len(changed)} chunked files updated, {len(deleted)} deleted')
+        return True
+
+    def rebuild(self, recipe: dict, out, workers: int = 4):
+        rebuild(self.engine, self.chunks_dir, recipe, out, workers)
+
+    def collect_garbage(self, recipes: list):
+        '''
+        Delete the chunks not referenced by any of the given recipes, which
+        must be every recipe still kept in the main directory and snapbacks
+        '''
+        referenced = {d for recipe in recipes for d, _ in recipe['chunks']}
+        unreferenced = [
+            e['Path'] for e in self.engine.iter_list(self.chunks_dir)
+            if e['Path'].rsplit('/', 1)[-1] not in referenced
+        ]
+        if unreferenced:
+            self.engine.delete(self.chunks_dir, files_from=unreferenced)
+            self.known -= {p.rsplit('/', 1)[-1] for p in unreferenced}
+            self._save_cache()
+        log.info(f'Deleted {len(unreferenced)} unreferenced chunks')
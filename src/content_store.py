@@ -0,0 +1,145 @@
+import json
+import uuid
+import logging as log
+from os.path import join
+
+
+INDEX_FILE = 'index.json'
+BLOBS_DIR = '.blobs'
+
+# Hashes used as blob keys, by preference, among those the backend provides
+HASH_TYPES = ['sha256', 'sha1', 'md5', 'whirlpool', 'quickxor', 'dropbox', 'crc32']
+
+
+def blob_key(entry: dict) -> str:
+    '''
+    Return the key under which the contents of a listed file are stored.
+    Files whose backend provides no hash get a unique key, so they are
+    stored but never deduplicated
+    '''
+    hashes = entry.get('Hashes') or {}
+    for hash_type in HASH_TYPES:
+        if hashes.get(hash_type):
+            return f'{hash_type}-{hashes[hash_type].replace("/", "_")}'
+    return f'nohash-{uuid.uuid4().hex}'
+
+
+class ContentStore:
+    '''
+    Content addressed storage of the snapbacks of a directory. The contents
+    of each file version are stored once under .blobs/ by their hash and
+    every snapback is only an index of {path: blob, size and mtime}, kept
+    for all the snapbacks in a single index.json. Copying, accumulating and
+    moving between snapbacks only change index entries, and blobs that are
+    no longer referenced by any snapback are deleted.
+    '''
+
+    def __init__(self, engine, backup_dir: str):
+        self.engine = engine
+        self.backup_dir = backup_dir
+        self.blobs_dir = join(backup_dir, BLOBS_DIR)
+        self.file = join(backup_dir, INDEX_FILE)
+        # Only a missing index is a new store, any error reading it is
+        # raised so the index is never saved over with this run's entries
+        content = engine.read_file(self.file)
+        self.index = json.loads(content) if content is not None else {}
+        self.dropped = set()
+
+    def blob_path(self, key: str) -> str:
+        return join(self.blobs_dir, key.partition('-')[2][:2], key)
+
+    def _referenced(self) -> set:
+        return {
+            entry['blob']
+            for tier in self.index.values() for entry in tier.values()
+        }
+
+    def _drop(self, entries):
+        self.dropped.update(entry['blob'] for entry in entries)
+
+    def tier(self, name: str) -> dict:
+        return self.index.setdefault(name.rstrip('/'), {})
+
+    def ingest(self, temp_dir: str, name: str = '.temp'):
+        '''
+        Turn the files that the sync moved into temp_dir into blobs and add
+        them to the index of the snapback name. Contents already stored are
+        deleted instead of being stored again.
+
+        The index is saved before any file is moved or deleted, so an
+        ingest that stops halfway leaves its files in temp_dir, referenced
+        by the index. The blobs referenced only by the snapback being
+        ingested are not taken as stored, so the next ingest moves those
+        files instead of deleting them
+        '''
+        tier = self.tier(name)
+        known = {
+            entry['blob']
+            for tier_name, entries in self.index.items() if entries is not tier
+            for entry in entries.values()
+        }
+        moves, deletes = [], []
+        for entry in self.engine.list(temp_dir, hashes=True):
+            key = blob_key(entry)
+            path = join(temp_dir, entry['Path'])
+            if key in known:
+                deletes.append(path)
+            else:
+                moves.append((path, self.blob_path(key)))
+                known.add(key)
+            if entry['Path'] in tier:
+                self._drop([tier[entry['Path']]])
+            tier[entry['Path']] = {
+                'blob': key, 'size': entry['Size'], 'mtime': entry['ModTime']
+            }
+        if not moves and not deletes:
+            return
+        self._save()
+        for path, blob_path in moves:
+            self.engine.move_file(path, blob_path)
+        for path in deletes:
+            self.engine.delete_file(path)
+        log.debug(f'Ingested {len(moves) + len(deletes)} files into {name}, {len(moves)} new blobs')
+
+    def copy(self, a: str, b: str):
+        '''
+        Copy the entries of snapback a into snapback b
+        '''
+        src, dst = self.tier(a), self.tier(b)
+        self._drop(dst[p] for p in src if p in dst)
+        dst.update(src)
+
+    def accumulate(self, a: str, b: str):
+        '''
+        Add the entries of snapback a missing in snapback b and empty a
+        '''
+        src, dst = self.tier(a), self.tier(b)
+        for path, entry in src.items():
+            if path in dst: self._drop([entry])
+            else: dst[path] = entry
+        src.clear()
+
+    def move(self, a: str, b: str):
+        '''
+        Move the entries of snapback a into snapback b, replacing existing ones
+        '''
+        self.copy(a, b)
+        self.tier(a).clear()
+
+    def clear(self, name: str):
+        self._drop(self.tier(name).values())
+        self.tier(name).clear()
+
+    def _save(self):
+        self.engine.write_file(self.file, json.dumps(self.index, separators=(',', ':')))
+
+    def commit(self):
+        '''
+        Save the index and then delete the blobs it no longer references.
+        A crash in between only leaves unreferenced blobs behind
+        '''
+        self._save()
+        for key in self.dropped - self._referenced():
+            try: self.engine.delete_file(self.blob_path(key))
+            except Exception: log.exception(f'Error deleting blob {key}')
+        self.dropped.clear()
@@ -0,0 +1,175 @@
+import os
+import json
+import time
+import argparse
+import threading
+import logging as log
+from datetime import datetime
+from os.path import dirname
+
+
+# Objects returned by each request of a listing on most object stores
+LIST_PAGE = 1000
+
+# Updates of a stage averaged to project its requests
+HISTORY = 10
+
+# Cold tiers whose rolls may be deferred, the coldest first. The daily
+# tier takes in .temp on every run, so it is never deferred
+DEFERRABLE = ('year', 'month', 'week')
+
+
+def requests(record: dict) -> dict:
+    '''
+    Estimate the requests a pay per request object store bills for the
+    counters of a stage: a request per page listed, a PUT or server side
+    COPY per file written, a COPY and a DELETE per file renamed (object
+    stores have no renames), a DELETE per file deleted and one request for
+    each other engine call
+    '''
+    estimate = {
+        'list': -(-record['listed'] // LIST_PAGE),
+        'write': record['files'] + record['renames'],
+        'delete': record['deletes'] + record['renames'],
+        'other': record['calls']
+    }
+    estimate['total'] = sum(estimate.values())
+    return estimate
+
+
+class CostLedger:
+    '''
+    History of the requests and bytes of every stage of every directory
+    update, appended to a JSON lines file, and the budget of requests of
+    the current run shared by all its updates. The requests of a stage are
+    projected from its last updates, so a run that would go over budget
+    defers the rolls of its cold tiers to a later run
+    '''
+
+    def __init__(self, file: str, budget: int = None):
+        self.file = file
+        self.budget = budget
+        self.spent = 0
+        self.lock = threading.Lock()
+        self.history = {}
+        try:
+            with open(file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try: entry = json.loads(line)
+                    except ValueError: continue
+                    for stage, cost in entry['stages'].items():
+                        recent = self.history.setdefault((entry['job'], entry['dir'], stage), [])
+                        recent.append(cost['requests'])
+                        del recent[:-HISTORY]
+        except FileNotFoundError:
+            pass
+
+    def project(self, job: str, dir: str, stage: str, default: int = 0) -> float:
+        '''
+        Return the average requests of the last updates of a stage, or
+        default if it never ran
+        '''
+        with self.lock:
+            recent = self.history.get((job, dir, stage))
+        return sum(recent) / len(recent) if recent else default
+
+    def remaining(self, metrics=None) -> float:
+        '''
+        Return the requests left in the budget of the run, counting those
+        of the update measured by metrics so far, or None without a budget
+        '''
+        if self.budget is None:
+            return None
+        current = sum(requests(r)['total'] for r in metrics.stages) if metrics else 0
+        with self.lock:
+            return self.budget - self.spent - current
+
+    def record(self, metrics):
+        '''
+        Set the estimated requests of each stage of an update in its
+        metrics, spend them from the budget and append them to the history
+        '''
+        stages = {}
+        for record in metrics.stages:
+            record['requests'] = (estimate := requests(record))['total']
+            cost = stages.setdefault(record['stage'], {**dict.fromkeys(estimate, 0), 'bytes': 0})
+            for key, value in estimate.items(): cost[key] += value
+            cost['bytes'] += record['bytes']
+        total = sum(cost['total'] for cost in stages.values())
+        entry = {
+            'time': datetime.fromtimestamp(metrics.start).isoformat(timespec='seconds'),
+            'job': metrics.job,
+            'dir': metrics.dir,
+            'requests': total,
+            'bytes': sum(cost['bytes'] for cost in stages.values()),
+            'stages': {
+                stage: {'requests': cost.pop('total'), **cost} for stage, cost in stages.items()
+            }
+        }
+        with self.lock:
+            self.spent += total
+            for stage, cost in entry['stages'].items():
+                recent = self.history.setdefault((metrics.job, metrics.dir, stage), [])
+                recent.append(cost['requests'])
+                del recent[:-HISTORY]
+            os.makedirs(dirname(self.file) or '.', exist_ok=True)
+            with open(self.file, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + '\n')
+        log.info(f'{metrics.job}/{metrics.dir}: ~{total} requests, {entry["bytes"]} bytes')
+
+
+def totals(file: str, since: str = None, stages: bool = False) -> dict:
+    '''
+    Return {(job, dir[, stage]): [requests, bytes]} summed over the history
+    from the given ISO date on
+    '''
+    sums = {}
+    with open(file, 'r', encoding='utf-8') as f:
+        for line in f:
+            try: entry = json.loads(line)
+            except ValueError: continue
+            if since and entry['time'] < since: continue
+            if stages:
+                items = [((entry['job'], entry['dir'], stage), cost)
+                         for stage, cost in entry['stages'].items()]
+            else:
+                items = [((entry['job'], entry['dir']), entry)]
+            for key, cost in items:
+                total = sums.setdefault(key, [0, 0])
+                total[0] += cost['requests']
+                total[1] += cost['bytes']
+    return sums
+
+
+def command_parser() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="snapBack request costs")
+    parser.add_argument('--history',
+        type=str,
+        default='last_snapback.costs.jsonl',
+        help='Cost history file (default: last_snapback.costs.jsonl)'
+    )
+    parser.add_argument('--since',
+        type=str,
+        default=time.strftime('%Y-%m-01'),
+        help='First date counted, as YYYY-MM-DD (default: first day of this month)'
+    )
+    parser.add_argument('--stages',
+        action='store_true',
+        help='Break the totals down by stage'
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = command_parser()
+    rows = sorted(totals(args.history, args.since, args.stages).items(),
+                  key=lambda row: row[1][0], reverse=True)
+    width = max([len('Directory')] + [len('/'.join(key)) for key, _ in rows])
+    print(f'{"Directory":<{width}}  {"Requests":>10} {"Bytes":>14}')
+    for key, (count, size) in rows:
+        print(f'{"/".join(key):<{width}}  {count:>10} {size:>14}')
+    print(f'{sum(c for _, (c, _) in rows)} requests since {args.since}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+import sys
+import yaml
+import signal
+import argparse
+import threading
+import logging as log
+from datetime import datetime as dt, timedelta
+from lock import FileLock, Locked
+
+
+# Held by the daemon while it lives, so only one instance runs
+DAEMON_LOCK = 'snapback.daemon.lock'
+
+# Slot of the last run of the daemon, to catch up the ones missed
+STATE_FILE = 'last_snapback.daemon.yaml'
+
+
+class SnapBackDaemon:
+    '''
+    Resident scheduler firing run(slot) at every backup hour. A slot that
+    passed without running, because the daemon was stopped, the machine
+    asleep or the previous run long, is run as soon as possible. Only the
+    most recent missed slot is run, as it backs up the same changes all
+    the missed ones would have
+    '''
+
+    def __init__(self,
+        hours: list,
+        run,
+        state_file: str = STATE_FILE,
+        clock=dt.now,
+        max_sleep: float = 60
+    ):
+        self.hours = sorted(int(h) % 24 for h in hours)
+        self.run = run
+        self.state_file = state_file
+        self.clock = clock
+        # Sleeps are short, so a change of the clock or a suspension is noticed
+        self.max_sleep = max_sleep
+        self.stopped = threading.Event()
+
+    def _load(self) -> dt:
+        try:
+            with open(self.state_file, 'r') as f:
+                last = (yaml.safe_load(f) or {}).get('last_slot')
+            return dt.fromisoformat(last) if last else None
+        except FileNotFoundError:
+            return None
+
+    def _save(self, slot: dt):
+        with open(self.state_file, 'w') as f:
+            yaml.dump({'last_slot': slot.isoformat()}, f)
+
+    def last_slot(self, now: dt) -> dt:
+        '''
+        Return the most recent backup hour at or before now
+        '''
+        day = now.replace(minute=0, second=0, microsecond=0)
+        for days in range(2):
+            for hour in reversed(self.hours):
+                if (slot := day.replace(hour=hour) - timedelta(days=days)) <= now:
+                    return slot
+
+    def next_slot(self, now: dt) -> dt:
+        '''
+        Return the first backup hour after now
+        '''
+        day = now.replace(minute=0, second=0, microsecond=0)
+        for days in range(2):
+            for hour in self.hours:
+                if (slot := day.replace(hour=hour) + timedelta(days=days)) > now:
+                    return slot
+
+    def step(self) -> float:
+        '''
+        Run the pending slot, if any, and return the seconds to wait for
+        the next one
+        '''
+        now = self.clock()
+        last = self._load()
+        if last is None:
+            # First start: nothing was missed yet
+            self._save(last := self.last_slot(now))
+        if (slot := self.last_slot(now)) > last:
+            if now - slot > timedelta(minutes=5):
+                log.warning(f'Catching up the run of {slot:%Y-%m-%d %H:%M}')
+            try:
+                self.run(slot)
+            except Exception:
+                log.exception(f'Error in the run of {slot:%Y-%m-%d %H:%M}')
+            self._save(slot)
+            return 0
+        return (self.next_slot(now) - now).total_seconds()
+
+    def serve(self):
+        '''
+        Run the slots until stopped
+        '''
+        log.info('Daemon started')
+        while not self.stopped.is_set():
+            if (wait := self.step()) > 0:
+                self.stopped.wait(min(wait, self.max_sleep))
+        log.info('Daemon stopped')
+
+    def stop(self, *args):
+        self.stopped.set()
+
+
+def command_parser():
+    parser = argparse.ArgumentParser(description="snapBack scheduler daemon")
+    parser.add_argument(
+        '--log-level',
+        type=str,
+        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+        default='ERROR',
+        help='Set the logging level (default: ERROR)'
+    )
+    parser.add_argument(
+        '--engine',
+        type=str,
+        choices=['subprocess', 'daemon'],
+        default=None,
+        help='How rclone is run (default: from config.yaml, subprocess if '
+             'not set). The rclone daemon is kept for every run'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=None,
+        help='Number of directories updated concurrently (default: from '
+             'config.yaml, 1 if not set)'
+    )
+    return parser.parse_args()
+
+
+def main():
+    from backup import RUN_LOCK, load_config, create_data_file, run
+    from engine import create_engine
+
+    config = load_config()
+    args = command_parser()
+    log.basicConfig(
+        level=getattr(log, args.log_level),
+        filename='snapback.log',
+        filemode='a',
+        format='%(asctime)s Daemon: [%(levelname)s] %(message)s'
+    )
+
+    try:
+        instance = FileLock(DAEMON_LOCK, blocking=False).acquire()
+    except Locked:
+        sys.exit(f'The snapBack daemon is already running (process '
+                 f'{FileLock(DAEMON_LOCK).owner()})')
+
+    engine_name = args.engine or config.get('engine', 'subprocess')
+    workers = args.workers or config.get('concurrency', {}).get('max_workers', 1)
+    engine = create_engine(engine_name)
+
+    def run_slot(slot: dt):
+        nonlocal engine
+        # An rclone daemon that died is started again
+        if getattr(engine, 'process', None) and engine.process.poll() is not None:
+            log.warning('The rclone daemon stopped, starting it again')
+            engine.close()
+            engine = create_engine(engine_name)
+        # Waits for a run started by hand to end
+        with FileLock(RUN_LOCK):
+            create_data_file()
+            run(config, engine, str(slot.hour).zfill(2), workers)
+
+    daemon = SnapBackDaemon(config['daily_backup_hours'], run_slot)
+    signal.signal(signal.SIGINT, daemon.stop)
+    signal.signal(signal.SIGTERM, daemon.stop)
+    try:
+        daemon.serve()
+    finally:
+        engine.close()
+        instance.release()
+
+
+if __name__ == '__main__':
+    main()
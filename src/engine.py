@@ -0,0 +1,561 @@
+import os
+import re
+import json
+import time
+import base64
+import shutil
+import secrets
+import socket
+import tempfile
+import threading
+import subprocess
+import http.client
+import logging as log
+from rclone_python import rclone
+from local_engine import LocalEngine
+
+
+class RcloneError(Exception):
+    pass
+
+
+# Suffix of the files in which rclone keeps symlinks with --links
+LINK_SUFFIX = '.rclonelink'
+
+
+def not_found(error: Exception) -> bool:
+    '''
+    Whether an rclone error only reports that the path does not exist
+    '''
+    return any(
+        m in str(error)
+        for m in ('directory not found', 'object not found', 'no such file or directory')
+    )
+
+
+def read_log(file: str) -> tuple:
+    '''
+    Return the last stats and the error messages of an rclone JSON log
+    '''
+    stats, errors = {}, []
+    try:
+        with open(file, 'r', encoding='utf-8') as f:
+            for line in f:
+                try: record = json.loads(line)
+                except ValueError: continue
+                if 'stats' in record: stats = record['stats']
+                if record.get('level') in ('error', 'critical'):
+                    errors.append(record.get('msg', '').strip())
+    except OSError:
+        pass
+    return stats, errors
+
+
+def get_remote(path: str) -> str:
+    '''
+    Return the rclone remote name of the path or None if it is a local path
+    (single letter prefixes such as C: are Windows drives, not remotes)
+    '''
+    if match := re.match(r'^([\w.\- ]{2,}):', path):
+        return match.group(1)
+    return None
+
+
+class SubprocessEngine:
+    '''
+    Runs every operation as its own rclone process. It is the fallback
+    engine and the one used when no rclone daemon can be started.
+    '''
+
+    name = 'subprocess'
+    link_suffix = LINK_SUFFIX
+
+    def __init__(self):
+        # The private directory is created on first use, once, as the
+        # workers of a run share its engine
+        self.tempdir = None
+        self.tempdir_lock = threading.Lock()
+
+    def _temp_file(self, suffix: str) -> tuple:
+        '''
+        Create a file in the private directory of the engine and return
+        its descriptor and path
+        '''
+        with self.tempdir_lock:
+            if self.tempdir is None:
+                self.tempdir = tempfile.mkdtemp(prefix='snapback-')
+            return tempfile.mkstemp(dir=self.tempdir, suffix=suffix)
+
+    def _list_file(self, paths: list) -> str:
+        '''
+        Write the paths to a file in the private directory of the engine,
+        one per line as expected by --files-from
+        '''
+        fd, file = self._temp_file('.txt')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.writelines(path + '\n' for path in paths)
+        return file
+
+    def _transfer(self, operation, *paths, **options) -> dict:
+        '''
+        Run an rclone_python operation with its log written as JSON to a
+        file of the engine, and return the final stats rclone logs. The
+        errors in the log are added to the exception of a failed operation
+        '''
+        fd, file = self._temp_file('.json')
+        os.close(fd)
+        args = self._args(**options) + [
+            # Setting --stats, even to its default, makes every command log its final stats
+            f'--log-file "{file}"', '--use-json-log', '--stats-log-level NOTICE', '--stats 1m'
+        ]
+        try:
+            operation(*paths, args=args)
+            return read_log(file)[0]
+        except Exception as e:
+            raise RcloneError('\n'.join([str(e), *read_log(file)[1]])) from e
+        finally:
+            os.remove(file)
+
+    def _args(self,
+        backup_dir: str = None,
+        exclude: list = (),
+        ignore_existing: bool = False,
+        fast_list: bool = False,
+        links: bool = False,
+        files_from: list = None,
+        no_traverse: bool = False,
+        max_size: int = None,
+        transfers: int = None,
+        checkers: int = None,
+        buffer_size: int = None,
+    ) -> list:
+        args = []
+        if fast_list: args.append('--fast-list')
+        if links: args.append('--links')
+        if backup_dir: args.append(f'--backup-dir {backup_dir}')
+        if ignore_existing: args.append('--ignore-existing')
+        if no_traverse: args.append('--no-traverse')
+        if max_size is not None: args.append(f'--max-size {max_size}B')
+        if transfers: args.append(f'--transfers {transfers}')
+        if checkers: args.append(f'--checkers {checkers}')
+        if buffer_size is not None: args.append(f'--buffer-size {buffer_size}B')
+        if files_from is not None:
+            args.append(f'--files-from "{self._list_file(files_from)}"')
+        args.extend([f'--exclude {x}' for x in exclude])
+        return args
+
+    def mkdir(self, path: str):
+        result = subprocess.run(['rclone', 'mkdir', path])
+        if result.returncode:
+            raise RcloneError(f'Error creating directory {path}')
+
+    def sync(self, src: str, dst: str, **options) -> dict:
+        return self._transfer(rclone.sync, src, dst, **options)
+
+    def copy(self, src: str, dst: str, **options) -> dict:
+        return self._transfer(rclone.copy, src, dst, **options)
+
+    def move(self, src: str, dst: str, **options) -> dict:
+        return self._transfer(rclone.move, src, dst, **options)
+
+    def delete(self, path: str, **options) -> dict:
+        return self._transfer(rclone.delete, path, **options)
+
+    def accumulate(self, src: str, dst: str, **options) -> dict:
+        '''
+        Move the files of src missing in dst, server-side when the backend
+        can, and then discard src with whatever it still holds in bulk
+        '''
+        stats = self.move(src, dst, ignore_existing=True, **options)
+        self.purge(src)
+        return stats
+
+    def purge(self, path: str):
+        '''
+        Remove path and everything under it. A missing path is already gone
+        '''
+        try:
+            rclone.purge(path)
+        except Exception as e:
+            if not not_found(e): raise
+
+    def iter_list(self, path: str, hashes: bool = False):
+        '''
+        Yield every file under path as rclone lsjson entries (Path, Size,
+        ModTime and, if requested, the Hashes the backend provides), parsed
+        as rclone prints them. Without --fast-list rclone lists a directory
+        at a time, so no side holds the whole listing. A missing directory
+        has no files
+        '''
+        command = ['rclone', 'lsjson', '-R', '--files-only', path]
+        if hashes: command.append('--hash')
+        fd, errors = self._temp_file('.log')
+        try:
+            with os.fdopen(fd, 'w+', encoding='utf-8') as stderr, subprocess.Popen(
+                command, stdout=subprocess.PIPE, stderr=stderr, text=True, encoding='utf-8'
+            ) as process:
+                completed = False
+                try:
+                    # lsjson prints one entry per line between [ and ]
+                    for line in process.stdout:
+                        if (line := line.strip().rstrip(',')) in ('', '[', ']'): continue
+                        yield json.loads(line)
+                    completed = True
+                finally:
+                    if not completed: process.kill()
+                if process.wait():
+                    stderr.seek(0)
+                    if 'directory not found' in (message := stderr.read()): return
+                    raise RcloneError(f'Error listing {path}: {message}')
+        finally:
+            os.remove(errors)
+
+    def list(self, path: str, hashes: bool = False) -> list:
+        return list(self.iter_list(path, hashes))
+
+    def move_file(self, src: str, dst: str):
+        result = subprocess.run(['rclone', 'moveto', src, dst],
+            capture_output=True, text=True)
+        if result.returncode:
+            raise RcloneError(f'Error moving {src}: {result.stderr}')
+
+    def copy_file(self, src: str, dst: str):
+        result = subprocess.run(['rclone', 'copyto', '--links', src, dst],
+            capture_output=True, text=True)
+        if result.returncode:
+            raise RcloneError(f'Error copying {src}: {result.stderr}')
+
+    def delete_file(self, path: str):
+        result = subprocess.run(['rclone', 'deletefile', path],
+            capture_output=True, text=True)
+        if result.returncode:
+            raise RcloneError(f'Error deleting {path}: {result.stderr}')
+
+    def read_file(self, path: str) -> str:
+        '''
+        Return the contents of a small text file or None if it does not
+        exist. Any other error is raised, as taking an unreadable file for
+        a missing one would have it overwritten
+        '''
+        result = subprocess.run(['rclone', 'cat', path],
+            capture_output=True, text=True)
+        if result.returncode == 0:
+            return result.stdout
+        if not_found(result.stderr):
+            return None
+        raise RcloneError(f'Error reading {path}: {result.stderr}')
+
+    def read_bytes(self, path: str) -> bytes:
+        result = subprocess.run(['rclone', 'cat', path], capture_output=True)
+        if result.returncode:
+            raise RcloneError(f'Error reading {path}: {result.stderr.decode()}')
+        return result.stdout
+
+    def read_range(self, path: str, offset: int, length: int) -> bytes:
+        '''
+        Return length bytes of a file from offset, reading only them when
+        the backend supports range requests
+        '''
+        result = subprocess.run(
+            ['rclone', 'cat', '--offset', str(offset), '--count', str(length), path],
+            capture_output=True
+        )
+        if result.returncode:
+            raise RcloneError(f'Error reading {path}: {result.stderr.decode()}')
+        return result.stdout
+
+    def write_file(self, path: str, content: str):
+        result = subprocess.run(['rclone', 'rcat', path],
+            input=content, capture_output=True, text=True)
+        if result.returncode:
+            raise RcloneError(f'Error writing {path}: {result.stderr}')
+
+    def close(self):
+        with self.tempdir_lock:
+            if self.tempdir:
+                shutil.rmtree(self.tempdir, ignore_errors=True)
+                self.tempdir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, socket_path: str):
+        super().__init__('localhost')
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+class DaemonEngine(SubprocessEngine):
+    '''
+    Starts a single `rclone rcd` for the whole run and sends every operation
+    to its rc API, so the rclone config is read and the backends are
+    authenticated only once. Each thread keeps its own keep-alive connection
+    to the daemon, over a unix socket when the platform supports it.
+    '''
+
+    name = 'daemon'
+
+    def __init__(self, startup_timeout: float = 10):
+        super().__init__()
+        self.user = secrets.token_hex(8)
+        self.password = secrets.token_hex(16)
+        self.local = threading.local()
+        self.tempdir = tempfile.mkdtemp(prefix='snapback-rcd-')
+
+        if hasattr(socket, 'AF_UNIX') and os.name != 'nt':
+            self.socket_path = os.path.join(self.tempdir, 'rcd.sock')
+            addr = 'unix://' + self.socket_path
+        else:
+            self.socket_path = None
+            with socket.socket() as s:
+                s.bind(('127.0.0.1', 0))
+                self.port = s.getsockname()[1]
+            addr = f'127.0.0.1:{self.port}'
+
+        try:
+            self.process = subprocess.Popen(
+                ['rclone', 'rcd', '--rc-addr', addr,
+                 '--rc-user', self.user, '--rc-pass', self.password],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL
+            )
+        except OSError:
+            shutil.rmtree(self.tempdir, ignore_errors=True)
+            raise
+
+        deadline = time.time() + startup_timeout
+        while True:
+            try:
+                self.call('rc/noop')
+                break
+            except (OSError, RcloneError):
+                if self.process.poll() is not None or time.time() > deadline:
+                    self.close()
+                    raise RcloneError('Could not start the rclone daemon')
+                time.sleep(0.1)
+
+    def _connection(self) -> http.client.HTTPConnection:
+        if getattr(self.local, 'connection', None) is None:
+            if self.socket_path:
+                self.local.connection = UnixHTTPConnection(self.socket_path)
+            else:
+                self.local.connection = http.client.HTTPConnection(
+                    '127.0.0.1', self.port
+                )
+        return self.local.connection
+
+    def call(self, method: str, **params) -> dict:
+        '''
+        Call a method of the rc API and return its decoded response
+        '''
+        credentials = base64.b64encode(
+            f'{self.user}:{self.password}'.encode()
+        ).decode()
+        headers = {
+            'Content-Type': 'application/json',
+            'Authorization': f'Basic {credentials}'
+        }
+        connection = self._connection()
+        try:
+            connection.request('POST', '/' + method, json.dumps(params), headers)
+            response = connection.getresponse()
+            body = json.loads(response.read() or b'{}')
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            self.local.connection = None
+            raise
+        if response.status != 200:
+            raise RcloneError(f'{method}: {body.get("error", response.reason)}')
+        return body
+
+    def _params(self,
+        backup_dir: str = None,
+        exclude: list = (),
+        ignore_existing: bool = False,
+        fast_list: bool = False,
+        links: bool = False,
+        files_from: list = None,
+        no_traverse: bool = False,
+        max_size: int = None,
+        transfers: int = None,
+        checkers: int = None,
+        buffer_size: int = None,
+    ) -> dict:
+        config, filters = {}, {}
+        if fast_list: config['UseListR'] = True
+        if backup_dir: config['BackupDir'] = backup_dir
+        if ignore_existing: config['IgnoreExisting'] = True
+        if no_traverse: config['NoTraverse'] = True
+        if transfers: config['Transfers'] = transfers
+        if checkers: config['Checkers'] = checkers
+        if buffer_size is not None: config['BufferSize'] = buffer_size
+        if exclude: filters['ExcludeRule'] = list(exclude)
+        if max_size is not None: filters['MaxSize'] = max_size
+        if files_from is not None:
+            filters['FilesFrom'] = [self._list_file(files_from)]
+        params = {}
+        if config: params['_config'] = config
+        if filters: params['_filter'] = filters
+        return params
+
+    @staticmethod
+    def _fs(path: str, links: bool = False) -> str:
+        # Local paths need the links option set on the connection string
+        if links and get_remote(path) is None:
+            return f':local,links:{path}'
+        return path
+
+    def _transfer(self, method: str, **params) -> dict:
+        '''
+        Call a method in a stats group of its own and return the stats
+        rclone kept for it
+        '''
+        group = f'snapback-{secrets.token_hex(8)}'
+        try:
+            self.call(method, _group=group, **params)
+            return self.call('core/stats', group=group)
+        finally:
+            try: self.call('core/stats-delete', group=group)
+            except (OSError, RcloneError): pass
+
+    def mkdir(self, path: str):
+        self.call('operations/mkdir', fs=path, remote='')
+
+    def sync(self, src: str, dst: str, **options) -> dict:
+        return self._transfer('sync/sync',
+            srcFs=self._fs(src, options.get('links')), dstFs=dst,
+            **self._params(**options)
+        )
+
+    def copy(self, src: str, dst: str, **options) -> dict:
+        return self._transfer('sync/copy',
+            srcFs=self._fs(src, options.get('links')), dstFs=dst,
+            **self._params(**options)
+        )
+
+    def move(self, src: str, dst: str, **options) -> dict:
+        return self._transfer('sync/move',
+            srcFs=self._fs(src, options.get('links')), dstFs=dst,
+            **self._params(**options)
+        )
+
+    def delete(self, path: str, **options) -> dict:
+        return self._transfer('operations/delete', fs=path, **self._params(**options))
+
+    def accumulate(self, src: str, dst: str, **options) -> dict:
+        stats = self.move(src, dst, ignore_existing=True, **options)
+        self.purge(src)
+        return stats
+
+    def purge(self, path: str):
+        try:
+            self.call('operations/purge', fs=path, remote='')
+        except RcloneError as e:
+            if not not_found(e): raise
+
+    # iter_list is inherited: the rc API answers with the whole listing at
+    # once, so streamed listings are read from an rclone process instead
+    def list(self, path: str, hashes: bool = False) -> list:
+        try:
+            return self.call('operations/list', fs=path, remote='', opt={
+                'recurse': True, 'filesOnly': True, 'showHash': hashes
+            })['list']
+        except RcloneError as e:
+            if 'directory not found' in str(e): return []
+            raise
+
+    def move_file(self, src: str, dst: str):
+        (src_fs, src_name), (dst_fs, dst_name) = os.path.split(src), os.path.split(dst)
+        self.call('operations/movefile',
+            srcFs=src_fs, srcRemote=src_name, dstFs=dst_fs, dstRemote=dst_name)
+
+    def copy_file(self, src: str, dst: str):
+        (src_fs, src_name), (dst_fs, dst_name) = os.path.split(src), os.path.split(dst)
+        self.call('operations/copyfile',
+            srcFs=self._fs(src_fs, links=True), srcRemote=src_name,
+            dstFs=self._fs(dst_fs, links=True), dstRemote=dst_name)
+
+    def delete_file(self, path: str):
+        fs, name = os.path.split(path)
+        self.call('operations/deletefile', fs=fs, remote=name)
+
+    def read_file(self, path: str) -> str:
+        '''
+        Return the contents of a small text file or None if it does not
+        exist, raising any other error. The file is fetched through the
+        daemon into its private directory
+        '''
+        fs, name = os.path.split(path.rstrip('/'))
+        local = tempfile.mkdtemp(dir=self.tempdir)
+        try:
+            self.call('operations/copyfile',
+                srcFs=fs, srcRemote=name, dstFs=local, dstRemote=name)
+            with open(os.path.join(local, name), 'r') as f: return f.read()
+        except RcloneError as e:
+            if not not_found(e): raise
+            return None
+        finally:
+            shutil.rmtree(local, ignore_errors=True)
+
+    def read_bytes(self, path: str) -> bytes:
+        fs, name = os.path.split(path.rstrip('/'))
+        local = tempfile.mkdtemp(dir=self.tempdir)
+        try:
+            self.call('operations/copyfile',
+                srcFs=fs, srcRemote=name, dstFs=local, dstRemote=name)
+            with open(os.path.join(local, name), 'rb') as f: return f.read()
+        finally:
+            shutil.rmtree(local, ignore_errors=True)
+
+    # read_range is inherited: the rc API has no ranged read, so it runs rclone cat
+
+    def write_file(self, path: str, content: str):
+        fs, name = os.path.split(path.rstrip('/'))
+        local = tempfile.mkdtemp(dir=self.tempdir)
+        try:
+            with open(os.path.join(local, name), 'w') as f: f.write(content)
+            self.call('operations/copyfile',
+                srcFs=local, srcRemote=name, dstFs=fs, dstRemote=name)
+        finally:
+            shutil.rmtree(local, ignore_errors=True)
+
+    def close(self):
+        if self.process.poll() is None:
+            try: self.call('core/quit')
+            except (OSError, RcloneError): pass
+            try: self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired: self.process.kill()
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+
+
+def create_engine(name: str = 'subprocess'):
+    '''
+    Create the rclone engine by name, falling back to the subprocess engine
+    if the daemon can not be started
+    '''
+    if name == 'daemon':
+        try:
+            return DaemonEngine()
+        except (OSError, RcloneError):
+            log.warning('rclone daemon not available, using subprocesses')
+    return SubprocessEngine()
+
+
+def engine_for(dest_path: str, engine=None, local_engine: str = 'hardlink'):
+    '''
+    Return the engine for a destination: local destinations get a
+    LocalEngine with the given link mode unless local_engine is "rclone",
+    remotes get the run's rclone engine
+    '''
+    if get_remote(dest_path) is None and local_engine != 'rclone':
+        return LocalEngine(local_engine)
+    return engine or SubprocessEngine()
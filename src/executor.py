@@ -0,0 +1,86 @@
+import threading
+import logging as log
+from collections import defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+
+class SnapBackExecutor:
+    '''
+    Bounded worker pool that runs independent tasks in parallel while
+    limiting how many of them hit the same remote at the same time.
+
+    Tasks are queued per remote and only handed to the pool once the
+    remote has a free slot, so workers never sit blocked waiting for a
+    busy remote while tasks for other remotes are pending.
+    '''
+
+    def __init__(self,
+        max_workers: int = 4,
+        remote_limits: dict = None,
+        default_limit: int = None
+    ):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.remote_limits = remote_limits or {}
+        self.default_limit = default_limit or max_workers
+        self.lock = threading.Lock()
+        self.pending = defaultdict(deque)
+        self.running = defaultdict(int)
+        self.futures = []
+
+    def _limit(self, remote: str) -> int:
+        return max(1, self.remote_limits.get(remote, self.default_limit))
+
+    def _dispatch(self, remote: str):
+        '''
+        Hand queued tasks of the remote to the pool while it has free slots
+        '''
+        with self.lock:
+            while (self.pending[remote]
+                   and self.running[remote] < self._limit(remote)):
+                task = self.pending[remote].popleft()
+                self.running[remote] += 1
+                self.pool.submit(self._run, remote, *task)
+
+    def _run(self, remote: str, future: Future, fn, args, kwargs):
+        try:
+            if future.set_running_or_notify_cancel():
+                try: future.set_result(fn(*args, **kwargs))
+                except BaseException as e: future.set_exception(e)
+        finally:
+            with self.lock: self.running[remote] -= 1
+            self._dispatch(remote)
+
+    def submit(self, remote: str, fn, *args, **kwargs) -> Future:
+        '''
+        Queue fn(*args, **kwargs) to run under the concurrency cap of remote
+        '''
+        future = Future()
+        with self.lock:
+            self.pending[remote].append((future, fn, args, kwargs))
+            self.futures.append(future)
+        self._dispatch(remote)
+        return future
+
+    def wait(self) -> list:
+        '''
+        Wait for every submitted task, including the ones submitted by
+        other tasks while waiting, and return the exceptions raised
+        '''
+        waited = 0
+        while waited < len(self.futures):
+            waited = len(self.futures)
+            wait(self.futures[:waited])
+        errors = [f.exception() for f in self.futures if f.exception()]
+        for error in errors:
+            log.error(f'Task failed: {error!r}')
+        return errors
+
+    def shutdown(self):
+        self.wait()
+        self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
@@ -0,0 +1,140 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+import logging as log
+from concurrent.futures import ThreadPoolExecutor
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS hashes (
+    dev       INTEGER NOT NULL,
+    ino       INTEGER NOT NULL,
+    algorithm TEXT NOT NULL,
+    size      INTEGER NOT NULL,
+    mtime_ns  INTEGER NOT NULL,
+    hash      TEXT NOT NULL,
+    used      INTEGER NOT NULL,
+    PRIMARY KEY (dev, ino, algorithm)
+);
+'''
+
+# Days after which the hashes of files that were not looked up are dropped
+KEEP_DAYS = 30
+
+
+def hash_file(path: str, algorithm: str = 'sha1') -> str:
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        while chunk := f.read(1 << 20): digest.update(chunk)
+    return digest.hexdigest()
+
+
+class HashCache:
+    '''
+    Content hashes of local files, stored in SQLite and keyed by device,
+    inode, size and modification time. A file is only read again when one
+    of them changed, so comparing by content costs a stat per file instead
+    of reading the whole source on every run. Shared by every job, as the
+    keys do not depend on where the file is backed up.
+
+    Files larger than `large` bytes are hashed by a pool of `workers`
+    threads, hashlib releasing the GIL while it digests
+    '''
+
+    def __init__(self,
+        file: str,
+        algorithm: str = 'sha1',
+        workers: int = 4,
+        large: int = 1 << 20
+    ):
+        self.file = file
+        self.algorithm = algorithm
+        self.workers = workers
+        self.large = large
+        self.hits = self.misses = 0
+        self.today = int(time.time() // 86400)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(file, timeout=30, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+        with self.db:
+            self.db.execute('DELETE FROM hashes WHERE used < ?', (self.today - KEEP_DAYS,))
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _lookup(self, path_stat: os.stat_result) -> str:
+        row = self.db.execute(
+            'SELECT hash FROM hashes WHERE dev=? AND ino=? AND algorithm=? '
+            'AND size=? AND mtime_ns=?',
+            (path_stat.st_dev, path_stat.st_ino, self.algorithm,
+             path_stat.st_size, path_stat.st_mtime_ns)
+        ).fetchone()
+        return row and row[0]
+
+    def _hash(self, path: str, path_stat: os.stat_result) -> str:
+        '''
+        Hash a file, or return None if it changed while it was read
+        '''
+        digest = hash_file(path, self.algorithm)
+        after = os.stat(path)
+        if (after.st_size, after.st_mtime_ns) != (path_stat.st_size, path_stat.st_mtime_ns):
+            log.warning(f'{path} changed while it was hashed')
+            return None
+        return digest
+
+    def hash_files(self, paths: dict) -> dict:
+        '''
+        Return {key: hash} for paths ({key: local path}), reading only the
+        files whose signature is not in the cache. Files that can not be
+        read, or change while they are read, are left out
+        '''
+        hashes, small, large, used = {}, [], [], []
+        with self.lock:
+            for key, path in paths.items():
+                try:
+                    path_stat = os.stat(path)
+                except OSError:
+                    log.exception(f'Error reading {path}')
+                    continue
+                if digest := self._lookup(path_stat):
+                    hashes[key] = digest
+                    used.append((self.today, path_stat.st_dev, path_stat.st_ino, self.algorithm))
+                else:
+                    (large if path_stat.st_size > self.large else small).append((key, path, path_stat))
+            self.hits += len(hashes)
+            self.misses += len(small) + len(large)
+
+        def compute(item: tuple) -> tuple:
+            key, path, path_stat = item
+            try:
+                return key, path_stat, self._hash(path, path_stat)
+            except OSError:
+                log.exception(f'Error hashing {path}')
+                return key, path_stat, None
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            results = list(pool.map(compute, large))
+        results.extend(map(compute, small))
+
+        rows = []
+        for key, path_stat, digest in results:
+            if digest is None: continue
+            hashes[key] = digest
+            rows.append((path_stat.st_dev, path_stat.st_ino, self.algorithm,
+                path_stat.st_size, path_stat.st_mtime_ns, digest, self.today))
+        with self.lock, self.db:
+            self.db.executemany('UPDATE hashes SET used=? WHERE dev=? AND ino=? AND algorithm=?', used)
+            self.db.executemany('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        return hashes
+
+    def hash(self, path: str) -> str:
+        return self.hash_files({path: path}).get(path)
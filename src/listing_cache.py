@@ -0,0 +1,260 @@
+import threading
+import logging as log
+
+
+# Options after which the files a transfer writes can not be told from
+# the listing of its source
+UNMODELED = ('exclude', 'backup_dir')
+
+
+def _norm(path: str) -> str:
+    '''
+    Key of a path in the listings, which the engine is never given
+    '''
+    return path.replace('\\', '/').rstrip('/')
+
+
+def _relative(path: str, root: str) -> str:
+    '''
+    Return path relative to root, '' for root itself, or None if it is not
+    under root
+    '''
+    if path == root:
+        return ''
+    if path.startswith(root + '/') or (root.endswith(':') and path.startswith(root)):
+        return path[len(root):].lstrip('/')
+    return None
+
+
+class ListingCache:
+    '''
+    Engine that keeps the listings made during the update of a directory
+    and answers the later listings of the same directories, or of
+    directories under them, from memory. The engine's own operations
+    update the listings they change in place: transfers between known
+    directories, deletions, purges and renames. Listings it can not keep
+    exact, and every listing touched by an operation that fails, are
+    dropped and listed again when needed.
+
+    Directories created by the update, or known to hold files, are not
+    created again
+    '''
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.lock = threading.RLock()
+        # {root: (whether entries have Hashes, {path: lsjson entry})}
+        self.listings = {}
+        self.dirs = set()
+        self.hits = self.misses = 0
+
+    def __getattr__(self, name: str):
+        return getattr(self.engine, name)
+
+    # Cached listings
+
+    def _view(self, path: str, hashes: bool = False) -> dict:
+        '''
+        Return {path: entry} of the known files under path, or None
+        '''
+        with self.lock:
+            for root, (with_hashes, entries) in self.listings.items():
+                if (prefix := _relative(path, root)) is None or (hashes and not with_hashes):
+                    continue
+                if not prefix:
+                    return dict(entries)
+                prefix += '/'
+                return {p[len(prefix):]: e for p, e in entries.items() if p.startswith(prefix)}
+        return None
+
+    def _store(self, path: str, hashes: bool, entries: dict):
+        with self.lock:
+            for root in [r for r in self.listings if _relative(r, path) is not None]:
+                del self.listings[root]
+            self.listings[path] = (hashes, entries)
+
+    def _replace(self, path: str, entries: dict, hashes: bool = True):
+        '''
+        Set the files under path in every listing that covers it
+        '''
+        with self.lock:
+            for root, (with_hashes, cached) in list(self.listings.items()):
+                if (prefix := _relative(path, root)) is not None:
+                    prefix = prefix + '/' if prefix else ''
+                    kept = {p: e for p, e in cached.items() if not p.startswith(prefix)}
+                    kept.update({prefix + p: e for p, e in entries.items()})
+                elif (sub := _relative(root, path)) is not None:
+                    sub += '/'
+                    kept = {p[len(sub):]: e for p, e in entries.items() if p.startswith(sub)}
+                else:
+                    continue
+                self.listings[root] = (with_hashes and hashes, kept)
+
+    def invalidate(self, *paths: str):
+        '''
+        Forget the listings that hold any of the paths, or files under them
+        '''
+        with self.lock:
+            for path in map(_norm, filter(None, paths)):
+                for root in list(self.listings):
+                    if _relative(root, path) is not None or _relative(path, root) is not None:
+                        del self.listings[root]
+                self.dirs = {d for d in self.dirs if _relative(d, path) is None}
+
+    def iter_list(self, path: str, hashes: bool = False):
+        if (entries := self._view(key := _norm(path), hashes)) is not None:
+            self.hits += 1
+            for rel_path, entry in entries.items():
+                yield {**entry, 'Path': rel_path}
+            return
+        self.misses += 1
+        listed = {}
+        for entry in self.engine.iter_list(path, hashes=hashes):
+            listed[entry['Path']] = entry
+            yield {**entry}
+        self._store(key, hashes, listed)
+
+    def list(self, path: str, hashes: bool = False) -> list:
+        return list(self.iter_list(path, hashes))
+
+    # Operations
+
+    def _guarded(self, paths: tuple, operation, *args, **options):
+        '''
+        Run an operation of the engine, forgetting the listings of its
+        paths if it fails, as it may have changed them halfway
+        '''
+        try:
+            return operation(*args, **options)
+        except Exception:
+            self.invalidate(*paths)
+            raise
+
+    def _selected(self, src: str, files_from: list = None, max_size: int = None, **options) -> dict:
+        '''
+        Return the known files of src a transfer with these options takes
+        '''
+        if (entries := self._view(src)) is None:
+            return None
+        if files_from is not None:
+            entries = {p: entries[p] for p in files_from if p in entries}
+        if max_size is not None:
+            entries = {p: e for p, e in entries.items() if e['Size'] <= max_size}
+        return entries
+
+    def _transfer(self, kind: str, src: str, dst: str, **options) -> dict:
+        '''
+        Run a copy, move or accumulation and apply it to the known listings
+        '''
+        backup_dir = options.get('backup_dir')
+        stats = self._guarded((src, dst, backup_dir),
+            getattr(self.engine, kind), src, dst, **options)
+        src, dst = _norm(src), _norm(dst)
+        with self.lock:
+            self.invalidate(backup_dir)
+            taken, current = self._selected(src, **options), self._view(dst)
+            if taken is None or current is None or any(options.get(o) for o in UNMODELED):
+                self.invalidate(dst, src if kind == 'move' else None)
+            else:
+                if kind == 'accumulate' or options.get('ignore_existing'):
+                    taken = {p: e for p, e in taken.items() if p not in current}
+                self._replace(dst, {**current, **taken},
+                    all('Hashes' in e for e in taken.values()))
+                if kind == 'move':
+                    self._replace(src, {p: e for p, e in self._view(src).items() if p not in taken})
+                self.dirs.add(dst)
+            # An accumulation discards its source with whatever it still holds
+            if kind == 'accumulate':
+                self._replace(src, {})
+                self.dirs = {d for d in self.dirs if _relative(d, src) is None}
+        return stats
+
+    def copy(self, src: str, dst: str, **options) -> dict:
+        return self._transfer('copy', src, dst, **options)
+
+    def move(self, src: str, dst: str, **options) -> dict:
+        return self._transfer('move', src, dst, **options)
+
+    def accumulate(self, src: str, dst: str, **options) -> dict:
+        return self._transfer('accumulate', src, dst, **options)
+
+    def sync(self, src: str, dst: str, **options) -> dict:
+        try:
+            return self.engine.sync(src, dst, **options)
+        finally:
+            self.invalidate(src, dst, options.get('backup_dir'))
+
+    def delete(self, path: str, files_from: list = None, **options) -> dict:
+        stats = self._guarded((path,), self.engine.delete, path, files_from=files_from, **options)
+        path = _norm(path)
+        with self.lock:
+            if options.get('exclude') or (current := self._view(path)) is None:
+                self.invalidate(path)
+                return stats
+            deleted = self._selected(path, files_from, options.get('max_size'))
+            self._replace(path, {p: e for p, e in current.items() if p not in deleted})
+        return stats
+
+    def purge(self, path: str):
+        self._guarded((path,), self.engine.purge, path)
+        self._replace(path := _norm(path), {})
+        with self.lock:
+            self.dirs = {d for d in self.dirs if _relative(d, path) is None}
+
+    def mkdir(self, path: str):
+        with self.lock:
+            if (key := _norm(path)) in self.dirs or self._view(key):
+                log.debug(f'{path} already exists')
+                return
+        self.engine.mkdir(path)
+        with self.lock:
+            self.dirs.add(key)
+
+    def _file(self, path: str) -> tuple:
+        '''
+        Split a file path into its directory and name
+        '''
+        parent, _, name = _norm(path).rpartition('/')
+        return parent, name
+
+    def _set_file(self, path: str, entry: dict = None) -> bool:
+        '''
+        Set, or remove without entry, a file in the known listing of its
+        directory. Returns False if the directory is not known
+        '''
+        parent, name = self._file(path)
+        with self.lock:
+            if (current := self._view(parent)) is None:
+                return False
+            if entry is None:
+                current.pop(name, None)
+            else:
+                current[name] = {**entry, 'Path': name, 'Name': name}
+            self._replace(parent, current, entry is None or 'Hashes' in entry)
+        return True
+
+    def _entry(self, path: str) -> dict:
+        parent, name = self._file(path)
+        return (self._view(parent) or {}).get(name)
+
+    def move_file(self, src: str, dst: str):
+        self._guarded((src, dst), self.engine.move_file, src, dst)
+        entry = self._entry(src)
+        self._set_file(src)
+        if entry is None or not self._set_file(dst, entry):
+            self.invalidate(dst)
+
+    def copy_file(self, src: str, dst: str):
+        self._guarded((dst,), self.engine.copy_file, src, dst)
+        if (entry := self._entry(src)) is None or not self._set_file(dst, entry):
+            self.invalidate(dst)
+
+    def delete_file(self, path: str):
+        self._guarded((path,), self.engine.delete_file, path)
+        self._set_file(path)
+
+    def write_file(self, path: str, content: str):
+        try:
+            self.engine.write_file(path, content)
+        finally:
+            self.invalidate(path)
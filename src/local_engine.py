@@ -0,0 +1,297 @@
+import os
+import errno
+import shutil
+import hashlib
+from datetime import datetime, timezone
+from os.path import join, exists, dirname
+from manifest import scan
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+FICLONE = 0x40049409
+
+
+def new_stats() -> dict:
+    '''
+    Counters of an operation, named after those of the rclone stats
+    '''
+    return {'transfers': 0, 'bytes': 0, 'checks': 0, 'renames': 0, 'deletes': 0}
+
+
+def reflink(src: str, dst: str):
+    '''
+    Clone src into dst sharing its data blocks (Btrfs, XFS, ...). Raises
+    OSError when the filesystem does not support it
+    '''
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, 'reflinks are not supported')
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except OSError:
+            d.close()
+            os.remove(dst)
+            raise
+    shutil.copystat(src, dst)
+
+
+class LocalEngine:
+    '''
+    Engine for destinations that are local paths or mounts (NAS, NFS, ...).
+    Files are transferred from the source with reflinks when possible and
+    byte copies otherwise, while the tiers are populated with hard links
+    (or reflinks) and renames, so tier operations only cost metadata.
+
+    Backed up files are never modified in place: a changed file is written
+    to a new inode and the old one is renamed into the backup directory,
+    which makes it safe for several tiers to share an inode.
+    '''
+
+    name = 'local'
+    # Symlinks are kept as symlinks, under their own name
+    link_suffix = ''
+
+    def __init__(self, link_mode: str = 'hardlink'):
+        self.link_mode = link_mode
+
+    def _transfer(self, src: str, dst: str, links: bool = False):
+        '''
+        Write a new file dst with the contents of the source file src
+        '''
+        os.makedirs(dirname(dst), exist_ok=True)
+        temp = dst + '.snapback-partial'
+        if links and os.path.islink(src):
+            os.symlink(os.readlink(src), temp)
+        else:
+            try: reflink(src, temp)
+            except OSError: shutil.copy2(src, temp, follow_symlinks=not links)
+        os.replace(temp, dst)
+
+    def _link(self, src: str, dst: str):
+        '''
+        Make dst share the contents of src without copying them
+        '''
+        os.makedirs(dirname(dst), exist_ok=True)
+        if os.path.lexists(dst): os.remove(dst)
+        if self.link_mode == 'reflink' and not os.path.islink(src):
+            try: return reflink(src, dst)
+            except OSError: pass
+        try:
+            os.link(src, dst, follow_symlinks=False)
+        except OSError:
+            shutil.copy2(src, dst, follow_symlinks=False)
+
+    def _rename(self, src: str, dst: str):
+        os.makedirs(dirname(dst), exist_ok=True)
+        os.replace(src, dst)
+
+    @staticmethod
+    def _files(path: str,
+        files_from: list = None,
+        exclude: list = (),
+        max_size: int = None,
+        errors: list = None
+    ) -> dict:
+        if files_from is not None:
+            files = {}
+            for p in files_from:
+                if os.path.lexists(file := join(path, p)):
+                    file_stat = os.lstat(file)
+                    files[p] = [file_stat.st_size, file_stat.st_mtime_ns]
+        elif not exists(path):
+            return {}
+        else:
+            files = scan(path, exclude, errors=errors)
+        if max_size is not None:
+            files = {p: e for p, e in files.items() if e[0] <= max_size}
+        return files
+
+    @staticmethod
+    def _remove_empty_dirs(path: str):
+        '''
+        Remove the empty subdirectories of path, keeping path itself
+        '''
+        for root, dirs, files in os.walk(path, topdown=False):
+            if root != path and not os.listdir(root):
+                os.rmdir(root)
+
+    def mkdir(self, path: str):
+        os.makedirs(path, exist_ok=True)
+
+    def sync(self, src: str, dst: str,
+        backup_dir: str = None,
+        exclude: list = (),
+        links: bool = False,
+        max_size: int = None,
+        **options
+    ):
+        '''
+        Make dst identical to src. Replaced and deleted files are renamed
+        into backup_dir, if given. Files larger than max_size are left
+        untouched on both sides, as rclone does. If part of src could not
+        be read the deletions are skipped and OSError is raised
+        '''
+        stats = self.copy(src, dst,
+            backup_dir=backup_dir, exclude=exclude, links=links, max_size=max_size
+        )
+        source = self._files(src, exclude=exclude, max_size=max_size, errors=(errors := []))
+        if errors:
+            # As rclone does, nothing is deleted when the source was not read whole
+            raise OSError(f'Not deleting files from {dst}: {len(errors)} paths of {src} could not be read')
+        for path in self._files(dst, exclude=exclude, max_size=max_size):
+            if path not in source:
+                if backup_dir: self._rename(join(dst, path), join(backup_dir, path))
+                else: os.remove(join(dst, path))
+                stats['renames' if backup_dir else 'deletes'] += 1
+        self._remove_empty_dirs(dst)
+        return stats
+
+    def copy(self, src: str, dst: str,
+        backup_dir: str = None,
+        exclude: list = (),
+        ignore_existing: bool = False,
+        links: bool = False,
+        files_from: list = None,
+        max_size: int = None,
+        **options
+    ):
+        '''
+        Copy the files of src that are missing or different in dst. Copies
+        made with backup_dir or links come from the live source and are
+        transferred, the rest are copies between snapbacks and are linked
+        '''
+        source = self._files(src, files_from, exclude, max_size)
+        is_tier = backup_dir is None and not links
+        stats = new_stats()
+        for path in source:
+            a, b = join(src, path), join(dst, path)
+            if os.path.lexists(b):
+                stats['checks'] += 1
+                if ignore_existing or same_file(a, b):
+                    continue
+                if backup_dir:
+                    self._rename(b, join(backup_dir, path))
+                    stats['renames'] += 1
+            if is_tier: self._link(a, b)
+            else: self._transfer(a, b, links)
+            stats['transfers'] += 1
+            stats['bytes'] += source[path][0]
+        return stats
+
+    def move(self, src: str, dst: str, files_from: list = None, **options) -> dict:
+        stats = new_stats()
+        for path in self._files(src, files_from):
+            self._rename(join(src, path), join(dst, path))
+            stats['renames'] += 1
+        if exists(src): self._remove_empty_dirs(src)
+        return stats
+
+    def accumulate(self, src: str, dst: str, **options) -> dict:
+        '''
+        Rename into dst the files of src it does not have, in a single walk,
+        and then remove src with the files dst already had
+        '''
+        stats = new_stats()
+        for path in self._files(src):
+            stats['checks'] += 1
+            if not os.path.lexists(target := join(dst, path)):
+                self._rename(join(src, path), target)
+                stats['renames'] += 1
+            else:
+                stats['deletes'] += 1
+        self.purge(src)
+        return stats
+
+    def delete(self, path: str, files_from: list = None, **options) -> dict:
+        stats = new_stats()
+        for file in self._files(path, files_from):
+            os.remove(join(path, file))
+            stats['deletes'] += 1
+        if exists(path): self._remove_empty_dirs(path)
+        return stats
+
+    def purge(self, path: str):
+        if exists(path): shutil.rmtree(path)
+
+    def iter_list(self, path: str, hashes: bool = False):
+        '''
+        Yield every file under path as rclone lsjson would
+        '''
+        for rel_path, (size, mtime_ns) in self._files(path).items():
+            entry = {
+                'Path': rel_path,
+                'Size': size,
+                'ModTime': datetime.fromtimestamp(
+                    mtime_ns / 1e9, timezone.utc).isoformat()
+            }
+            if hashes:
+                entry['Hashes'] = {'sha1': file_hash(join(path, rel_path))}
+            yield entry
+
+    def list(self, path: str, hashes: bool = False) -> list:
+        return list(self.iter_list(path, hashes))
+
+    def move_file(self, src: str, dst: str):
+        self._rename(src, dst)
+
+    def copy_file(self, src: str, dst: str):
+        self._transfer(src, dst, links=True)
+
+    def delete_file(self, path: str):
+        os.remove(path)
+
+    def read_file(self, path: str) -> str:
+        try:
+            with open(path, 'r') as f: return f.read()
+        except FileNotFoundError:
+            return None
+
+    def read_bytes(self, path: str) -> bytes:
+        with open(path, 'rb') as f: return f.read()
+
+    def read_range(self, path: str, offset: int, length: int) -> bytes:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def write_file(self, path: str, content: str):
+        os.makedirs(dirname(path) or '.', exist_ok=True)
+        with open(temp := path + '.tmp', 'w') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, path)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def file_hash(path: str) -> str:
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while chunk := f.read(1 << 20): digest.update(chunk)
+    return digest.hexdigest()
+
+
+def same_file(a: str, b: str) -> bool:
+    '''
+    Whether b already holds the contents of a, comparing size and mtime
+    as rclone does
+    '''
+    try:
+        sa, sb = os.lstat(a), os.lstat(b)
+    except FileNotFoundError:
+        return False
+    if (sa.st_ino, sa.st_dev) == (sb.st_ino, sb.st_dev):
+        return True
+    return sa.st_size == sb.st_size and sa.st_mtime_ns == sb.st_mtime_ns
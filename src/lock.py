@@ -0,0 +1,76 @@
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
+
+
+class Locked(Exception):
+    pass
+
+
+class FileLock:
+    '''
+    Exclusive lock on a file, held by one process at a time. The system
+    releases it when the process dies, so a crashed run never leaves it
+    held. The holder writes its pid in the file
+    '''
+
+    def __init__(self, file: str, blocking: bool = True, poll: float = 1):
+        self.file = file
+        self.blocking = blocking
+        self.poll = poll
+        self.f = None
+
+    def _try(self) -> bool:
+        try:
+            if fcntl:
+                fcntl.flock(self.f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                self.f.seek(0)
+                msvcrt.locking(self.f.fileno(), msvcrt.LK_NBLCK, 1)
+            return True
+        except OSError:
+            return False
+
+    def owner(self) -> str:
+        try:
+            with open(self.file, 'r') as f: return f.read().strip() or 'unknown'
+        except OSError:
+            return 'unknown'
+
+    def acquire(self):
+        '''
+        Take the lock, waiting for it if blocking, or raise Locked
+        '''
+        self.f = open(self.file, 'a+')
+        while not self._try():
+            if not self.blocking:
+                self.f.close()
+                self.f = None
+                raise Locked(f'{self.file} is held by process {self.owner()}')
+            time.sleep(self.poll)
+        self.f.seek(0)
+        self.f.truncate()
+        self.f.write(str(os.getpid()))
+        self.f.flush()
+        return self
+
+    def release(self):
+        if self.f is None: return
+        if fcntl:
+            fcntl.flock(self.f, fcntl.LOCK_UN)
+        else:
+            self.f.seek(0)
+            msvcrt.locking(self.f.fileno(), msvcrt.LK_UNLCK, 1)
+        self.f.close()
+        self.f = None
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
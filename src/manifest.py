@@ -0,0 +1,209 @@
+import os
+import re
+import json
+import stat
+import bisect
+import logging as log
+from os.path import join, exists, dirname
+
+
+def glob_to_regex(pattern: str) -> re.Pattern:
+    '''
+    Translate an rclone filter pattern into a regular expression matched
+    against paths relative to the source, with / as separator. Patterns
+    starting with / are anchored to the root, the rest match complete path
+    elements at any depth. * does not cross directories, ** does.
+    '''
+    anchored = pattern.startswith('/')
+    pattern = pattern.lstrip('/')
+    regex, i = '', 0
+    while i < len(pattern):
+        if pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+        elif pattern[i] == '*':
+            regex += '[^/]*'
+            i += 1
+        elif pattern[i] == '?':
+            regex += '[^/]'
+            i += 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    if pattern.endswith('/'):
+        regex += '.*'
+    return re.compile(('^' if anchored else '(^|.*/)') + regex + '$')
+
+
+class ExcludeFilter:
+    '''
+    Matches paths relative to the source against the exclude patterns of
+    a directory
+    '''
+
+    def __init__(self, patterns: list = ()):
+        self.patterns = [glob_to_regex(p) for p in patterns]
+
+    def __call__(self, path: str, is_dir: bool = False) -> bool:
+        '''
+        Whether the path is excluded. A directory is excluded when every
+        file under it would be, which is the case if the pattern matches
+        the directory followed by anything, at any depth
+        '''
+        if is_dir:
+            return any(
+                p.match(path + '/\0') and p.match(path + '/\0/\0')
+                for p in self.patterns
+            )
+        return any(p.match(path) for p in self.patterns)
+
+
+def scan(root: str,
+    exclude: list = (),
+    rel_dir: str = '',
+    errors: list = None,
+    links: set = None
+) -> dict:
+    '''
+    Walk the source directory and return {path: [size, mtime_ns]} for every
+    file and symlink that is not excluded. Paths are relative to the root
+    and use / as separator. rel_dir limits the walk to a subdirectory. The
+    paths that could not be read, directories ending with /, are appended
+    to errors and the paths of the symlinks are added to links
+    '''
+    excluded = ExcludeFilter(exclude)
+    entries = {}
+    errors = [] if errors is None else errors
+    links = set() if links is None else links
+    stack = [rel_dir + '/' if rel_dir else '']
+    while stack:
+        rel_dir = stack.pop()
+        try:
+            with os.scandir(join(root, rel_dir)) as it:
+                for entry in it:
+                    rel_path = rel_dir + entry.name
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if not excluded(rel_path, is_dir=True):
+                                stack.append(rel_path + '/')
+                        elif not excluded(rel_path):
+                            entry_stat = entry.stat(follow_symlinks=False)
+                            entries[rel_path] = [entry_stat.st_size, entry_stat.st_mtime_ns]
+                            if entry.is_symlink(): links.add(rel_path)
+                    except OSError as e:
+                        log.warning(f'Error scanning {join(root, rel_path)}: {e}')
+                        errors.append(rel_path)
+        except OSError:
+            log.exception(f'Error scanning {join(root, rel_dir)}')
+            errors.append(rel_dir)
+    return entries
+
+
+def rescan(root: str,
+    paths: list,
+    entries: dict,
+    exclude: list = (),
+    errors: list = None,
+    links: set = None
+) -> dict:
+    '''
+    Return the entries of a previous scan updated with the current state of
+    the given paths only. Directories among them are walked again and
+    paths that no longer exist are removed along with everything under them.
+    The paths that could not be read are appended to errors, and links, the
+    symlinks of the previous scan, is updated in place
+    '''
+    excluded = ExcludeFilter(exclude)
+    keys = sorted(entries)
+    entries = {path: entry[:2] for path, entry in entries.items()}
+    errors = [] if errors is None else errors
+    links = set() if links is None else links
+
+    def forget(path: str):
+        entries.pop(path, None)
+        links.discard(path)
+        i = bisect.bisect_left(keys, path + '/')
+        while i < len(keys) and keys[i].startswith(path + '/'):
+            entries.pop(keys[i], None)
+            links.discard(keys[i])
+            i += 1
+
+    for path in paths:
+        forget(path)
+        try:
+            path_stat = os.lstat(join(root, path))
+        except FileNotFoundError:
+            continue
+        except OSError as e:
+            log.warning(f'Error scanning {join(root, path)}: {e}')
+            errors.append(path)
+            continue
+        if stat.S_ISDIR(path_stat.st_mode):
+            if not excluded(path, is_dir=True):
+                entries.update(scan(root, exclude, path, errors, links))
+        elif not excluded(path):
+            entries[path] = [path_stat.st_size, path_stat.st_mtime_ns]
+            if stat.S_ISLNK(path_stat.st_mode): links.add(path)
+    return entries
+
+
+class SourceManifest:
+    '''
+    Size and modification time of every file of a source directory as it
+    was at the last successful sync, stored locally as JSON. With checksum
+    change detection each entry also holds the content hash of the file.
+    The entries of symlinks are marked by a fourth item, true
+    '''
+
+    def __init__(self, file: str):
+        self.file = file
+        self.entries = None
+        self.saved_ns = None
+        self.links = set()
+        if exists(file):
+            try:
+                with open(file, 'r') as f: self.entries = json.load(f)
+                self.saved_ns = os.stat(file).st_mtime_ns
+                self.links = {p for p, e in self.entries.items() if len(e) > 3 and e[3]}
+            except (OSError, ValueError):
+                log.exception(f'Error reading the manifest {file}')
+
+    def diff(self, entries: dict, errors: list = ()) -> tuple:
+        '''
+        Return the paths that are new or changed and the paths that were
+        deleted since the manifest was saved. A scan with errors may have
+        missed files, so as rclone does, none are taken as deleted
+        '''
+        old = self.entries or {}
+        changed = [p for p, e in entries.items() if old.get(p, [None])[:2] != e[:2]]
+        deleted = [] if errors else [p for p in old if p not in entries]
+        return changed, deleted
+
+    def hash(self, path: str) -> str:
+        '''
+        Return the content hash recorded for a file, if any
+        '''
+        entry = (self.entries or {}).get(path)
+        return entry[2] if entry and len(entry) > 2 else None
+
+    def save(self, entries: dict, links: set = ()):
+        '''
+        Replace the manifest atomically with the given entries, links being
+        the paths of the symlinks among them, written one by one so a
+        columnar scan is never copied into a dict
+        '''
+        os.makedirs(dirname(self.file) or '.', exist_ok=True)
+        temp_file = self.file + '.tmp'
+        with open(temp_file, 'w') as f:
+            f.write('{')
+            for i, (path, entry) in enumerate(entries.items()):
+                if i: f.write(',')
+                if path in links:
+                    entry = [*entry[:2], entry[2] if len(entry) > 2 else None, True]
+                f.write(json.dumps(path) + ':' + json.dumps(list(entry), separators=(',', ':')))
+            f.write('}')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file, self.file)
+        self.entries = entries
+        self.links = set(links)
@@ -0,0 +1,230 @@
+import os
+import json
+import time
+import threading
+import logging as log
+from contextlib import contextmanager
+from datetime import datetime
+
+
+# Counters of a stage, and the rclone stats (or LocalEngine counters) they
+# are read from: files are the files written by the transfers, scanned the
+# files found walking the source and requests the estimate of the requests
+# billed by an object store, set when the update ends
+COUNTERS = (
+    'calls', 'files', 'bytes', 'checks', 'listed', 'deletes', 'renames', 'errors',
+    'scanned', 'requests'
+)
+STATS = {
+    'transfers': 'files', 'bytes': 'bytes', 'checks': 'checks', 'listed': 'listed',
+    'deletes': 'deletes', 'renames': 'renames', 'errors': 'errors'
+}
+
+# Engine operations whose result is the stats of the operation
+TRANSFERS = ('sync', 'copy', 'move', 'delete', 'accumulate')
+
+# Stage of the engine calls made outside any stage
+OTHER = 'other'
+
+
+def new_record(stage: str) -> dict:
+    return {
+        'stage': stage, 'start': time.time(), 'seconds': 0.0, 'failed': False,
+        **dict.fromkeys(COUNTERS, 0)
+    }
+
+
+class Metrics:
+    '''
+    Wall time and counters of each stage of the update of a directory.
+    Stages run one after another, so the engine calls made while a stage
+    runs are counted in it, whatever thread makes them
+    '''
+
+    def __init__(self, job: str, dir: str):
+        self.job = job
+        self.dir = dir
+        self.stages = []
+        self.current = None
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.seconds = None
+        self.failing_point = None
+
+    @contextmanager
+    def stage(self, name: str):
+        '''
+        Measure a stage of the update. A stage that raises is marked as failed
+        '''
+        record = new_record(name)
+        previous, self.current = self.current, record
+        start = time.perf_counter()
+        try:
+            yield record
+        except Exception:
+            record['failed'] = True
+            raise
+        finally:
+            record['seconds'] = time.perf_counter() - start
+            self.current = previous
+            with self.lock: self.stages.append(record)
+
+    def count(self, calls: int = 0, stats: dict = None, **counters):
+        '''
+        Add an engine call, the rclone stats it returned and other counters
+        to the current stage
+        '''
+        with self.lock:
+            if (record := self.current) is None:
+                record = next((r for r in self.stages if r['stage'] == OTHER), None)
+                if record is None:
+                    self.stages.append(record := new_record(OTHER))
+            record['calls'] += calls
+            for key, counter in STATS.items():
+                record[counter] += (stats or {}).get(key) or 0
+            for counter, value in counters.items():
+                record[counter] += value
+
+    def finish(self, failing_point: str = None):
+        self.seconds = time.time() - self.start
+        self.failing_point = failing_point
+
+    def to_dict(self) -> dict:
+        return {
+            'time': datetime.fromtimestamp(self.start).isoformat(timespec='seconds'),
+            'job': self.job,
+            'dir': self.dir,
+            'seconds': self.seconds,
+            'success': self.failing_point is None,
+            'failing_point': self.failing_point,
+            'stages': self.stages
+        }
+
+
+class MeteredEngine:
+    '''
+    Engine that counts its calls, their failures and the stats of their
+    transfers in the current stage of metrics
+    '''
+
+    def __init__(self, engine, metrics: Metrics):
+        self.engine = engine
+        self.metrics = metrics
+
+    def __getattr__(self, name: str):
+        attr = getattr(self.engine, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def metered(*args, **kwargs):
+            try:
+                result = attr(*args, **kwargs)
+            except Exception:
+                self.metrics.count(calls=1, errors=1)
+                raise
+            if name == 'iter_list':
+                return self._listing(result)
+            if name in TRANSFERS and isinstance(result, dict):
+                self.metrics.count(calls=1, stats=result)
+            elif name == 'list':
+                self.metrics.count(calls=1, listed=len(result))
+            else:
+                self.metrics.count(calls=1)
+            return result
+        return metered
+
+    def _listing(self, entries):
+        '''
+        Count a streamed listing once it is consumed or abandoned
+        '''
+        listed, failed = 0, 0
+        try:
+            for entry in entries:
+                listed += 1
+                yield entry
+        except Exception:
+            failed = 1
+            raise
+        finally:
+            self.metrics.count(calls=1, listed=listed, errors=failed)
+
+
+def write_json_lines(file: str, runs: list):
+    '''
+    Append the metrics of each update to file, one JSON object per line
+    '''
+    with open(file, 'a', encoding='utf-8') as f:
+        for metrics in runs:
+            f.write(json.dumps(metrics.to_dict()) + '\n')
+
+
+def _label(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def write_textfile(file: str, runs: list):
+    '''
+    Write the metrics of the updates of the run in the Prometheus text
+    format, for the textfile collector of node_exporter. The file is
+    replaced atomically so the collector never reads it half written
+    '''
+    samples = {f'stage_{field}': {} for field in ('seconds', 'failed', *COUNTERS)}
+    samples.update(update_seconds={}, update_success={}, update_timestamp_seconds={})
+    for metrics in runs:
+        labels = f'job="{_label(metrics.job)}",dir="{_label(metrics.dir)}"'
+        samples['update_seconds'][labels] = metrics.seconds or 0
+        samples['update_success'][labels] = int(metrics.failing_point is None)
+        samples['update_timestamp_seconds'][labels] = int(metrics.start)
+        for record in metrics.stages:
+            # The same stage may run more than once in an update
+            stage = f'{labels},stage="{_label(record["stage"])}"'
+            for field in ('seconds', 'failed', *COUNTERS):
+                values = samples[f'stage_{field}']
+                values[stage] = values.get(stage, 0) + record[field]
+
+    lines = []
+    for name, values in samples.items():
+        lines.append(f'# TYPE snapback_{name} gauge')
+        lines.extend(f'snapback_{name}{{{labels}}} {value:g}' for labels, value in values.items())
+    temp = file + '.tmp'
+    with open(temp, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(temp, file)
+
+
+def summary(runs: list, limit: int = 15) -> str:
+    '''
+    Return a table of the slowest stages of the run
+    '''
+    rows = sorted(
+        ((f'{m.job}/{m.dir}', record) for m in runs for record in m.stages),
+        key=lambda row: row[1]['seconds'], reverse=True
+    )[:limit]
+    width = max([len('Directory')] + [len(d) for d, _ in rows])
+    lines = [
+        f'{"Directory":<{width}}  {"Stage":<32} {"Seconds":>9} {"Calls":>6} '
+        f'{"Files":>7} {"Bytes":>12} {"Errors":>6}'
+    ]
+    for directory, r in rows:
+        stage = r['stage'] + (' (failed)' if r['failed'] else '')
+        lines.append(
+            f'{directory:<{width}}  {stage[:32]:<32} {r["seconds"]:>9.3f} {r["calls"]:>6} '
+            f'{r["files"]:>7} {r["bytes"]:>12} {r["errors"]:>6}'
+        )
+    total = sum(m.seconds or 0 for m in runs)
+    lines.append(f'{len(runs)} directories updated in {total:.3f} s')
+    return '\n'.join(lines)
+
+
+def export(runs: list, config: dict):
+    '''
+    Write the metrics of the run where the metrics section of the config
+    says. Metrics are never worth failing the backup for
+    '''
+    try:
+        if file := config.get('json_lines', 'snapback.metrics.jsonl'):
+            write_json_lines(file, runs)
+        if file := config.get('textfile'):
+            write_textfile(file, runs)
+    except Exception:
+        log.exception('Error writing the metrics of the run')
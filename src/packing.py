@@ -0,0 +1,223 @@
+import os
+import json
+import time
+import zlib
+import shutil
+import hashlib
+import secrets
+import tempfile
+import logging as log
+from os.path import join
+from datetime import datetime
+from chunking import RECIPE_SUFFIX
+
+
+PACKS_DIR = '.packs'
+PACK_SUFFIX = '.pack'
+INDEX_SUFFIX = '.index.json'
+
+# Symlinks stored by rclone on remotes that have none
+LINK_SUFFIX = '.rclonelink'
+
+
+def is_packed(path: str) -> bool:
+    '''
+    Whether a path listed in a snapback belongs to its packs
+    '''
+    return path.startswith(PACKS_DIR + '/')
+
+
+def pack_time(name: str) -> int:
+    '''
+    Return the time in nanoseconds at which a pack or its index was written
+    '''
+    return int(name.partition('-')[0])
+
+
+class PackStore:
+    '''
+    Groups the small files of the snapbacks of cold tiers into packs, so a
+    snapback of tens of thousands of files is moved and accumulated as a
+    few objects. A pack, .packs/<name>.pack in the snapback, is the
+    concatenation of its files compressed one by one, and its index,
+    .packs/<name>.index.json, maps each path to the offset and length of
+    its data, so a single file is restored with one range read.
+
+    Recipes of chunked files are never packed, as the chunk store reads
+    them to know which chunks are still referenced.
+    '''
+
+    def __init__(self,
+        engine,
+        backup_dir: str,
+        max_size: int = 1 << 20,
+        pack_size: int = 64 << 20
+    ):
+        self.engine = engine
+        self.backup_dir = backup_dir
+        self.max_size = max_size
+        self.pack_size = pack_size
+
+    def _dir(self, slot: str) -> str:
+        return join(self.backup_dir, slot, PACKS_DIR)
+
+    def indexes(self, slot: str, listing: list = None) -> dict:
+        '''
+        Return {index name: index} of the packs of a snapback, reading the
+        index names from its listing if given
+        '''
+        if listing is None:
+            names = [e['Path'] for e in self.engine.iter_list(self._dir(slot))]
+        else:
+            names = [e['Path'][len(PACKS_DIR)+1:] for e in listing if is_packed(e['Path'])]
+        indexes = {}
+        for name in names:
+            if not name.endswith(INDEX_SUFFIX): continue
+            if (content := self.engine.read_file(join(self._dir(slot), name))) is None:
+                raise FileNotFoundError(f'Can not read the pack index {name} of {slot}')
+            indexes[name] = json.loads(content)
+        return indexes
+
+    def files(self, slot: str, listing: list = None) -> dict:
+        '''
+        Return {path: entry} of the packed files of a snapback, each entry
+        holding the path of its pack, its offset, length, size, mtime and
+        sha1
+        '''
+        files = {}
+        # Pack names start with the time they were written, so a path held
+        # by several packs gets the entry of the newest
+        indexes = self.indexes(slot, listing)
+        for _, index in sorted(indexes.items(), key=lambda item: pack_time(item[0])):
+            pack = join(self._dir(slot), index['pack'])
+            for path, entry in index['files'].items():
+                files[path] = {**entry, 'pack': pack}
+        return files
+
+    def read(self, entry: dict) -> bytes:
+        '''
+        Return the contents of a packed file, read with a range read
+        '''
+        return zlib.decompress(
+            self.engine.read_range(entry['pack'], entry['offset'], entry['length'])
+        )
+
+    def _write_pack(self, staging: str, slot: str, entries: list):
+        '''
+        Write the staged files of entries as a pack and upload it, the pack
+        before its index so an index never points to a missing pack
+        '''
+        name = f'{time.time_ns()}-{secrets.token_hex(4)}'
+        files, offset = {}, 0
+        with open(pack := join(staging, name + PACK_SUFFIX), 'wb') as f:
+            for e in entries:
+                with open(join(staging, e['Path']), 'rb') as g: data = g.read()
+                compressed = zlib.compress(data)
+                f.write(compressed)
+                files[e['Path']] = {
+                    'offset': offset, 'length': len(compressed), 'size': len(data),
+                    'mtime': e['ModTime'], 'sha1': hashlib.sha1(data).hexdigest()
+                }
+                offset += len(compressed)
+        self.engine.copy_file(pack, join(self._dir(slot), name + PACK_SUFFIX))
+        self.engine.write_file(join(self._dir(slot), name + INDEX_SUFFIX),
+            json.dumps({'pack': name + PACK_SUFFIX, 'files': files}, separators=(',', ':')))
+
+    def _drop(self, slot: str, paths: set, indexes: dict):
+        '''
+        Remove the given paths from the pack indexes of a snapback,
+        deleting the packs left without files
+        '''
+        for name, index in indexes.items():
+            if not (dropped := [path for path in index['files'] if path in paths]):
+                continue
+            for path in dropped: del index['files'][path]
+            if index['files']:
+                self.engine.write_file(join(self._dir(slot), name),
+                    json.dumps(index, separators=(',', ':')))
+            else:
+                self.engine.delete_file(join(self._dir(slot), name))
+                self.engine.delete_file(join(self._dir(slot), index['pack']))
+
+    def pack(self, slot: str) -> int:
+        '''
+        Pack the loose files of a snapback up to max_size, in packs of
+        about pack_size bytes, and delete them once their packs are
+        uploaded. Returns the number of files packed.
+
+        Loose files are newer than the packed versions of their paths, which
+        a move into the snapback replaced, so those are dropped from the
+        packs first and every path is held by a single entry
+        '''
+        root = join(self.backup_dir, slot)
+        loose, listing = [], []
+        for e in self.engine.iter_list(root):
+            (listing if is_packed(e['Path']) else loose).append(e)
+        if listing:
+            self._drop(slot, {e['Path'] for e in loose}, self.indexes(slot, listing))
+        small = [
+            e for e in loose
+            if e['Size'] <= self.max_size
+            and not e['Path'].endswith((RECIPE_SUFFIX, LINK_SUFFIX))
+        ]
+        if len(small) < 2:
+            return 0
+
+        staging = tempfile.mkdtemp(prefix='snapback-packs-')
+        try:
+            self.engine.copy(root, staging,
+                files_from=[e['Path'] for e in small], no_traverse=True)
+            # Symlinks stay loose, so they are restored as symlinks
+            small = [
+                e for e in small
+                if not os.path.islink(staged := join(staging, e['Path'])) and os.path.isfile(staged)
+            ]
+            group, size = [], 0
+            for e in small:
+                group.append(e)
+                size += e['Size']
+                if size >= self.pack_size:
+                    self._write_pack(staging, slot, group)
+                    group, size = [], 0
+            if group:
+                self._write_pack(staging, slot, group)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+        self.engine.delete(root, files_from=[e['Path'] for e in small], no_traverse=True)
+        log.info(f'Packed {len(small)} files of {slot}')
+        return len(small)
+
+    def merge(self, a: str, b: str):
+        '''
+        Prepare the accumulation of snapback a into snapback b, whose files
+        win: the loose files of a that b holds packed are deleted, and the
+        packs of a are moved into b without the files b already holds.
+        Every step can be repeated, so a stopped accumulation is resumed
+        '''
+        held, listing = set(), []
+        for e in self.engine.iter_list(join(self.backup_dir, b)):
+            if is_packed(e['Path']): listing.append(e)
+            else: held.add(e['Path'])
+        packed = self.files(b, listing)
+        held.update(packed)
+
+        if packed:
+            self.engine.delete(join(self.backup_dir, a),
+                files_from=list(packed), no_traverse=True)
+
+        if not (indexes := self.indexes(a)):
+            return
+        self._drop(a, held, indexes)
+        self.engine.move(self._dir(a), self._dir(b))
+
+    def restore(self, entry: dict, target: str):
+        '''
+        Write a packed file to the local target with its modification time
+        '''
+        os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+        with open(partial := target + '.snapback-partial', 'wb') as f:
+            f.write(self.read(entry))
+        mtime = datetime.fromisoformat(entry['mtime']).timestamp()
+        os.utime(partial, (mtime, mtime))
+        os.replace(partial, target)
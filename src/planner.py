@@ -0,0 +1,198 @@
+import logging as log
+from rotation import TIERS
+
+
+# Engine operations made by each kind of operation on file based storage
+# (an accumulation is a move and a purge). Content stored snapbacks only
+# change the index
+COSTS = {'mkdir': 1, 'copy': 1, 'accumulate': 2, 'move': 1, 'rotate': 2, 'state': 0}
+
+# Tier rolled by each state key, in the order the tiers are updated
+ROLLS = {'day': 'daily', 'week': 'weekly', 'month': 'monthly', 'year': 'yearly'}
+
+
+class Operation:
+    '''
+    A step of the update of a directory: a tier operation from snapback a to
+    snapback b, the rotation of a tier, the creation of a snapback directory
+    or the assignment of a state value
+    '''
+
+    def __init__(self, kind: str, a: str = None, b: str = None, value=None):
+        self.kind = kind
+        self.a = a
+        self.b = b
+        self.value = value
+        self.deps = []
+        # Whether b was known to be empty and a to hold files before the operation
+        self.into_empty = False
+        self.from_full = False
+
+    def tiers(self) -> set:
+        '''
+        Return the snapbacks the operation reads or writes
+        '''
+        if self.kind == 'rotate':
+            return {f'{self.a}.{i}' for i in range(1, TIERS[self.a]+1)}
+        if self.kind == 'state':
+            return set()
+        return {t for t in (self.a, self.b) if t}
+
+    def __eq__(self, other):
+        return (self.kind, self.a, self.b, self.value) == \
+               (other.kind, other.a, other.b, other.value)
+
+    def __repr__(self):
+        if self.kind == 'state':
+            return f'state {self.a} = {self.value}'
+        return ' '.join([self.kind, self.a] + (['->', self.b] if self.b else []))
+
+
+def schedule(hourly_dir: str, rolls: dict, rotation: str = 'move') -> list:
+    '''
+    Return the operations of an update before any optimization. rolls maps
+    each state key (day, week, ...) to its new value for the tiers that roll
+    in this update
+    '''
+    ops = []
+    if hourly_dir:
+        ops.append(Operation('copy', '.temp', hourly_dir))
+    previous, previous_key = '.temp', None
+    for key, tier in ROLLS.items():
+        if key in rolls:
+            if rotation == 'manifest':
+                ops.append(Operation('rotate', tier))
+            else:
+                ops.extend(
+                    Operation('move', f'{tier}.{i}', f'{tier}.{i+1}')
+                    for i in range(TIERS[tier]-1, 0, -1)
+                )
+            ops.append(Operation('state', key, value=rolls[key]))
+        # .temp is accumulated every time, the other tiers when the previous one rolled
+        if previous_key is None or previous_key in rolls:
+            ops.append(Operation('accumulate', previous, f'{tier}.1'))
+        previous, previous_key = f'{tier}.1', key
+    return ops
+
+
+def optimize(ops: list, empty: set = (), full: set = (), storage: str = 'files') -> list:
+    '''
+    Remove the operations whose source snapback is known to be empty, turn
+    accumulations into an empty snapback into moves and fuse a move into an
+    empty snapback with the move or accumulation that drains it next. Then
+    add the mkdir operations file based storage needs
+    '''
+    empty, full = set(empty), set(full)
+    planned = []
+
+    def becomes(tier: str, source: str):
+        '''
+        Update what is known of tier after it received the files of source
+        '''
+        empty.discard(tier)
+        if source in full: full.add(tier)
+
+    def feeder(op: Operation) -> int:
+        '''
+        Return the index of the planned move that only put its files into the
+        empty source of op, if nothing else touched them since
+        '''
+        for i in range(len(planned)-1, -1, -1):
+            if op.a in planned[i].tiers():
+                first = planned[i]
+                if first.kind == 'move' and first.b == op.a and first.into_empty and \
+                        not any(first.a in later.tiers() for later in planned[i+1:]):
+                    return i
+                return None
+        return None
+
+    for op in ops:
+        if op.kind in ('copy', 'accumulate', 'move'):
+            if op.a in empty:
+                continue
+            if op.kind == 'accumulate' and op.b in empty:
+                op = Operation('move', op.a, op.b)
+            op.into_empty, op.from_full = op.b in empty, op.a in full
+            becomes(op.b, op.a)
+            if op.kind != 'copy':
+                empty.add(op.a)
+                full.discard(op.a)
+                if (i := feeder(op)) is not None:
+                    first = planned.pop(i)
+                    fused = Operation(op.kind, first.a, op.b)
+                    fused.into_empty, fused.from_full = op.into_empty, first.from_full
+                    op = fused
+        elif op.kind == 'rotate':
+            n = TIERS[op.a]
+            for i in range(n, 1, -1):
+                for known in (empty, full):
+                    if f'{op.a}.{i-1}' in known: known.add(f'{op.a}.{i}')
+                    else: known.discard(f'{op.a}.{i}')
+            empty.add(f'{op.a}.1')
+            full.discard(f'{op.a}.1')
+        planned.append(op)
+
+    if storage == 'content':
+        return planned
+
+    # Sources that are not known to hold files may not exist yet
+    existing, with_mkdir = {'.temp'}, []
+    for op in planned:
+        if op.kind in ('copy', 'accumulate', 'move') and op.a not in existing \
+                and not op.from_full:
+            with_mkdir.append(Operation('mkdir', op.a))
+            existing.add(op.a)
+        if op.kind == 'rotate':
+            existing -= op.tiers()
+        if op.kind == 'accumulate':
+            existing.discard(op.a)
+        if op.b: existing.add(op.b)
+        with_mkdir.append(op)
+    return with_mkdir
+
+
+def link(ops: list) -> list:
+    '''
+    Fill the dependencies of each operation with the previous operations
+    touching the same snapbacks, which makes the plan a DAG
+    '''
+    for i, op in enumerate(ops):
+        tiers = op.tiers()
+        if op.kind == 'state':
+            # A state value is set once its tier has rolled
+            tier = ROLLS[op.a]
+            tiers = {f'{tier}.{j}' for j in range(1, TIERS[tier]+1)}
+        op.deps = [j for j in range(i) if ops[j].tiers() & tiers]
+    return ops
+
+
+def cost(ops: list, storage: str = 'files') -> int:
+    '''
+    Estimate the number of engine operations of a plan
+    '''
+    if storage == 'content':
+        return sum(1 for op in ops if op.kind == 'rotate')
+    return sum(COSTS[op.kind] for op in ops)
+
+
+def plan(hourly_dir: str, rolls: dict,
+    rotation: str = 'move',
+    storage: str = 'files',
+    empty: set = (),
+    full: set = ()
+) -> list:
+    '''
+    Return the optimized operations of an update, with their dependencies
+    '''
+    ops = optimize(schedule(hourly_dir, rolls, rotation), empty, full, storage)
+    log.debug(f'Plan: {ops}')
+    return link(ops)
+
+
+def describe(ops: list, unplanned: int, storage: str = 'files') -> str:
+    lines = [f'{len(ops)} operations, ~{cost(ops, storage)} engine calls '
+             f'({unplanned} without planning)']
+    for i, op in enumerate(ops, 1):
+        after = f'  (after {", ".join(str(j+1) for j in op.deps)})' if op.deps else ''
+        lines.append(f'  {i:>2}. {op}{after}')
+    return '\n'.join(lines)
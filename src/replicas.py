@@ -0,0 +1,104 @@
+import re
+import threading
+import logging as log
+from manifest import rescan
+from scanner import scan_tree, WORKERS
+from watcher import ChangeJournal
+
+
+# How the replicas of a job with several destinations are written
+REPLICATIONS = ('primary', 'parallel')
+
+
+def destinations(job_data: dict) -> list:
+    '''
+    Return the destinations of a job, which may be one path or a list
+    '''
+    destination = job_data['destination']
+    return list(destination) if isinstance(destination, (list, tuple)) else [destination]
+
+
+def replica_name(job_name: str, destination: str, index: int) -> str:
+    '''
+    Name under which the state, manifests, checkpoints and catalog of a
+    replica are kept. The first destination keeps the name of the job, so
+    turning a destination into a list does not start it over
+    '''
+    if index == 0:
+        return job_name
+    return f'{job_name}@' + re.sub(r'[^\w.-]+', '_', destination).strip('_')
+
+
+def replicas(job_name: str, job_data: dict) -> list:
+    '''
+    Return the (name, destination) of every replica of a job
+    '''
+    return [
+        (replica_name(job_name, destination, i), destination)
+        for i, destination in enumerate(destinations(job_data))
+    ]
+
+
+class SourceScan:
+    '''
+    Scan of a source directory made once per run and shared by the updates
+    of all its replicas. The first update that needs it makes it, from the
+    change journal of the watcher when the journal covers every change
+    since that update's manifest was saved, or walking the source with
+    workers threads otherwise
+    '''
+
+    def __init__(self,
+        path: str,
+        exclude: list = (),
+        journal_file: str = None,
+        workers: int = WORKERS
+    ):
+        self.path = path
+        self.exclude = exclude
+        self.workers = workers
+        self.journal = ChangeJournal(journal_file) if journal_file else None
+        self.lock = threading.Lock()
+        self.entries = None
+        self.offset = None
+        # Paths the scan could not read, so it is incomplete if any
+        self.errors = []
+        # Paths of the symlinks of the source
+        self.links = set()
+
+    def get(self, manifest=None, record: dict = None) -> dict:
+        '''
+        Return {path: [size, mtime_ns]} of the source, scanning it on the
+        first call. manifest is the SourceManifest of the calling update,
+        record the metrics stage in which the files walked, and the paths
+        that could not be read, are counted
+        '''
+        with self.lock:
+            if self.entries is not None:
+                return self.entries
+            paths = None
+            if self.journal and manifest is not None and manifest.entries is not None:
+                paths, self.offset = self.journal.read(since_ns=manifest.saved_ns)
+            if paths is None:
+                self.entries = scan_tree(self.path, self.exclude, self.workers)
+                self.errors = self.entries.errors
+                self.links = self.entries.links
+                if record is not None:
+                    record['scanned'] += len(self.entries)
+            else:
+                log.debug(f'{len(paths)} paths changed according to the journal')
+                self.links = set(manifest.links)
+                self.entries = rescan(self.path, paths, manifest.entries, self.exclude,
+                    self.errors, self.links)
+            if record is not None:
+                record['errors'] += len(self.errors)
+            return self.entries
+
+    def commit(self):
+        '''
+        Drop the journaled paths read by the scan, once they were synced
+        '''
+        with self.lock:
+            if self.offset is not None:
+                self.journal.commit(self.offset)
+                self.offset = None
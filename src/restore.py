@@ -1,28 +1,297 @@
+import os
+import json
 import yaml
 import argparse
 import logging as log
-from snapback import SnapBack
+from os.path import join, basename
+from datetime import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+from snapback import HOURS, get_hourly_dir
+from engine import create_engine, engine_for
+from replicas import destinations
+from rotation import TIERS, SlotManifest
+from content_store import ContentStore
+from chunking import CHUNKS_DIR, RECIPE_SUFFIX, rebuild
+from manifest import ExcludeFilter
+from hash_cache import HashCache
+from packing import PackStore, is_packed
+
+
+def snapback_order(hour: int) -> list:
+    '''
+    Return the snapbacks from the most recent to the oldest. The hourly ones
+    taken so far today come first, then those still holding yesterday's
+    changes, then the rotating tiers
+    '''
+    hourly = sorted((int(h) % 24, get_hourly_dir(h)) for h in HOURS)
+    today = [name for h, name in reversed(hourly) if h <= hour]
+    yesterday = [name for h, name in reversed(hourly) if h > hour]
+    return today + yesterday + [
+        f'{tier}.{i}' for tier, n in TIERS.items() for i in range(1, n+1)
+    ]
+
+
+def unchanged(path: str, size: int, mtime: float) -> bool:
+    '''
+    Whether the local file already has the given size and modification time
+    (seconds), with the one second tolerance of rclone
+    '''
+    try:
+        path_stat = os.lstat(path)
+    except FileNotFoundError:
+        return False
+    return path_stat.st_size == size and abs(path_stat.st_mtime - mtime) < 1
+
+
+class SnapBackRestore:
+    '''
+    Rebuilds a backed up directory as it was at a given snapback. The main
+    directory holds the latest version of every file and each snapback the
+    versions replaced during its period, so the view at a snapback is the
+    main directory overlaid with every snapback from the most recent down to
+    the requested one, the older versions winning. Files created after the
+    snapback are kept, as nothing records their absence.
+
+    Only the winning version of each file is fetched, straight from the
+    destination into the target, and files the target already holds are
+    skipped.
+    '''
+
+    def __init__(self,
+        dest_path: str,
+        dir_name: str,
+        engine=None,
+        rotation: str = 'move',
+        storage: str = 'files',
+        local_engine: str = 'hardlink',
+        transfers: int = 4
+    ):
+        self.dest_path = join(dest_path, dir_name)
+        self.backup_dir = join(dest_path, '.snapbacks', dir_name)
+        self.engine = engine_for(dest_path, engine, local_engine)
+        self.rotation = rotation
+        self.storage = storage
+        self.transfers = transfers
+        self._manifest = None
+        self._store = None
+
+    @property
+    def manifest(self) -> SlotManifest:
+        if self._manifest is None:
+            self._manifest = SlotManifest.load(self.engine, self.backup_dir)
+        return self._manifest
+
+    @property
+    def store(self) -> ContentStore:
+        if self._store is None:
+            self._store = ContentStore(self.engine, self.backup_dir)
+        return self._store
+
+    def _slot(self, name: str) -> str:
+        if self.rotation == 'manifest':
+            return self.manifest.resolve(name)
+        return name
+
+    def _listing(self, root: str, hash_type: str = None) -> dict:
+        '''
+        Return {path: (root, source path, size, mtime, hash)} for the files
+        under root, with their hash of hash_type if given and known. The
+        files of packed snapbacks have no root, their source is their entry
+        in the index of their pack. A loose file wins over a packed version
+        of its path, as packing drops the versions it supersedes
+        '''
+        files, packed = {}, []
+        for e in self.engine.iter_list(root, hashes=hash_type is not None):
+            if is_packed(e['Path']):
+                packed.append(e)
+                continue
+            files[e['Path']] = (root, e['Path'], e['Size'], e['ModTime'],
+                hash_type and (e.get('Hashes') or {}).get(hash_type))
+        if packed:
+            packs = PackStore(self.engine, self.backup_dir)
+            for path, e in packs.files(basename(root), packed).items():
+                files.setdefault(path, (None, e, e['size'], e['mtime'],
+                    e['sha1'] if hash_type == 'sha1' else None))
+        return files
+
+    def _layer(self, name: str, hash_type: str = None) -> dict:
+        '''
+        Return {path: (layer root, source path, size, mtime, hash)} for the
+        files of a snapback. Content stored snapbacks have no root, their
+        files are fetched one by one from the blobs
+        '''
+        if self.storage == 'content':
+            layer = {}
+            for path, e in self.store.tier(self._slot(name)).items():
+                blob_type, _, blob_hash = e['blob'].partition('-')
+                layer[path] = (None, self.store.blob_path(e['blob']), e['size'], e['mtime'],
+                    blob_hash if blob_type == hash_type else None)
+            return layer
+        return self._listing(join(self.backup_dir, self._slot(name)), hash_type)
+
+    def view(self, snapback: str, hour: int = None, hash_type: str = None) -> dict:
+        '''
+        Return the files of the directory at the snapback, mapping each path
+        to the layer that holds its version there, and the hash of hash_type
+        of the version when asked and known
+        '''
+        order = snapback_order(dt.now().hour if hour is None else hour)
+        if snapback not in order:
+            raise ValueError(f'Unknown snapback {snapback}')
+        view = self._listing(self.dest_path, hash_type)
+        for name in order[:order.index(snapback)+1]:
+            for path, source in self._layer(name, hash_type).items():
+                # A version and the recipe of a chunked version replace each other
+                view.pop(path.removesuffix(RECIPE_SUFFIX), None)
+                view.pop(path + RECIPE_SUFFIX, None)
+                view[path] = source
+        return view
+
+    def _rebuild(self, recipe_path: str, target: str):
+        '''
+        Write a chunked file to the target from its chunks, in order
+        '''
+        recipe = json.loads(self.engine.read_file(recipe_path))
+        if unchanged(target, recipe['size'], recipe['mtime'] / 1e9):
+            return
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(partial := target + '.snapback-partial', 'wb') as out:
+            rebuild(self.engine, join(self.backup_dir, CHUNKS_DIR),
+                recipe, out, self.transfers)
+        os.utime(partial, ns=(recipe['mtime'], recipe['mtime']))
+        os.replace(partial, target)
+
+    def _unpack(self, entry: dict, target: str):
+        if not unchanged(target, entry['size'], dt.fromisoformat(entry['mtime']).timestamp()):
+            PackStore(self.engine, self.backup_dir).restore(entry, target)
+
+    def _copy_blob(self, blob_path: str, size: int, mtime: str, target: str):
+        if not unchanged(target, size, dt.fromisoformat(mtime).timestamp()):
+            self.engine.copy_file(blob_path, target)
+
+    def restore(self, snapback: str, target: str, include: list = None,
+                hour: int = None) -> list:
+        '''
+        Restore the directory at the snapback into the local target
+        directory, only the paths matching the include patterns if given.
+        Returns the paths that could not be restored
+        '''
+        matches = ExcludeFilter(include) if include else None
+        layers, single = {}, []
+        for path, (root, source, size, mtime, _) in self.view(snapback, hour).items():
+            name = path.removesuffix(RECIPE_SUFFIX)
+            if matches and not matches(name):
+                continue
+            if path.endswith(RECIPE_SUFFIX):
+                single.append((name, self._rebuild, join(root or '', source)))
+            elif isinstance(source, dict):
+                single.append((name, self._unpack, source))
+            elif root is None:
+                single.append((name, self._copy_blob, source, size, mtime))
+            else:
+                layers.setdefault(root, []).append(path)
+
+        failed = []
+        for root, paths in layers.items():
+            try:
+                self.engine.copy(root, target,
+                    files_from=paths, no_traverse=True, links=True,
+                    transfers=self.transfers
+                )
+            except Exception:
+                log.exception(f'Error restoring files from {root}')
+                failed.extend(paths)
+
+        def restore_one(name, method, *args):
+            try:
+                method(*args, join(target, name))
+            except Exception:
+                log.exception(f'Error restoring {name}')
+                failed.append(name)
+
+        with ThreadPoolExecutor(max_workers=self.transfers) as pool:
+            list(pool.map(lambda item: restore_one(*item), single))
+
+        log.info(f'Restored {snapback} into {target}, {len(failed)} errors')
+        return failed
+
+    def verify(self, snapback: str, target: str, hash_cache: HashCache,
+               include: list = None, hour: int = None) -> list:
+        '''
+        Compare the content of the restored files with the hash that the
+        destination reports for their version at the snapback, only reading
+        the files that changed since the hash cache last saw them. Returns
+        the paths that are missing or differ. Versions without a hash of
+        the type of the cache (chunked files, remotes without it) are not
+        checked
+        '''
+        matches = ExcludeFilter(include) if include else None
+        expected = {
+            path: digest
+            for path, (*_, digest) in self.view(snapback, hour, hash_cache.algorithm).items()
+            if digest and not path.endswith(RECIPE_SUFFIX)
+            and not (matches and not matches(path))
+        }
+        hashes = hash_cache.hash_files({path: join(target, path) for path in expected})
+        differ = [
+            path for path, digest in expected.items()
+            if hashes.get(path, '').lower() != digest.replace('_', '/').lower()
+        ]
+        log.info(f'Verified {len(expected)} files of {snapback} in {target}, '
+                 f'{len(differ)} differ')
+        return differ
 
 
 def command_parser(config: dict) -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="snapBack restore")
-    parser.add_argument('remote', 
+    parser.add_argument('job',
         type=str,
-        choices=config['remotes'].keys(), 
-        help='Remote alias'
+        choices=config['jobs'].keys(),
+        help='Job of the directory'
     )
     parser.add_argument('directory',
         type=str,
-        choices=config['directories'].keys(),
         help='Directory to restore'
     )
-    parser.add_argument('snapback', 
-        type=str, 
-        choices=['hourly.12', 'hourly.16', 'hourly.20', 'hourly.24', 
-                 'daily.1', 'daily.2', 'daily.3', 'weekly.1', 'weekly.2', 
-                 'monthly.1', 'monthly.2', 'monthly.3', 'yearly.1', 'yearly.2'],
+    parser.add_argument('snapback',
+        type=str,
+        choices=snapback_order(0),
         help='Snapback to restore'
     )
+    parser.add_argument('--target',
+        type=str,
+        default=None,
+        help='Local directory to restore into (default: the source directory)'
+    )
+    parser.add_argument('--include',
+        type=str,
+        nargs='+',
+        default=None,
+        help='Only restore the paths matching these rclone style patterns'
+    )
+    parser.add_argument('--transfers',
+        type=int,
+        default=4,
+        help='Number of files transferred in parallel (default: 4)'
+    )
+    parser.add_argument('--engine',
+        type=str,
+        choices=['subprocess', 'daemon'],
+        default=config.get('engine', 'subprocess'),
+        help='How rclone is run (default: subprocess)'
+    )
+    parser.add_argument('--verify',
+        action='store_true',
+        help='Compare the hash of every restored file with the one of its '
+             'version on the destination'
+    )
+    parser.add_argument(
+        '--destination',
+        type=str,
+        default=None,
+        help='Destination to restore from, when the job has several '
+             '(default: the first one)'
+    )
     parser.add_argument(
         '--log-level',
         type=str,
@@ -30,7 +299,7 @@ def command_parser(config: dict) -> argparse.Namespace:
         default='ERROR',
         help='Set the logging level (default: ERROR)'
     )
-    
+
     return parser.parse_args()
 
 
@@ -42,7 +311,7 @@ def main():
 
     # Create the argument parser
     args = command_parser(config)
-    
+
     # Set the logging configuration
     log.basicConfig(
         level=getattr(log, args.log_level),
@@ -51,12 +320,35 @@ def main():
         format='%(asctime)s Restore: [%(levelname)s] %(message)s'
     )
 
-    SnapBack(
-        config['directories'][args.directory], 
-        config['remotes'][args.remote],
-        args.directory
-    ).restore()
-    
+    job_data = config['jobs'][args.job]
+    if (source := job_data['directories'].get(args.directory)) is None:
+        raise SystemExit(f'Unknown directory {args.directory} in job {args.job}')
+    target = args.target or (source['path'] if type(source) == dict else source)
+    if (destination := args.destination or destinations(job_data)[0]) not in destinations(job_data):
+        raise SystemExit(f'Unknown destination {destination} of job {args.job}')
+
+    with create_engine(args.engine) as engine:
+        restore = SnapBackRestore(
+            destination,
+            args.directory,
+            engine=engine,
+            rotation=job_data.get('rotation', 'move'),
+            storage=job_data.get('storage', 'files'),
+            local_engine=job_data.get('local_engine', 'hardlink'),
+            transfers=args.transfers
+        )
+        failed = restore.restore(args.snapback, target, args.include)
+        if args.verify:
+            with HashCache('last_snapback.hashes.db', job_data.get('hash_type', 'sha1'),
+                           workers=args.transfers) as hash_cache:
+                for path in (differ := restore.verify(args.snapback, target, hash_cache, args.include)):
+                    print(f'Differs: {path}')
+
+    if failed:
+        raise SystemExit(f'{len(failed)} files could not be restored, see snapback.log')
+    if args.verify and differ:
+        raise SystemExit(f'{len(differ)} restored files differ from their version')
+
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,109 @@
+import yaml
+import logging as log
+from os.path import join
+
+
+# Number of snapbacks kept for each rotating tier
+TIERS = {'daily': 3, 'weekly': 2, 'monthly': 3, 'yearly': 2}
+
+MANIFEST_FILE = 'manifest.yaml'
+
+
+def split_name(name: str) -> tuple:
+    '''
+    Split a logical snapback name such as "daily.2/" into ("daily", 2).
+    Names that are not part of a rotating tier return (name, None)
+    '''
+    name = name.rstrip('/')
+    tier, _, index = name.partition('.')
+    if tier in TIERS and index.isdigit():
+        return tier, int(index)
+    return name, None
+
+
+class SlotManifest:
+    '''
+    Maps the logical snapbacks of each rotating tier (daily.1, daily.2, ...)
+    to the physical slot directories that hold them. Each tier is a ring of
+    slots, so a rotation only reorders the ring and clears the oldest slot
+    instead of moving the data of every snapback.
+
+    The slots are the directories of the move based layout, so a remote can
+    switch to manifest rotation without migrating any data. After the first
+    rotation the directory names no longer tell the age of their contents,
+    the manifest does. It also counts the rotations of each tier, its
+    generation, so a rotation repeated by a resumed run is not applied twice.
+    '''
+
+    def __init__(self,
+        engine,
+        backup_dir: str,
+        slots: dict = None,
+        generations: dict = None
+    ):
+        self.engine = engine
+        self.file = join(backup_dir, MANIFEST_FILE)
+        self.slots = {
+            tier: [f'{tier}.{i}' for i in range(1, n+1)]
+            for tier, n in TIERS.items()
+        }
+        if slots: self.slots.update(slots)
+        self.generations = {tier: 0 for tier in TIERS}
+        if generations: self.generations.update(generations)
+
+    @classmethod
+    def load(cls, engine, backup_dir: str):
+        '''
+        Read the manifest from the remote or start a new one if it does not
+        exist. Errors reading it are raised, as rotating from the default
+        slots could clear the one of a newer snapback. Manifests written
+        before the generations were kept start them at 0
+        '''
+        content = engine.read_file(join(backup_dir, MANIFEST_FILE))
+        slots = (yaml.safe_load(content) if content is not None else None) or {}
+        generations = slots.pop('generations', None)
+        return cls(engine, backup_dir, slots, generations)
+
+    def save(self):
+        self.engine.write_file(self.file, yaml.dump({**self.slots, 'generations': self.generations}))
+
+    def resolve(self, name: str) -> str:
+        '''
+        Return the physical directory of a logical snapback name
+        '''
+        tier, index = split_name(name)
+        if index is None or index > len(self.slots[tier]):
+            return name.rstrip('/')
+        return self.slots[tier][index-1]
+
+    def tiers(self) -> dict:
+        '''
+        Return every logical snapback name with its physical directory
+        '''
+        return {
+            f'{tier}.{i}': slot
+            for tier, slots in self.slots.items()
+            for i, slot in enumerate(slots, 1)
+        }
+
+    def rotate(self, tier: str, clear, generation: int = None) -> bool:
+        '''
+        Shift every snapback of the tier one position and reuse the slot of
+        the oldest one as the new first snapback. clear is called with the
+        physical directory of that slot before the manifest is saved, so a
+        crash in between only repeats the clearing on the next run.
+        generation is the one the rotation brings the tier to: when the
+        tier already reached it, the rotation was saved by a run that died
+        before recording it, and nothing is done. Returns whether the tier
+        was rotated
+        '''
+        if generation is not None and self.generations[tier] >= generation:
+            log.info(f'{tier} was already rotated to generation {generation}')
+            return False
+        slots = self.slots[tier]
+        clear(slots[-1])
+        self.slots[tier] = slots[-1:] + slots[:-1]
+        self.generations[tier] += 1
+        self.save()
+        log.debug(f'Rotated {tier}: {self.slots[tier]}')
+        return True
@@ -0,0 +1,161 @@
+import os
+import time
+import queue
+import threading
+import logging as log
+from array import array
+from os.path import join
+from collections.abc import Mapping
+from manifest import ExcludeFilter
+
+
+# Threads walking a tree. The walk waits on the file system, which
+# releases the GIL, so more threads than cores pay off on network storage
+WORKERS = 8
+
+
+class ScanResult(Mapping):
+    '''
+    Files found by a scan, stored by columns: the id of the directory of
+    each file, its name in a single buffer, its size and its mtime in
+    arrays, instead of a string, a list and two integers per file. It reads
+    as a mapping of {path: [size, mtime_ns]}, paths being relative to the
+    root with / as separator. Lookups by path build an index on first use.
+    '''
+
+    def __init__(self):
+        self.dirs = ['']
+        self.dir_ids = array('l')
+        self.names = bytearray()
+        self.ends = array('q')
+        self.sizes = array('q')
+        self.mtimes = array('q')
+        self._index = None
+        # Paths of the symlinks among the files
+        self.links = set()
+        # Paths that could not be read, directories ending with /. The files
+        # under them, or the files themselves, are missing from the result
+        self.errors = []
+        # Throughput of the walk that made it
+        self.stats = {'files': 0, 'dirs': 0, 'errors': 0, 'seconds': 0.0}
+
+    def add(self, dir_id: int, name: str, size: int, mtime_ns: int):
+        self.dir_ids.append(dir_id)
+        self.names += name.encode('utf-8', 'surrogateescape')
+        self.ends.append(len(self.names))
+        self.sizes.append(size)
+        self.mtimes.append(mtime_ns)
+
+    def extend(self, other: 'ScanResult'):
+        '''
+        Append the files of another result that shares the same dirs
+        '''
+        offset = len(self.names)
+        self.dir_ids.extend(other.dir_ids)
+        self.names += other.names
+        self.ends.extend(end + offset for end in other.ends)
+        self.sizes.extend(other.sizes)
+        self.mtimes.extend(other.mtimes)
+        self.links |= other.links
+        self.errors.extend(other.errors)
+        self._index = None
+
+    def path(self, i: int) -> str:
+        start = self.ends[i-1] if i else 0
+        return self.dirs[self.dir_ids[i]] + \
+            self.names[start:self.ends[i]].decode('utf-8', 'surrogateescape')
+
+    def __len__(self) -> int:
+        return len(self.sizes)
+
+    def __iter__(self):
+        return (self.path(i) for i in range(len(self.sizes)))
+
+    def items(self):
+        return (
+            (self.path(i), [self.sizes[i], self.mtimes[i]])
+            for i in range(len(self.sizes))
+        )
+
+    def __getitem__(self, path: str) -> list:
+        if self._index is None:
+            self._index = {path: i for i, path in enumerate(self)}
+        i = self._index[path]
+        return [self.sizes[i], self.mtimes[i]]
+
+    @property
+    def rate(self) -> float:
+        '''
+        Entries (files and directories) walked per second
+        '''
+        seconds = self.stats['seconds'] or 1e-9
+        return (self.stats['files'] + self.stats['dirs']) / seconds
+
+
+def scan_tree(root: str, exclude: list = (), workers: int = WORKERS) -> ScanResult:
+    '''
+    Walk the source directory with a pool of threads sharing a queue of
+    directories, and return the files and symlinks that are not excluded.
+    Excluded directories are never entered. The paths that could not be
+    read are kept in the errors of the result, as the scan is incomplete
+    '''
+    excluded = ExcludeFilter(exclude)
+    result = ScanResult()
+    parts = [ScanResult() for _ in range(max(1, workers))]
+    lock = threading.Lock()
+    pending = queue.Queue()
+    pending.put(0)
+    start = time.perf_counter()
+
+    def read_dir(part: ScanResult, dir_id: int):
+        rel_dir = result.dirs[dir_id]
+        try:
+            with os.scandir(join(root, rel_dir)) as it:
+                for entry in it:
+                    rel_path = rel_dir + entry.name
+                    # An entry that can not be read, or vanishes, does not
+                    # end the walk of the rest of its directory
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if excluded(rel_path, is_dir=True): continue
+                            with lock:
+                                result.dirs.append(rel_path + '/')
+                                child = len(result.dirs) - 1
+                            pending.put(child)
+                        elif not excluded(rel_path):
+                            entry_stat = entry.stat(follow_symlinks=False)
+                            part.add(dir_id, entry.name, entry_stat.st_size, entry_stat.st_mtime_ns)
+                            if entry.is_symlink(): part.links.add(rel_path)
+                    except OSError as e:
+                        log.warning(f'Error scanning {join(root, rel_path)}: {e}')
+                        part.errors.append(rel_path)
+        except OSError:
+            log.exception(f'Error scanning {join(root, rel_dir)}')
+            part.errors.append(rel_dir)
+
+    def walk(part: ScanResult):
+        while (dir_id := pending.get()) is not None:
+            try:
+                read_dir(part, dir_id)
+            finally:
+                pending.task_done()
+
+    threads = [threading.Thread(target=walk, args=(part,), daemon=True) for part in parts]
+    for thread in threads: thread.start()
+    pending.join()
+    for _ in threads: pending.put(None)
+    for thread in threads: thread.join()
+
+    for part in parts:
+        result.extend(part)
+    result.stats = {
+        'files': len(result),
+        'dirs': len(result.dirs),
+        'errors': len(result.errors),
+        'seconds': time.perf_counter() - start
+    }
+    log.info(f'Scanned {root}: {len(result)} files in {len(result.dirs)} directories '
+             f'in {result.stats["seconds"]:.1f}s ({result.rate:.0f} entries/s)')
+    if result.errors:
+        log.warning(f'{len(result.errors)} paths of {root} could not be scanned')
+    return result
@@ -1,14 +1,42 @@
+import os
+import copy
+import json
 import yaml
-import subprocess
+import threading
 import logging as log
-from os.path import join
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join, splitext
 from datetime import datetime as dt
-from rclone_python import rclone
+from engine import engine_for, get_remote
+from rotation import TIERS, SlotManifest
+from manifest import SourceManifest
+from content_store import ContentStore
+from chunking import ChunkStore, RECIPE_SUFFIX, CHUNKS_DIR
+from catalog import Catalog, MAIN, mtime_us, from_listing, blob_hash
+from planner import Operation, ROLLS, plan, schedule, cost, describe
+from metrics import Metrics, MeteredEngine
+from checkpoint import Checkpoint
+from hash_cache import HashCache
+from packing import PackStore
+from replicas import SourceScan, replicas
+from scanner import WORKERS
+from tuning import Tuner
+from costs import CostLedger, DEFERRABLE
+from listing_cache import ListingCache
 
 
 with open('config.yaml', 'r') as f:
     HOURS = yaml.safe_load(f)['daily_backup_hours']
 
+# Runs that may resume a stopped run before it is given up
+RESUME_ATTEMPTS = 3
+
+# Memory rclone holds per object listed with --fast-list, and the default
+# budget above which syncs list one directory at a time instead
+FAST_LIST_BYTES = 1024
+LIST_MEMORY = 1 << 30
+
 
 def get_hourly_dir(hour: str) -> str:
     if hour == '00': 
@@ -20,10 +48,19 @@ def get_hourly_dir(hour: str) -> str:
 
 
 class LastSnapBackData:
+    '''
+    State of the last snapback of every job and directory, stored in a YAML
+    file. Assignments made inside a transaction are staged in the view that
+    made them and written together in a single atomic commit.
+    '''
 
     def __init__(self, file: str = 'last_snapback.yaml'):
+        self.file = file
         self.job_name = None
         self.dir_name = None
+        self.lock = threading.RLock()
+        self.staged = None
+        self.data = {}
         try:
             with open(file, 'r') as f:
                 self.data = yaml.safe_load(f)
@@ -33,23 +70,130 @@ class LastSnapBackData:
         except yaml.YAMLError:
             log.exception('Error parsing the configuration file config.yaml')
 
+    def fork(self):
+        '''
+        Return a view sharing the same data, file and lock but with its own
+        job and directory selection, so that concurrent workers do not
+        change each other's selection
+        '''
+        view = copy.copy(self)
+        view.staged = None
+        return view
+
+    def _write(self):
+        '''
+        Replace the file atomically so a crash never leaves it half written
+        '''
+        with self.lock:
+            temp_file = self.file + '.tmp'
+            with open(temp_file, 'w') as f:
+                yaml.dump(self.data, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_file, self.file)
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Stage every assignment made inside the block and commit them all
+        with a single write when it ends, even if it ends with an error
+        '''
+        self.staged = {}
+        try:
+            yield self
+        finally:
+            staged, self.staged = self.staged, None
+            self.commit(staged)
+
+    def commit(self, staged: dict):
+        if not staged: return
+        with self.lock:
+            for (job_name, dir_name, key), value in staged.items():
+                self.data[job_name][dir_name][key] = value
+            self._write()
+
+    def manifest_file(self, dir_name: str) -> str:
+        '''
+        Path of the local source manifest of a directory of the selected job,
+        stored next to the data file
+        '''
+        return join(
+            splitext(self.file)[0] + '.manifests', self.job_name, dir_name + '.json'
+        )
+
+    def chunks_file(self, dir_name: str) -> str:
+        '''
+        Path of the local cache of the chunked files and uploaded chunks of a
+        directory of the selected job, stored next to the data file
+        '''
+        return join(
+            splitext(self.file)[0] + '.chunks', self.job_name, dir_name + '.json'
+        )
+
+    def catalog_file(self) -> str:
+        '''
+        Path of the version catalog of every job, next to the data file
+        '''
+        return splitext(self.file)[0] + '.catalog.db'
+
+    def hash_cache_file(self) -> str:
+        '''
+        Path of the cache of the content hashes of the local files, shared
+        by every job, next to the data file
+        '''
+        return splitext(self.file)[0] + '.hashes.db'
+
+    def checkpoint_file(self, dir_name: str) -> str:
+        '''
+        Path of the checkpoint of the unfinished run of a directory of the
+        selected job, stored next to the data file
+        '''
+        return join(
+            splitext(self.file)[0] + '.checkpoints', self.job_name, dir_name + '.yaml'
+        )
+
+    def costs_file(self) -> str:
+        '''
+        Path of the history of the requests of every update, next to the
+        data file
+        '''
+        return splitext(self.file)[0] + '.costs.jsonl'
+
+    def tuning_file(self) -> str:
+        '''
+        Path of the transfer settings tuned for each remote, next to the
+        data file
+        '''
+        return splitext(self.file)[0] + '.tuning.json'
+
+    def journal_file(self, dir_name: str) -> str:
+        '''
+        Path of the change journal written by the watcher for a directory of
+        the selected job, stored next to the data file
+        '''
+        return join(
+            splitext(self.file)[0] + '.journals', self.job_name, dir_name + '.journal'
+        )
+
     def reset_dir(self, dir_name: str):
         if self.job_name is None: 
             log.error('No job selected')
             return
 
-        self.data[self.job_name][dir_name] = {
-            'day': 0, 'month': 'None', 'week': 0, 'year': 0,
-            'failing_point': None, 'success': False
-        }
-        with open('last_snapback.yaml', 'w') as f: yaml.dump(self.data, f)
+        with self.lock:
+            self.data[self.job_name][dir_name] = {
+                'day': 0, 'month': 'None', 'week': 0, 'year': 0,
+                'failing_point': None, 'success': False
+            }
+            self._write()
         return self
 
     def select_job(self, job_name: str):
 
         # Create a new job if it doesn't exist
-        if job_name not in self.data.keys(): 
-            self.data[job_name] = {}
+        with self.lock:
+            if job_name not in self.data.keys(): 
+                self.data[job_name] = {}
 
         self.job_name = job_name
         return self
@@ -62,8 +206,9 @@ class LastSnapBackData:
             return
         
         # Create a new directory if it doesn't exist
-        if dir_name not in self.data[self.job_name].keys(): 
-            self.reset_dir(dir_name)
+        with self.lock:
+            if dir_name not in self.data[self.job_name].keys(): 
+                self.reset_dir(dir_name)
 
         self.dir_name = dir_name
         return self
@@ -71,13 +216,20 @@ class LastSnapBackData:
     def __setitem__(self, key, value):
         if self.job_name is None or self.dir_name is None:
             log.error('No job or directory selected')
-        self.data[self.job_name][self.dir_name][key] = value
-        with open('last_snapback.yaml', 'w') as f: yaml.dump(self.data, f)
+        if self.staged is not None:
+            self.staged[(self.job_name, self.dir_name, key)] = value
+            return
+        with self.lock:
+            self.data[self.job_name][self.dir_name][key] = value
+            self._write()
    
     def __getitem__(self, key):
         if self.job_name is None or self.dir_name is None:
             log.error('No job or directory selected')
-        return self.data[self.job_name][self.dir_name][key]
+        if self.staged and (staged_key := (self.job_name, self.dir_name, key)) in self.staged:
+            return self.staged[staged_key]
+        with self.lock:
+            return self.data[self.job_name][self.dir_name][key]
 
 
 class SnapBackJob:
@@ -85,33 +237,146 @@ class SnapBackJob:
     def __init__(self, 
         job_name: str, 
         job_data: dict, 
-        last_snapback_data: LastSnapBackData
+        last_snapback_data: LastSnapBackData,
+        engine=None,
+        clock=dt.now,
+        tuner: Tuner = None,
+        ledger: CostLedger = None
     ):
         self.job_data = job_data
+        self.engine = engine
+        self.clock = clock
+        self.tuner = tuner
+        self.ledger = ledger
+        self.metrics = []
         last_snapback_data.select_job(job_name)
         self.last_snapback_data = last_snapback_data
 
-    def perform(self, hour: str):
-        for dir_name, source in self.job_data['directories'].items():
+    def _updates(self):
+        '''
+        Yield the updates of every directory of the job, one per replica
+        with the first destination first. With primary replication the
+        other replicas are synced from the first one, server side when
+        they are on the same remote, so the source is only read once. With
+        parallel replication they are all written from the source, sharing
+        a single scan of it
+        '''
+        names = replicas(self.last_snapback_data.job_name, self.job_data)
+        primary = names[0][1]
+        replication = self.job_data.get('replication', 'primary')
+        chunk_threshold = self.job_data.get('chunk_threshold')
 
-            self.last_snapback_data.select_dir(dir_name)
+        for dir_name, source in self.job_data['directories'].items():
 
             if type(source) == dict:
                 sour_path = source['path']
-                exclude = source['exclude']
+                exclude = source.get('exclude', [])
             else:
                 sour_path = source
                 exclude = []
 
-            SnapBackUpdate(
-                sour_path=sour_path,
-                dest_path=self.job_data['destination'],
-                dir_name=dir_name,
-                last_snapback_data=self.last_snapback_data,
-                exclude=exclude
-            ).perform_update(hour)
+            # The journal of the watcher belongs to the source, so it is
+            # kept under the name of the job
+            scan = SourceScan(sour_path, exclude,
+                self.last_snapback_data.journal_file(dir_name),
+                self.job_data.get('scan_workers', WORKERS))
 
-        log.info(f'Completed successfully')
+            updates = []
+            for i, (name, destination) in enumerate(names):
+                options = {
+                    'sour_path': sour_path,
+                    'exclude': exclude,
+                    'change_detection': self.job_data.get('change_detection', 'sync'),
+                    'local_engine': self.job_data.get('local_engine', 'hardlink'),
+                    'chunk_threshold': chunk_threshold
+                }
+                if i > 0 and replication == 'primary':
+                    options.update(
+                        sour_path=join(primary, dir_name),
+                        exclude=[],
+                        change_detection='sync',
+                        chunk_threshold=None,
+                        chunks_from=None if chunk_threshold is None
+                            else join(primary, '.snapbacks', dir_name, CHUNKS_DIR)
+                    )
+                    # A local engine can not read from a remote
+                    if get_remote(primary) is not None:
+                        options['local_engine'] = 'rclone'
+
+                updates.append(SnapBackUpdate(
+                    dest_path=destination,
+                    dir_name=dir_name,
+                    last_snapback_data=self.last_snapback_data.fork().select_job(name),
+                    engine=self.engine,
+                    rotation=self.job_data.get('rotation', 'move'),
+                    storage=self.job_data.get('storage', 'files'),
+                    chunk_size=self.job_data.get('chunk_size', 4 << 20),
+                    hash_type=self.job_data.get('hash_type', 'sha1'),
+                    list_memory=self.job_data.get('list_memory', LIST_MEMORY),
+                    pack=self.job_data.get('pack'),
+                    clock=self.clock,
+                    tuner=self.tuner,
+                    ledger=self.ledger,
+                    scan=scan,
+                    **options
+                ))
+            yield updates
+
+    def _submit(self, executor, update, hour: str, then: list = ()):
+        '''
+        Submit the update under the cap of its remote, and the updates in
+        then once it is done
+        '''
+        def task():
+            try:
+                update.perform_update(hour)
+            finally:
+                for replica in then:
+                    self._submit(executor, replica, hour)
+        return executor.submit(get_remote(update.destination) or 'local', task)
+
+    def perform(self, hour: str, executor=None):
+        '''
+        Perform the update of every directory of the job. If an executor
+        is given, the updates are submitted to it to run concurrently and
+        the list of futures is returned. The replicas synced from the first
+        destination are submitted once it is updated
+        '''
+        parallel = self.job_data.get('replication', 'primary') == 'parallel'
+        futures = []
+        for updates in self._updates():
+            self.metrics.extend(update.metrics for update in updates)
+            if executor is not None:
+                if parallel:
+                    futures.extend(self._submit(executor, update, hour) for update in updates)
+                else:
+                    futures.append(self._submit(executor, updates[0], hour, updates[1:]))
+            elif parallel and len(updates) > 1:
+                with ThreadPoolExecutor(len(updates)) as pool:
+                    for future in [pool.submit(u.perform_update, hour) for u in updates]:
+                        future.result()
+            else:
+                for update in updates:
+                    update.perform_update(hour)
+
+        if executor is None:
+            log.info(f'Completed successfully')
+        return futures
+
+    def plan(self, hour: str) -> dict:
+        '''
+        Return the description of the plan of every directory of the job,
+        without running anything. The sync has not run, so whether it will
+        leave anything in .temp is unknown. The directories of the replicas
+        other than the first one are followed by the name of the replica
+        '''
+        plans = {}
+        for updates in self._updates():
+            for i, update in enumerate(updates):
+                key = update.dir_name if i == 0 else \
+                    f'{update.dir_name} ({update.last_snapback_data.job_name})'
+                plans[key] = update.describe_plan(hour)
+        return plans
 
 
 class SnapBackUpdate:
@@ -121,111 +386,859 @@ class SnapBackUpdate:
         dest_path: str,
         dir_name: str,
         last_snapback_data: LastSnapBackData,
-        exclude: list = []
+        exclude: list = [],
+        engine=None,
+        rotation: str = 'move',
+        change_detection: str = 'sync',
+        local_engine: str = 'hardlink',
+        storage: str = 'files',
+        chunk_threshold: int = None,
+        chunk_size: int = 4 << 20,
+        hash_type: str = 'sha1',
+        pack: dict = None,
+        list_memory: int = LIST_MEMORY,
+        clock=dt.now,
+        tuner: Tuner = None,
+        ledger: CostLedger = None,
+        scan: SourceScan = None,
+        chunks_from: str = None
     ):
         self.sour_path = sour_path
+        self.dir_name = dir_name
+        self.destination = dest_path
         self.dest_path = join(dest_path, dir_name)
         self.backup_dir = join(dest_path, '.snapbacks', dir_name)
         self.exclude = exclude
         last_snapback_data.select_dir(dir_name)
         self.last_snapback_data = last_snapback_data
+        self.metrics = Metrics(last_snapback_data.job_name, dir_name)
+        # Listings made by the update are kept for its later stages, so
+        # only the calls that reach the engine are metered
+        dest_engine = engine_for(dest_path, engine, local_engine)
+        self.engine = ListingCache(MeteredEngine(dest_engine, self.metrics))
+        # An engine created for the update alone is closed when it ends
+        self._own_engine = dest_engine if dest_engine is not engine else None
+        self.rotation = rotation
+        self.change_detection = change_detection
+        self.storage = storage
+        self.chunk_threshold = chunk_threshold
+        self.chunk_size = chunk_size
+        self.hash_type = hash_type
+        self.list_memory = list_memory
+        # Packing starts at the first tier chosen and goes on in every
+        # later one, so packed files never go back to a loose tier
+        self.pack = pack or {}
+        self.pack_tiers = set()
+        if self.pack.get('tiers'):
+            if storage == 'content':
+                log.warning('Content stored snapbacks are not packed')
+            else:
+                order = list(TIERS)
+                self.pack_tiers = set(order[min(order.index(t) for t in self.pack['tiers']):])
+        # Returns the current datetime, which decides the tiers that roll
+        self.clock = clock
+        # Tunes the transfers against the remote of the destination
+        self.tuner = tuner
+        self.remote = get_remote(dest_path) or 'local'
+        self._tuning = {}
+        # Accounts the requests of the update against the budget of the run
+        self.ledger = ledger
+        self._manifest = None
+        self._store = None
+        self._chunks = None
+        self._packs = None
+        self._catalog = None
+        self._hash_cache = None
+        self._entries = None
+        self._temp = None
+        # Catalog operation recording the changes of the sync to the main directory
+        self._main_update = None
+        self.checkpoint = Checkpoint(last_snapback_data.checkpoint_file(dir_name))
+        # Shared with the other replicas of the directory, if any
+        self.scan = scan or SourceScan(
+            sour_path, exclude, last_snapback_data.journal_file(dir_name)
+        )
+        # Chunks directory of the replica this one is synced from
+        self.chunks_from = chunks_from
+        self.failing_point = None
+        self.failures = 0
+
+    @property
+    def manifest(self) -> SlotManifest:
+        if self._manifest is None:
+            self._manifest = SlotManifest.load(self.engine, self.backup_dir)
+        return self._manifest
+
+    @property
+    def store(self) -> ContentStore:
+        if self._store is None:
+            self._store = ContentStore(self.engine, self.backup_dir)
+        return self._store
+
+    @property
+    def chunks(self) -> ChunkStore:
+        if self._chunks is None:
+            self._chunks = ChunkStore(self.engine, self.dest_path, self.backup_dir,
+                self.last_snapback_data.chunks_file(self.dir_name),
+                self.chunk_threshold, self.chunk_size
+            )
+        return self._chunks
+
+    @property
+    def packs(self) -> PackStore:
+        if self._packs is None:
+            self._packs = PackStore(self.engine, self.backup_dir,
+                self.pack.get('max_size', 1 << 20), self.pack.get('pack_size', 64 << 20)
+            )
+        return self._packs
+
+    @property
+    def catalog(self) -> Catalog:
+        if self._catalog is None:
+            self._catalog = Catalog(self.last_snapback_data.catalog_file())
+        return self._catalog
+
+    @property
+    def hash_cache(self) -> HashCache:
+        if self._hash_cache is None:
+            self._hash_cache = HashCache(
+                self.last_snapback_data.hash_cache_file(), self.hash_type
+            )
+        return self._hash_cache
+
+    def _record(self, operation: str, *args):
+        '''
+        Mirror an operation in the version catalog. The catalog is only an
+        index of the destination, so its errors do not fail the update
+        '''
+        try:
+            getattr(self.catalog, operation)(
+                self.last_snapback_data.job_name, self.dir_name, *args
+            )
+        except Exception:
+            log.exception('Error updating the catalog, rebuild it with catalog.py')
+            self._catalog_incomplete()
+
+    def _catalog_incomplete(self):
+        try:
+            self.catalog.set_complete(self.last_snapback_data.job_name, self.dir_name, False)
+        except Exception:
+            log.exception('Error updating the catalog')
+
+    def _start_catalog(self):
+        '''
+        The catalog of a directory backed up for the first time is complete,
+        as it has no snapbacks yet
+        '''
+        try:
+            if next(self.engine.iter_list(self.backup_dir), None) is None:
+                self.catalog.set_complete(self.last_snapback_data.job_name, self.dir_name)
+        except Exception:
+            log.exception('Error starting the catalog')
+
+    def _source_entries(self, manifest: SourceManifest = None) -> dict:
+        '''
+        Return the scan of the source made by this run, scanning it if needed
+        '''
+        if self._entries is None:
+            with self.metrics.stage('scan') as record:
+                self._entries = self.scan.get(manifest, record)
+        return self._entries
+
+    def _fast_list(self) -> bool:
+        '''
+        Whether the sync lists with --fast-list, which makes far fewer
+        calls but holds the whole listing in memory. It is used while the
+        objects listed by the last sync, or the files of the source scan
+        before a first sync, fit in list_memory
+        '''
+        if self.list_memory is None:
+            return True
+        try:
+            objects = self.last_snapback_data['objects']
+        except KeyError:
+            objects = None
+        if objects is None and self._entries is not None:
+            objects = len(self._entries)
+        return objects is None or objects * FAST_LIST_BYTES <= self.list_memory
+
+    def _full_sync(self, temp_dir: str):
+        '''
+        Sync the source with the destination, recording the objects listed
+        to choose how the next sync lists
+        '''
+        fast_list = self._fast_list()
+        if not fast_list:
+            log.info(f'Listing {self.dest_path} without --fast-list to bound its memory')
+        stats = self.engine.sync(self.sour_path, self.dest_path,
+            fast_list=fast_list, links=True,
+            backup_dir=temp_dir, **self._sync_filters(), **self._tuned('sync')
+        )
+        if isinstance(stats, dict) and stats.get('listed') is not None:
+            self.last_snapback_data['objects'] = stats['listed']
+
+    @property
+    def _workload(self) -> str:
+        '''
+        Name under which the transfers of this directory are tuned
+        '''
+        return f'{self.last_snapback_data.job_name}/{self.dir_name}'
+
+    def _tuned(self, kind: str) -> dict:
+        '''
+        Return the transfer settings tuned for a stage kind of this
+        directory against the remote of the destination, logging them the
+        first time
+        '''
+        if self.tuner is None:
+            return {}
+        if kind not in self._tuning:
+            self._tuning[kind] = settings = self.tuner.settings(self.remote, kind, self._workload)
+            log.info(f'{self.remote} {kind} runs with ' +
+                     ', '.join(f'{k} {v}' for k, v in settings.items()))
+        return self._tuning[kind]
+
+    def _sync_filters(self) -> dict:
+        '''
+        Options that keep the chunked files and their recipes out of the
+        transfers of the sync, which are left to the chunk store
+        '''
+        if self.chunk_threshold is None:
+            return {'exclude': self.exclude}
+        return {
+            'exclude': [*self.exclude, '*' + RECIPE_SUFFIX],
+            'max_size': self.chunk_threshold
+        }
+
+    def _slot(self, name: str) -> str:
+        '''
+        Return the physical name of a snapback, resolving its logical name
+        through the slot manifest when manifest rotation is used
+        '''
+        if self.rotation == 'manifest':
+            return self.manifest.resolve(name)
+        return name.rstrip('/')
+
+    def _path(self, name: str) -> str:
+        '''
+        Return the path of a snapback directory
+        '''
+        return join(self.backup_dir, self._slot(name))
+
+    @contextmanager
+    def _stage(self, name: str, error: str):
+        '''
+        Run a stage of the pipeline, measuring it, logging its errors and
+        remembering the first stage that failed
+        '''
+        try:
+            with self.metrics.stage(name):
+                yield
+        except Exception:
+            log.exception(error)
+            self.failures += 1
+            if self.failing_point is None:
+                self.failing_point = name
+            # The destination may be left halfway through the stage
+            self._catalog_incomplete()
 
     def _ensure_dir_exists(self, dir: str):
         '''
         Ensure that the directory exists, if not create it
         '''
-        result = subprocess.run(['rclone', 'mkdir', dir])
-        if result.returncode:
-            log.error(f'Error creating directory {dir}')
+        with self._stage(f'mkdir {dir}', f'Error creating directory {dir}'):
+            self.engine.mkdir(dir)
 
-    def _sync(self):
+    def _sync(self) -> bool:
         '''
-        Sync the source directory with the destination directory
+        Sync the source directory with the destination directory. Returns
+        False when it is known that nothing changed
         '''
         self._ensure_dir_exists(temp_dir := join(self.backup_dir, '.temp'))
 
-        args = ['--fast-list', '--links', f'--backup-dir {temp_dir}']
-        args.extend([f'--exclude {x}' for x in self.exclude])
-        
-        try: rclone.sync(self.sour_path, self.dest_path, args=args)
-        except: log.exception(f'Error syncing {self.sour_path} to destination')
+        if self.change_detection in ('manifest', 'checksum'):
+            changed = self._sync_changes(temp_dir)
+        else:
+            changed = True
+            with self._stage('sync', f'Error syncing {self.sour_path} to destination'):
+                self._full_sync(temp_dir)
+
+        if self.chunk_threshold is not None:
+            with self._stage('chunk', f'Error uploading the chunks of {self.sour_path}'):
+                changed = self.chunks.update(
+                    self.sour_path, self._source_entries(), temp_dir,
+                    complete=not self.scan.errors
+                ) or changed
+        if self.chunks_from is not None:
+            # Copied, not synced: older snapbacks of this replica may still
+            # reference chunks that the one it is synced from collected
+            with self._stage('replicate chunks', f'Error copying the chunks of {self.chunks_from}'):
+                self.engine.copy(self.chunks_from, join(self.backup_dir, CHUNKS_DIR))
+        return changed
+
+    def _sync_changes(self, temp_dir: str) -> bool:
+        '''
+        Transfer only the files that changed since the last run according
+        to the local manifest of the source, without listing the destination.
+        Replaced and deleted files are moved to temp_dir as a sync would do.
+        Without a manifest a full sync is made to start one.
+
+        If the watcher kept a complete journal of the changes since the
+        manifest was saved, only the journaled paths are checked instead of
+        walking the whole source. The scan is shared with the other
+        replicas of the directory.
+
+        With checksum change detection, the files whose size or modification
+        time changed are hashed, through the hash cache, and only those whose
+        content changed are transferred.
+
+        If part of the source could not be scanned, as rclone does nothing
+        is deleted, and the manifest is not saved so the next run checks the
+        same files again
+        '''
+        manifest = SourceManifest(
+            self.last_snapback_data.manifest_file(self.dir_name)
+        )
+        entries = self._source_entries(manifest)
+
+        with self._stage('sync', f'Error syncing {self.sour_path} to destination'):
+            if manifest.entries is None:
+                self._full_sync(temp_dir)
+                if self.change_detection == 'checksum':
+                    entries, _ = self._hash_contents(manifest, entries, [
+                        p for p, e in entries.items()
+                        if self.chunk_threshold is None or e[0] <= self.chunk_threshold
+                    ])
+                if not self.scan.errors:
+                    manifest.save(entries, self.scan.links)
+                self._main_update = ('set_tier', MAIN, self._main_entries(entries, entries))
+                return True
+
+            changed, deleted = manifest.diff(entries, self.scan.errors)
+            chunked, removed = [], deleted
+            if self.chunk_threshold is not None:
+                # Chunked files are left to the chunk store
+                chunked = [p for p in changed if entries[p][0] > self.chunk_threshold]
+                changed = [p for p in changed if entries[p][0] <= self.chunk_threshold]
+                deleted = [
+                    p for p in deleted
+                    if manifest.entries[p][0] <= self.chunk_threshold
+                ]
+            touched = []
+            if self.change_detection == 'checksum':
+                entries, differ = self._hash_contents(manifest, entries, changed)
+                touched = [p for p in changed if p not in differ]
+                changed = differ
+            if changed:
+                self.engine.copy(self.sour_path, self.dest_path,
+                    links=True, backup_dir=temp_dir, no_traverse=True,
+                    files_from=self._stored_names(changed, self.scan.links), **self._tuned('sync')
+                )
+            if deleted:
+                self.engine.move(self.dest_path, temp_dir,
+                    links=True, no_traverse=True,
+                    files_from=self._stored_names(deleted, manifest.links), **self._tuned('sync')
+                )
+            self._main_update = ('update_tier', MAIN,
+                self._main_entries(entries, [*changed, *chunked]), removed)
+            if self.scan.errors:
+                log.warning(f'{len(self.scan.errors)} paths of {self.sour_path} could not be '
+                            'scanned, no file was deleted and the manifest was not saved')
+            else:
+                if changed or deleted or touched:
+                    manifest.save(entries, self.scan.links)
+                self.scan.commit()
+            if not changed and not deleted:
+                log.info(f'No changes in {self.sour_path}')
+                return False
+        return True
+
+    def _main_entries(self, entries: dict, paths) -> dict:
+        '''
+        Return the catalog versions of the given paths of the source scan
+        '''
+        return {path: (entries[path][0], mtime_us(entries[path][1]), None) for path in paths}
+
+    def _stored_names(self, paths: list, links: set) -> list:
+        '''
+        Return the names under which the engine stores paths of the source,
+        as rclone keeps each symlink in a <name>.rclonelink file
+        '''
+        if not (suffix := getattr(self.engine, 'link_suffix', '')) or not links:
+            return paths
+        return [p + suffix if p in links else p for p in paths]
+
+    def _hash_contents(self, manifest: SourceManifest, entries: dict, paths: list) -> tuple:
+        '''
+        Hash the given paths of the source and return the entries to save
+        in the manifest, with the hash of each file, and the paths whose
+        content is not the one recorded in the manifest
+        '''
+        paths = set(paths)
+        hashes = self.hash_cache.hash_files(
+            {path: join(self.sour_path, path) for path in paths}
+        )
+        hashed = {
+            path: [*entry[:2], hashes.get(path) if path in paths else manifest.hash(path)]
+            for path, entry in entries.items()
+        }
+        differ = [
+            path for path in paths
+            if path not in hashes or hashes[path] != manifest.hash(path)
+        ]
+        return hashed, differ
+
+    def _temp_entries(self) -> dict:
+        '''
+        Return the versions the sync moved to .temp, listing them once
+        '''
+        if self._temp is not None:
+            return self._temp
+        if self.storage == 'content':
+            self._temp = {
+                path: (e['size'], mtime_us(e['mtime']), blob_hash(e['blob']))
+                for path, e in self.store.tier('.temp').items()
+            }
+        else:
+            self._temp = from_listing(
+                self.engine.iter_list(join(self.backup_dir, '.temp'), hashes=True)
+            )
+        return self._temp
+
+    def _record_sync(self):
+        '''
+        Record in the catalog the versions that the sync moved to .temp and
+        its changes to the main directory, known from the manifest diff or,
+        with sync change detection, from .temp
+        '''
+        with self.metrics.stage('catalog'):
+            try:
+                temp = self._temp_entries()
+            except Exception:
+                return log.exception('Error listing the changes for the catalog')
+            if self._main_update is not None:
+                self._record(*self._main_update)
+            elif self.change_detection == 'sync':
+                self._record('update_tier', MAIN, *self._synced_main(temp))
+            self._record('set_tier', '.temp', temp)
+
+    def _synced_main(self, temp: dict) -> tuple:
+        '''
+        Return the versions in the main directory of the paths a full sync
+        moved to .temp, which it changed or deleted, and the paths of them
+        that it deleted. The versions are read from a local source, the
+        paths of a remote one are only dropped. Files the sync added replace
+        nothing, so they are only known to the catalog after a rebuild
+        '''
+        entries, deleted = {}, []
+        local = get_remote(self.sour_path) is None
+        for path in temp:
+            try:
+                path_stat = os.lstat(join(self.sour_path, path)) if local else None
+            except OSError:
+                path_stat = None
+            if path_stat is None:
+                deleted.append(path)
+            else:
+                entries[path] = (path_stat.st_size, mtime_us(path_stat.st_mtime_ns), None)
+        return entries, deleted
+
+    def _ingest(self) -> bool:
+        '''
+        Store the files replaced by the sync as blobs of the content store.
+        Returns whether they were, as the tiers can not be planned from an
+        index that could not be read
+        '''
+        failures = self.failures
+        with self._stage('ingest', 'Error storing .temp in the content store'):
+            self.store.ingest(join(self.backup_dir, '.temp'))
+        return self.failures == failures
+
+    def _collect_chunks(self):
+        '''
+        Delete the chunks that no recipe references any more, reading the
+        recipes of the main directory and of every snapback
+        '''
+        with self._stage('collect chunks', 'Error collecting unreferenced chunks'):
+            recipes = [
+                join(self.dest_path, path + RECIPE_SUFFIX) for path in self.chunks.files
+            ]
+            if self.storage == 'content':
+                recipes.extend(
+                    self.store.blob_path(entry['blob'])
+                    for tier in self.store.index.values()
+                    for path, entry in tier.items() if path.endswith(RECIPE_SUFFIX)
+                )
+            else:
+                recipes.extend(
+                    join(self.backup_dir, entry['Path'])
+                    for entry in self.engine.iter_list(self.backup_dir)
+                    if entry['Path'].endswith(RECIPE_SUFFIX)
+                )
+            contents = []
+            for path in recipes:
+                # A missing recipe would get its chunks deleted
+                if (content := self.engine.read_file(path)) is None:
+                    raise FileNotFoundError(f'Can not read the recipe {path}')
+                contents.append(json.loads(content))
+            self.chunks.collect_garbage(contents)
 
     def _copy(self, a: str, b: str):
         '''
         Copy the contents of directory a into directory b
         '''
-        self._ensure_dir_exists(in_path := join(self.backup_dir, a))
-        try: rclone.copy(in_path, join(self.backup_dir, b))
-        except: log.exception(f'Error copying {a} to {b}')
+        if self.storage == 'content':
+            with self._stage(f'copy {a} {b}', f'Error copying {a} to {b}'):
+                self.store.copy(self._slot(a), self._slot(b))
+                self._record('copy', a.rstrip('/'), b.rstrip('/'))
+            return
+
+        with self._stage(f'copy {a} {b}', f'Error copying {a} to {b}'):
+            self.engine.copy(self._path(a), self._path(b), **self._tuned('copy'))
+            self._record('copy', a.rstrip('/'), b.rstrip('/'))
 
     def _accumulate(self, a: str, b: str):
         '''
         Accumulate the contents of directory a into directory b
         ignoring existing files (i.e., only new files are copied)
         '''
-        self._ensure_dir_exists(in_path := join(self.backup_dir, a))
-        self._ensure_dir_exists(out_path := join(self.backup_dir, b))
-        try:
-            rclone.copy(in_path, out_path, args=['--ignore-existing'])
-            rclone.delete(in_path)
-        except:
-            log.exception(f'Error accumulating {a} into {b}')
+        if self.storage == 'content':
+            with self._stage(f'accumulate {a} {b}', f'Error accumulating {a} into {b}'):
+                self.store.accumulate(self._slot(a), self._slot(b))
+                self._record('accumulate', a.rstrip('/'), b.rstrip('/'))
+            return
+
+        with self._stage(f'accumulate {a} {b}', f'Error accumulating {a} into {b}'):
+            if self._packed(b):
+                self.packs.merge(self._slot(a), self._slot(b))
+            self.engine.accumulate(self._path(a), self._path(b), **self._tuned('accumulate'))
+            self._record('accumulate', a.rstrip('/'), b.rstrip('/'))
+        self._pack(a, b)
     
     def _move(self, a: str, b: str):
         '''
         Replace the contents of directory b with the contents of directory a
         '''
-        self._ensure_dir_exists(in_path := join(self.backup_dir, a))
-        try: rclone.move(in_path, join(self.backup_dir, b))
-        except: log.exception(f'Error moving {a} to {b}')
+        if self.storage == 'content':
+            with self._stage(f'move {a} {b}', f'Error moving {a} to {b}'):
+                self.store.move(self._slot(a), self._slot(b))
+                self._record('move', a.rstrip('/'), b.rstrip('/'))
+            return
+
+        with self._stage(f'move {a} {b}', f'Error moving {a} to {b}'):
+            self.engine.move(self._path(a), self._path(b), **self._tuned('move'))
+            self._record('move', a.rstrip('/'), b.rstrip('/'))
+        self._pack(a, b)
+
+    def _packed(self, name: str) -> bool:
+        return name.split('.')[0] in self.pack_tiers
+
+    def _pack(self, a: str, b: str):
+        '''
+        Pack the small files that snapback a brought into snapback b, when
+        b is packed and a is not a snapback of the same tier, whose files
+        are already packed. Packing only saves objects, so its errors do
+        not fail the update
+        '''
+        if not self._packed(b) or a.split('.')[0] == b.split('.')[0]:
+            return
+        with self.metrics.stage(f'pack {b.rstrip("/")}'):
+            try:
+                self.packs.pack(self._slot(b))
+            except Exception:
+                log.exception(f'Error packing {b}')
+
+    def _clear(self, slot: str):
+        '''
+        Remove the physical directory slot and its contents. Its errors are
+        raised, so the rotation fails before the slot is reused with the
+        old files still in it
+        '''
+        if self.storage == 'content':
+            return self.store.clear(slot)
+        self.engine.purge(join(self.backup_dir, slot))
+
+    def _rotate(self, tier: str, generation: int = None):
+        '''
+        Shift the snapbacks of the tier one position, leaving the first one
+        empty and discarding the oldest one. With manifest rotation nothing
+        is done if the tier already reached the generation
+        '''
+        if self.rotation == 'manifest':
+            with self._stage(f'rotate {tier}', f'Error rotating {tier}'):
+                if self.manifest.rotate(tier, self._clear, generation):
+                    self._record('rotate', tier)
+            return
+
+        for i in range(TIERS[tier]-1, 0, -1):
+            self._move(f'{tier}.{i}/', f'{tier}.{i+1}/')
+
+    def _rolls(self) -> dict:
+        '''
+        Return the new value of each state key whose tier rolls in this run
+        '''
+        now = self.clock()
+        values = {
+            'day': now.day, 'week': now.isocalendar()[1],
+            'month': now.strftime("%B"), 'year': now.year
+        }
+        return {
+            key: value for key, value in values.items()
+            if value != self.last_snapback_data[key]
+        }
+
+    def _known_tiers(self) -> tuple:
+        '''
+        Return the snapbacks known to be empty and those known to hold
+        files: all of them with content storage, from the catalog when it
+        is complete, and at least .temp once the sync has run
+        '''
+        names = [get_hourly_dir(h) for h in HOURS] + [
+            f'{tier}.{i}' for tier, n in TIERS.items() for i in range(1, n+1)
+        ]
+        counts = {}
+        if self.storage == 'content':
+            counts = {name: len(self.store.index.get(self._slot(name), {})) for name in names}
+        else:
+            try:
+                job_name = self.last_snapback_data.job_name
+                if self.catalog.is_complete(job_name, self.dir_name):
+                    known = self.catalog.tier_counts(job_name, self.dir_name)
+                    counts = {name: known.get(name, 0) for name in names}
+            except Exception:
+                log.exception('Error reading the catalog, planning without it')
+        if self._temp is not None:
+            counts['.temp'] = len(self._temp)
+        empty = {name for name, n in counts.items() if n == 0}
+        return empty, set(counts) - empty
+
+    def plan(self, hour: str, deferred: set = ()) -> list:
+        '''
+        Return the tier operations of the run at the given hour, without the
+        ones known to do nothing, nor the rolls of the deferred state keys
+        '''
+        empty, full = self._known_tiers()
+        rolls = {key: value for key, value in self._rolls().items() if key not in deferred}
+        return plan(get_hourly_dir(hour), rolls,
+            self.rotation, self.storage, empty, full)
+
+    def _projected(self, ops: list) -> float:
+        '''
+        Project the requests of the operations of a plan from the history
+        of their stages, or from the engine calls they make if they never ran
+        '''
+        job = self.last_snapback_data.job_name
+        projected = 0
+        for op in ops:
+            if op.kind == 'state':
+                continue
+            if op.kind == 'mkdir':
+                stage = f'mkdir {self._path(op.a)}'
+            elif op.kind == 'rotate':
+                stage = f'rotate {op.a}'
+            else:
+                stage = f'{op.kind} {op.a} {op.b}'
+            projected += self.ledger.project(job, self.dir_name, stage, cost([op], self.storage))
+            # Packing follows the moves into packed tiers
+            if op.kind in ('accumulate', 'move'):
+                projected += self.ledger.project(job, self.dir_name, f'pack {op.b}')
+        return projected
+
+    def _budgeted_plan(self, hour: str, record: dict) -> list:
+        '''
+        Plan the run, deferring the rolls of the cold tiers, the coldest
+        first, while the projected requests go over the budget of the run.
+        A deferred tier rolls on a later run, as its state is not updated
+        '''
+        ops = self.plan(hour)
+        if self.ledger is None or (remaining := self.ledger.remaining(self.metrics)) is None:
+            return ops
+        rolls, deferred = self._rolls(), set()
+        for key in DEFERRABLE:
+            if self._projected(ops) <= remaining:
+                break
+            if key in rolls:
+                deferred.add(key)
+                ops = self.plan(hour, deferred)
+        if deferred:
+            record['deferred'] = sorted(deferred, key=DEFERRABLE.index)
+            log.warning(f'Deferred the {", ".join(ROLLS[k] for k in record["deferred"])} '
+                        f'rotation of {self.dir_name}, over the budget of {self.ledger.budget} requests')
+        if (projected := self._projected(ops)) > remaining:
+            log.warning(f'The run of {self.dir_name} is projected to go over the request budget '
+                        f'by {projected - remaining:.0f}, its remaining operations can not be deferred')
+        return ops
+
+    def describe_plan(self, hour: str) -> str:
+        unplanned = cost(schedule(get_hourly_dir(hour), self._rolls(), self.rotation))
+        try:
+            return describe(self.plan(hour), unplanned, self.storage)
+        finally:
+            self._close_catalog()
+            self._close_engine()
+
+    def _close_catalog(self):
+        if self._catalog is not None:
+            self._catalog.close()
+            self._catalog = None
+
+    def _close_engine(self):
+        if self._own_engine is not None:
+            self._own_engine.close()
+
+    def _run(self, op: Operation):
+        if op.kind == 'mkdir':
+            self._ensure_dir_exists(self._path(op.a))
+        elif op.kind == 'copy':
+            self._copy(op.a, op.b)
+        elif op.kind == 'accumulate':
+            self._accumulate(op.a, op.b)
+        elif op.kind == 'move':
+            self._move(op.a, op.b)
+        elif op.kind == 'rotate':
+            self._rotate(op.a, op.value)
+        elif op.kind == 'state':
+            self.last_snapback_data[op.a] = op.value
+            log.info(f'{ROLLS[op.a].capitalize()} backup performed')
 
     def perform_update(self, hour: str):
         '''
-        Perfoms the complete reverse incremental backup process
-        '''
-        day = dt.now().day
-        week = dt.now().isocalendar()[1]
-        month = dt.now().strftime("%B")
-        year = dt.now().year
-
-        update_daily_backup   = day   != self.last_snapback_data['day']
-        update_weely_backup   = week  != self.last_snapback_data['week']
-        update_monthly_backup = month != self.last_snapback_data['month']
-        update_yearly_backup  = year  != self.last_snapback_data['year']
-
-        self._sync()
-
-        if hourly_dir := get_hourly_dir(hour): 
-            self._copy('.temp/', hourly_dir)
-
-        if update_daily_backup:
-            self._move('daily.2/', 'daily.3/')
-            self._move('daily.1/', 'daily.2/')
-            self.last_snapback_data['day'] = day
-            log.info('Daily backup performed')
-        self._accumulate('.temp/', 'daily.1/')
-
-        if update_weely_backup:
-            self._move('weekly.1/', 'weekly.2/')
-            self.last_snapback_data['week'] = week
-            log.info('Weekly backup performed')
-        if update_daily_backup:
-            self._accumulate('daily.1/', 'weekly.1/')
-
-        if update_monthly_backup:
-            self._move('monthly.2/', 'monthly.3/')
-            self._move('monthly.1/', 'monthly.2/')
-            self.last_snapback_data['month'] = month
-            log.info('Monthly backup performed')
-        if update_weely_backup:
-            self._accumulate('weekly.1/', 'monthly.1/')
-
-        if update_yearly_backup:
-            self._move('yearly.1/', 'yearly.2/')
-            self.last_snapback_data['year'] = year
-            log.info('Yearly backup performed')
-        if update_monthly_backup:
-            self._accumulate('monthly.1/', 'yearly.1/')
-
-    def restore(snapback: str):
-        pass
\ No newline at end of file
+        Perfoms the complete reverse incremental backup process. The state
+        changes of the run are committed together when it ends, along with
+        whether it succeeded and the first stage that failed
+        '''
+        with self.last_snapback_data.transaction():
+            try:
+                self._perform_update(hour)
+            finally:
+                self.last_snapback_data['failing_point'] = self.failing_point
+                self.last_snapback_data['success'] = self.failing_point is None
+                self.metrics.finish(self.failing_point)
+                self._record_tuning()
+                self._record_costs()
+                self._close_catalog()
+                if self._hash_cache is not None:
+                    self._hash_cache.close()
+                    self._hash_cache = None
+                self._close_engine()
+
+    def _record_tuning(self):
+        '''
+        Tune the next runs from the throughput of this one. Tuning only
+        changes settings, so its errors do not fail the update
+        '''
+        if self.tuner is None:
+            return
+        try:
+            self.tuner.record(self.remote, self.metrics.stages, self._workload)
+        except Exception:
+            log.exception('Error tuning the transfer settings')
+
+    def _record_costs(self):
+        if self.ledger is None:
+            return
+        try:
+            self.ledger.record(self.metrics)
+        except Exception:
+            log.exception('Error recording the requests of the update')
+
+    def _run_ops(self, hour: str, ops: list, done: int = 0, attempts: int = 0) -> bool:
+        '''
+        Run the tier operations from the done-th one, saving the progress to
+        the checkpoint after each one. The run stops at the first operation
+        that fails, as the next ones depend on it, and the checkpoint is
+        kept for the next run. Returns whether every operation was made
+        '''
+        # Rotations are saved with the generation they bring their tier to,
+        # so a run resumed after one was saved does not rotate the tier again
+        for op in ops[done:]:
+            if op.kind == 'rotate' and op.value is None:
+                op.value = self.manifest.generations[op.a] + 1
+        self.checkpoint.save(hour, ops, done, attempts)
+        completed = True
+        for op in ops[done:]:
+            failures = self.failures
+            self._run(op)
+            if self.failures > failures:
+                log.error(f'Stopped at "{op}", the next run resumes from it')
+                completed = False
+                break
+            done += 1
+            # Content stored snapbacks only change when the index is saved
+            if self.storage != 'content':
+                self.checkpoint.save(hour, ops, done, attempts)
+
+        if self.storage == 'content':
+            failures = self.failures
+            with self._stage('commit', 'Error saving the content store index'):
+                self.store.commit()
+            if self.failures > failures:
+                return False
+            self.checkpoint.save(hour, ops, done, attempts)
+
+        if completed:
+            self.checkpoint.clear()
+        return completed
+
+    def _resume(self, checkpoint: dict) -> bool:
+        '''
+        Finish the tier operations of the run that stopped halfway, before
+        this run syncs anything into .temp. The state values of the
+        operations it made are assigned again, as that run may have died
+        before saving them. Returns whether this run can go on
+        '''
+        ops, done = checkpoint['ops'], checkpoint['done']
+        if done >= len(ops):
+            self.checkpoint.clear()
+            return True
+        attempts = checkpoint.get('attempts', 0) + 1
+        if attempts > RESUME_ATTEMPTS:
+            log.error(f'Giving up the run of {checkpoint["hour"]}, stopped at '
+                      f'"{ops[done]}" after {RESUME_ATTEMPTS} attempts to resume it')
+            self.checkpoint.clear()
+            return True
+
+        log.warning(f'Resuming the run of {checkpoint["hour"]} at "{ops[done]}"')
+        for op in ops[:done]:
+            if op.kind == 'state':
+                self.last_snapback_data[op.a] = op.value
+        return self._run_ops(checkpoint['hour'], ops, done, attempts)
+
+    def _load_manifest(self) -> bool:
+        '''
+        Read the slot manifest before anything is resolved through it.
+        Returns whether it was read, as a manifest that exists but can not
+        be read must not be replaced by the default slots
+        '''
+        if self.rotation != 'manifest':
+            return True
+        failures = self.failures
+        with self._stage('load slots', 'Error reading the slot manifest'):
+            self._manifest = SlotManifest.load(self.engine, self.backup_dir)
+        return self.failures == failures
+
+    def _perform_update(self, hour: str):
+        if not self._load_manifest():
+            return
+        if (checkpoint := self.checkpoint.load()) is not None:
+            if not self._resume(checkpoint):
+                return
+
+        if self.last_snapback_data['day'] == 0:
+            self._start_catalog()
+
+        if not self._sync():
+            return
+        if self.storage == 'content' and not self._ingest():
+            return
+        self._record_sync()
+
+        rolls = self._rolls()
+        with self.metrics.stage('plan') as record:
+            ops = self._budgeted_plan(hour, record)
+        self._run_ops(hour, ops)
+
+        # Only after a clean run, so every recipe is where it should be
+        if ('week' in rolls and self.chunk_threshold is not None
+                and self.failing_point is None):
+            self._collect_chunks()
\ No newline at end of file
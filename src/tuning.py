@@ -0,0 +1,148 @@
+import os
+import json
+import threading
+import logging as log
+from os.path import dirname
+
+
+# Stages whose transfers are tuned, by the first word of their name
+TUNED = ('sync', 'copy', 'move', 'accumulate')
+
+# Settings of a remote never tuned, those of rclone
+DEFAULTS = {'transfers': 4, 'checkers': 8, 'buffer_size': 16 << 20}
+
+# Bounds of each setting, unless the config sets others
+BOUNDS = {'transfers': [1, 32], 'checkers': [2, 64], 'buffer_size': [4 << 20, 64 << 20]}
+
+# Runs moving less than this are too short to measure a throughput
+MIN_BYTES = 64 << 20
+MIN_SECONDS = 5
+
+# Share of failed files above which the concurrency is halved
+MAX_ERROR_RATE = 0.01
+
+# Drop in throughput taken as noise rather than a worse setting
+TOLERANCE = 0.05
+
+
+def clamp(value: int, bounds: list) -> int:
+    return max(bounds[0], min(bounds[1], value))
+
+
+def mib(size: int) -> str:
+    return f'{size / (1 << 20):.1f} MiB'
+
+
+def state_key(remote: str, workload: str = None) -> str:
+    '''
+    Key of the tuning state of a workload against a remote
+    '''
+    return remote if workload is None else f'{remote}:{workload}'
+
+
+class Tuner:
+    '''
+    Tunes the --transfers, --checkers and --buffer-size of each stage kind
+    (sync, copy, move, accumulate) of each directory backed up to a remote
+    from the throughput and errors measured on its previous runs, stored in
+    a JSON file. Directories are tuned apart, as the throughput of one
+    says nothing of the settings another needs.
+
+    The number of transfers climbs while the throughput keeps up and turns
+    back when it drops, is halved when files fail and stays within the
+    bounds of the config. Checkers follow the transfers as rclone's
+    defaults do, and buffers hold about a second of each transfer
+    '''
+
+    def __init__(self, file: str, config: dict = None):
+        config = config or {}
+        self.file = file
+        self.bounds = {**BOUNDS, **{k: v for k, v in config.items() if k in BOUNDS}}
+        self.remotes = config.get('remotes') or {}
+        self.lock = threading.Lock()
+        self.state = {}
+        try:
+            with open(file, 'r') as f: self.state = json.load(f)
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            log.exception(f'Error reading the tuning file {file}, starting over')
+
+    def _bounds(self, remote: str) -> dict:
+        return {**self.bounds, **(self.remotes.get(remote) or {})}
+
+    def settings(self, remote: str, kind: str, workload: str = None) -> dict:
+        '''
+        Return the engine options of the next run of a stage kind of a
+        workload, such as "<job>/<directory>", against a remote
+        '''
+        bounds = self._bounds(remote)
+        with self.lock:
+            state = self.state.get(state_key(remote, workload), {}).get(kind, {})
+        return {
+            name: clamp(state.get(name, default), bounds[name])
+            for name, default in DEFAULTS.items()
+        }
+
+    def record(self, remote: str, stages: list, workload: str = None):
+        '''
+        Tune the settings of a workload against a remote from the metrics
+        records of the stages of an update, and save them
+        '''
+        totals = {}
+        for stage in stages:
+            if (kind := stage['stage'].split(' ')[0]) not in TUNED: continue
+            total = totals.setdefault(kind, {'bytes': 0, 'seconds': 0.0, 'files': 0, 'errors': 0})
+            for counter in total:
+                total[counter] += stage[counter]
+
+        with self.lock:
+            for kind, total in totals.items():
+                self._tune(remote, workload, kind, total)
+            self._save()
+
+    def _tune(self, remote: str, workload: str, kind: str, total: dict):
+        bounds = self._bounds(remote)
+        state = self.state.setdefault(state_key(remote, workload), {}).setdefault(kind, {})
+        settings = {
+            name: clamp(state.get(name, default), bounds[name])
+            for name, default in DEFAULTS.items()
+        }
+        failing = total['errors'] > MAX_ERROR_RATE * max(total['files'], 1)
+        if not failing and (total['bytes'] < MIN_BYTES or total['seconds'] < MIN_SECONDS):
+            return
+        rate = total['bytes'] / max(total['seconds'], 1e-9)
+        transfers, direction = settings['transfers'], state.get('direction', 1)
+
+        if failing:
+            transfers, direction = transfers // 2, 1
+        else:
+            previous = state.get('rate')
+            if previous is not None and rate < previous * (1 - TOLERANCE):
+                direction = -direction
+            transfers += direction * max(1, transfers // 4)
+
+        transfers = clamp(transfers, bounds['transfers'])
+        state.update(
+            transfers=transfers,
+            checkers=clamp(2 * transfers, bounds['checkers']),
+            direction=direction,
+            rate=None if failing else rate
+        )
+        if not failing:
+            # A second of each transfer, rounded up to a power of two
+            per_transfer = int(rate / settings['transfers'])
+            state['buffer_size'] = clamp(1 << max(per_transfer - 1, 1).bit_length(), bounds['buffer_size'])
+        log.info(
+            f'Tuning {state_key(remote, workload)} {kind}: {mib(total["bytes"])} in {total["seconds"]:.1f}s '
+            f'({mib(rate)}/s) with {settings["transfers"]} transfers, {total["errors"]} errors; '
+            f'next run uses {state["transfers"]} transfers, {state["checkers"]} checkers and '
+            f'{mib(state.get("buffer_size", settings["buffer_size"]))} buffers'
+        )
+
+    def _save(self):
+        os.makedirs(dirname(self.file) or '.', exist_ok=True)
+        temp_file = self.file + '.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(temp_file, self.file)
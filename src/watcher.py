@@ -0,0 +1,339 @@
+import os
+import sys
+import time
+import yaml
+import ctypes
+import ctypes.util
+import select
+import struct
+import argparse
+import logging as log
+from os.path import join, exists, dirname
+from manifest import ExcludeFilter
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR       = 0x40000000
+IN_CLOEXEC     = 0o2000000
+
+WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+    IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF |
+    IN_ONLYDIR | IN_DONT_FOLLOW
+)
+EVENT_HEADER = struct.Struct('iIII')
+
+OVERFLOW = '!overflow'
+
+
+class ChangeJournal:
+    '''
+    Paths changed in a source directory since the last sync, appended by the
+    watcher and consumed by the sync. The first line identifies the watcher
+    session that writes it, so the reader can tell whether the journal
+    covers the whole time since the last sync.
+    '''
+
+    def __init__(self, file: str):
+        self.file = file
+
+    def _locked(self, mode: str):
+        f = open(self.file, mode, encoding='utf-8')
+        if fcntl: fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def start(self, pid: int, start_ns: int):
+        '''
+        Begin a new watcher session, discarding the previous journal
+        '''
+        os.makedirs(dirname(self.file) or '.', exist_ok=True)
+        with self._locked('w') as f:
+            f.write(f'# snapback journal pid={pid} start={start_ns}\n')
+
+    def append(self, paths: list, max_entries: int = 100000) -> bool:
+        '''
+        Append changed paths. Once the journal holds more than max_entries
+        paths it is marked as overflowed and False is returned
+        '''
+        with self._locked('a+') as f:
+            f.seek(0)
+            lines = sum(1 for _ in f)
+            if lines + len(paths) > max_entries:
+                f.write(OVERFLOW + '\n')
+                return False
+            f.writelines(path + '\n' for path in paths)
+        return True
+
+    def mark_overflow(self):
+        with self._locked('a') as f: f.write(OVERFLOW + '\n')
+
+    def has_overflowed(self) -> bool:
+        with self._locked('r') as f:
+            return any(line.rstrip('\n') == OVERFLOW for line in f)
+
+    def read(self, since_ns: int) -> tuple:
+        '''
+        Return the changed paths and the offset up to which they were read,
+        or (None, None) if the journal can not be trusted to hold every
+        change since since_ns: no watcher session started before that time,
+        the watcher is gone or events were lost
+        '''
+        if not exists(self.file):
+            return None, None
+        with self._locked('r') as f:
+            header = f.readline()
+            body = f.read()
+            offset = f.tell()
+        try:
+            fields = dict(x.split('=') for x in header.split()[3:])
+            pid, start_ns = int(fields['pid']), int(fields['start'])
+        except (ValueError, KeyError):
+            return None, None
+        if start_ns > since_ns or not pid_alive(pid):
+            return None, None
+        paths = body.splitlines()
+        if OVERFLOW in paths:
+            return None, offset
+        return sorted(set(paths)), offset
+
+    def commit(self, offset: int):
+        '''
+        Drop the paths read up to offset once they have been synced
+        '''
+        with self._locked('r+') as f:
+            header = f.readline()
+            f.seek(offset)
+            rest = f.read()
+            f.seek(0)
+            f.truncate()
+            f.write(header + rest)
+
+
+def pid_alive(pid: int) -> bool:
+    '''
+    Whether the process pid is running, probed with signal 0. The journal
+    is only written by the watcher, which runs on Linux: elsewhere the
+    watcher is never taken for alive, as os.kill terminates the process
+    on Windows instead of probing it
+    '''
+    if os.name != 'posix':
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Watcher:
+    '''
+    Watches the source directories with inotify (Linux only) and records
+    the changed paths of each one in its journal
+    '''
+
+    def __init__(self, directories: dict, flush_interval: float = 5,
+                 max_entries: int = 100000):
+        '''
+        directories maps each journal file to the source path it watches
+        and the exclude patterns of the source
+        '''
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.flush_interval = flush_interval
+        self.max_entries = max_entries
+        self.watches = {}
+        self.pending = {}
+        self.overflowed = set()
+        self.started = False
+        self.stopped = False
+        self.sources = {}
+        for journal_file, (path, exclude) in directories.items():
+            journal = ChangeJournal(journal_file)
+            self.sources[journal_file] = (journal, path, ExcludeFilter(exclude))
+            self.pending[journal_file] = set()
+
+    def _add_tree(self, journal_file: str, rel_dir: str):
+        '''
+        Watch a directory and all its subdirectories that are not excluded
+        '''
+        journal, root, excluded = self.sources[journal_file]
+        stack = [rel_dir]
+        while stack:
+            rel_dir = stack.pop()
+            path = join(root, rel_dir) if rel_dir else root
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+            if wd < 0:
+                log.error(f'Can not watch {path}: {os.strerror(ctypes.get_errno())}')
+                self._overflow(journal_file)
+                continue
+            self.watches[wd] = (journal_file, rel_dir)
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        rel_path = (rel_dir + '/' if rel_dir else '') + entry.name
+                        if (entry.is_dir(follow_symlinks=False)
+                                and not excluded(rel_path, is_dir=True)):
+                            stack.append(rel_path)
+            except OSError:
+                log.exception(f'Error scanning {path}')
+
+    def _overflow(self, journal_file: str):
+        if journal_file not in self.overflowed:
+            if self.started:
+                self.sources[journal_file][0].mark_overflow()
+            self.overflowed.add(journal_file)
+
+    def _handle(self, wd: int, mask: int, name: str):
+        if mask & IN_Q_OVERFLOW:
+            log.warning('inotify queue overflow, next syncs will scan')
+            for journal_file in self.sources: self._overflow(journal_file)
+            return
+        if wd not in self.watches:
+            return
+        journal_file, rel_dir = self.watches[wd]
+        if mask & IN_IGNORED:
+            del self.watches[wd]
+            return
+        excluded = self.sources[journal_file][2]
+        rel_path = (rel_dir + '/' if rel_dir else '') + name if name else rel_dir
+        is_dir = bool(mask & IN_ISDIR)
+        if name and excluded(rel_path, is_dir=is_dir):
+            return
+        self.pending[journal_file].add(rel_path)
+        if is_dir and mask & (IN_CREATE | IN_MOVED_TO):
+            self._add_tree(journal_file, rel_path)
+
+    def _read_events(self):
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return
+        i = 0
+        while i < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, i)
+            i += EVENT_HEADER.size
+            name = data[i:i+length].rstrip(b'\0')
+            i += length
+            self._handle(wd, mask, os.fsdecode(name))
+
+    def flush(self):
+        for journal_file, paths in self.pending.items():
+            if paths and journal_file not in self.overflowed:
+                journal = self.sources[journal_file][0]
+                if not journal.append(sorted(paths), self.max_entries):
+                    self.overflowed.add(journal_file)
+            paths.clear()
+
+    def run(self):
+        '''
+        Watch until interrupted. The session is started once every watch is
+        in place, so the journals only vouch for the time they cover
+        '''
+        for journal_file in self.sources:
+            self._add_tree(journal_file, '')
+        start_ns = time.time_ns()
+        for journal_file, (journal, path, _) in self.sources.items():
+            journal.start(os.getpid(), start_ns)
+            if journal_file in self.overflowed:
+                journal.mark_overflow()
+            log.info(f'Watching {path}')
+        self.started = True
+
+        last_flush = time.time()
+        try:
+            while not self.stopped:
+                ready, _, _ = select.select([self.fd], [], [], self.flush_interval)
+                if ready: self._read_events()
+                if time.time() - last_flush >= self.flush_interval:
+                    self.flush()
+                    # Overflowed journals start recording again once consumed
+                    self.overflowed = {
+                        f for f in self.overflowed
+                        if self.sources[f][0].has_overflowed()
+                    }
+                    last_flush = time.time()
+        finally:
+            self.flush()
+            os.close(self.fd)
+
+    def stop(self):
+        self.stopped = True
+
+
+def command_parser():
+    parser = argparse.ArgumentParser(description="snapBack change watcher")
+    parser.add_argument(
+        '--log-level',
+        type=str,
+        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
+        default='ERROR',
+        help='Set the logging level (default: ERROR)'
+    )
+    parser.add_argument(
+        '--flush-interval',
+        type=float,
+        default=5,
+        help='Seconds between writes to the journals (default: 5)'
+    )
+    return parser.parse_args()
+
+
+def main():
+    from snapback import LastSnapBackData
+
+    if not sys.platform.startswith('linux'):
+        sys.exit('The watcher needs inotify, which is only available on Linux')
+
+    with open('config.yaml', 'r') as f:
+        config = yaml.safe_load(f)
+
+    args = command_parser()
+    log.basicConfig(
+        level=getattr(log, args.log_level),
+        filename='snapback.log',
+        filemode='a',
+        format='%(asctime)s Watcher: [%(levelname)s] %(message)s'
+    )
+
+    # Only jobs that detect changes with a manifest can use the journals
+    data = LastSnapBackData()
+    directories = {}
+    for job_name, job_data in config['jobs'].items():
+        if job_data.get('change_detection') not in ('manifest', 'checksum'):
+            continue
+        data.select_job(job_name)
+        for dir_name, source in job_data['directories'].items():
+            if type(source) == dict:
+                directories[data.journal_file(dir_name)] = (
+                    source['path'], source.get('exclude', [])
+                )
+            else:
+                directories[data.journal_file(dir_name)] = (source, [])
+
+    Watcher(directories, flush_interval=args.flush_interval).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import os
+import yaml
+from src.snapback import *
+from os.path import join, exists
+
+
+DATA_DIR = join('test', 'test_data')
+DATA_FILE = join(DATA_DIR, 'last_snapback.yaml')
+
+
+def new_data():
+    if not exists(DATA_DIR): os.makedirs(DATA_DIR)
+    if exists(DATA_FILE): os.remove(DATA_FILE)
+    with open(DATA_FILE, 'w') as f: yaml.dump({}, f)
+    return LastSnapBackData(DATA_FILE).select_job('test_job').select_dir('A')
+
+def read_data():
+    with open(DATA_FILE, 'r') as f: return yaml.safe_load(f)
+
+
+def test_transaction():
+    '''
+    Assignments inside a transaction are only written when it ends
+    '''
+    data = new_data()
+    with data.transaction():
+        data['day'] = 5
+        data['week'] = 2
+        assert data['day'] == 5, 'Staged values should be readable'
+        assert read_data()['test_job']['A']['day'] == 0, 'Nothing written yet'
+
+    assert read_data()['test_job']['A']['day'] == 5
+    assert read_data()['test_job']['A']['week'] == 2
+    assert not exists(DATA_FILE + '.tmp')
+
+
+def test_forked_transactions():
+    '''
+    Concurrent views only commit their own directory
+    '''
+    data = new_data()
+    a = data.fork().select_dir('A')
+    b = data.fork().select_dir('B')
+
+    with a.transaction():
+        with b.transaction():
+            a['day'] = 1
+            b['day'] = 2
+        assert read_data()['test_job']['A']['day'] == 0
+        assert read_data()['test_job']['B']['day'] == 2
+
+    assert read_data()['test_job']['A']['day'] == 1
+    assert data.select_dir('B')['day'] == 2
+
+
+def test_failing_point(monkeypatch):
+    '''
+    A failed stage is recorded as the failing point of the run
+    '''
+    data = new_data()
+    update = SnapBackUpdate('source', 'destination', 'A', data)
+
+    def fail(*args, **kwargs): raise RuntimeError('failure')
+    monkeypatch.setattr(update, '_perform_update', lambda hour: update._sync())
+    monkeypatch.setattr(update.engine, 'mkdir', lambda path: None)
+    monkeypatch.setattr(update.engine, 'sync', fail)
+    update.perform_update('12')
+
+    assert read_data()['test_job']['A']['failing_point'] == 'sync'
+    assert read_data()['test_job']['A']['success'] is False
@@ -0,0 +1,39 @@
+import os
+import copy
+import shutil
+from benchmark.benchmark import *
+from os.path import join, exists
+
+
+ROOT = abspath(join('test', 'test_data', 'benchmark'))
+
+
+def test_tree():
+    '''
+    Trees are reproducible from their seed and keep their size on churn
+    '''
+    if exists(ROOT): shutil.rmtree(ROOT)
+    a = SyntheticTree(join(ROOT, 'a'), 50, 'small', seed=1)
+    b = SyntheticTree(join(ROOT, 'b'), 50, 'small', seed=1)
+    with open(join(a.root, a.paths[7]), 'rb') as fa, open(join(b.root, b.paths[7]), 'rb') as fb:
+        assert fa.read() == fb.read()
+
+    changes = a.churn(0.2)
+    assert changes == {'modified': 7, 'deleted': 1, 'created': 1}
+    assert len(a.paths) == 50
+    assert all(exists(join(a.root, path)) for path in a.paths)
+
+
+def test_local_scenario():
+    cwd = os.getcwd()
+    try:
+        report = run_scenario('tiny', {'files': 20, 'days': 2, 'churn': 0.1}, ROOT)
+    finally:
+        os.chdir(cwd)
+    assert (report['runs'], report['failures']) == (8, 0)
+    assert report['stages']['sync']['files'] >= 20
+    assert compare(report, report) == []
+
+    worse = copy.deepcopy(report)
+    worse['stages']['sync']['calls'] += 8
+    assert compare(worse, report) == ['sync calls: 8 -> 16']
@@ -0,0 +1,84 @@
+import os
+import yaml
+import shutil
+from src.catalog import *
+from src.snapback import SnapBackUpdate, LastSnapBackData
+from src.local_engine import LocalEngine
+from os.path import join, exists
+
+
+ROOT = join('test', 'test_data', 'catalog')
+SOURCE = join(ROOT, 'source')
+DEST = join(ROOT, 'dest')
+DATA_FILE = join(ROOT, 'last_snapback.yaml')
+
+
+def new_file(path, name, content=''):
+    if not exists(path): os.makedirs(path)
+    with open(join(path, name+'.txt'), 'w') as f: f.write(content)
+
+def update(rotation='move', change_detection='sync'):
+    data = LastSnapBackData(DATA_FILE).select_job('test_job')
+    SnapBackUpdate(SOURCE, DEST, 'test_directory', data.fork(), engine=LocalEngine(),
+        rotation=rotation, change_detection=change_detection).perform_update('12')
+    return data
+
+def snapshot(catalog):
+    rows = catalog.db.execute(
+        "SELECT tier, path, size, mtime, hash FROM versions WHERE tier != ?", (MAIN,)
+    )
+    return sorted(rows)
+
+
+def test_tier_operations():
+    if exists(ROOT): shutil.rmtree(ROOT)
+    os.makedirs(ROOT)
+    with Catalog(join(ROOT, 'catalog.db')) as catalog:
+        catalog.set_tier('job', 'dir', '.temp', {'A': (1, 10, None), 'B': (2, 20, None)})
+        catalog.set_tier('job', 'dir', 'daily.1', {'A': (1, 5, None)})
+        catalog.accumulate('job', 'dir', '.temp', 'daily.1')
+        assert catalog.versions('job', 'dir', 'A') == [('daily.1', 1, 5, None)]
+
+        catalog.copy('job', 'dir', 'daily.1', 'weekly.1')
+        catalog.rotate('job', 'dir', 'daily')
+        assert [v[0] for v in catalog.versions('job', 'dir', 'B')] == ['daily.2', 'weekly.1']
+        assert catalog.diff('job', 'dir', 'daily.2', 'weekly.1') == {
+            'only_daily.2': [], 'only_weekly.1': [], 'changed': []
+        }
+
+
+def test_mirrors_destination():
+    '''
+    The catalog kept by the updates matches one rebuilt from a listing.
+    The main directory is kept from the changes found by the manifest, or
+    from the versions moved to .temp by a full sync, which leaves the
+    files it did not change as a rebuild found them
+    '''
+    for rotation, change_detection in [('move', 'sync'), ('manifest', 'manifest')]:
+        if exists(ROOT): shutil.rmtree(ROOT)
+        os.makedirs(ROOT)
+        with open(DATA_FILE, 'w') as f: yaml.dump({}, f)
+
+        new_file(SOURCE, 'A', 'Version 1')
+        new_file(SOURCE, 'B', 'Deleted later')
+        new_file(SOURCE, 'C', 'Unchanged')
+        data = update(rotation, change_detection)
+        if change_detection == 'sync':
+            with Catalog(data.catalog_file()) as kept:
+                kept.rebuild('test_job', 'test_directory', LocalEngine(), DEST, rotation)
+        new_file(SOURCE, 'A', 'Version 2 is longer')
+        os.remove(join(SOURCE, 'B.txt'))
+        data = update(rotation, change_detection)
+
+        with Catalog(data.catalog_file()) as kept:
+            versions = [v[0] for v in kept.versions('test_job', 'test_directory', 'A.txt')]
+            assert {'daily.1', 'hourly.12'} <= set(versions)
+            assert kept.versions('test_job', 'test_directory', 'B.txt')
+            main = sorted(kept.db.execute(
+                'SELECT path, size FROM versions WHERE tier=?', (MAIN,)
+            ))
+            assert main == [('A.txt', 19), ('C.txt', 9)]
+
+            with Catalog(join(ROOT, 'rebuilt.db')) as rebuilt:
+                rebuilt.rebuild('test_job', 'test_directory', LocalEngine(), DEST, rotation)
+                assert snapshot(kept) == snapshot(rebuilt)
@@ -0,0 +1,130 @@
+import os
+import yaml
+import shutil
+from src.snapback import SnapBackUpdate, LastSnapBackData
+# The class used by the updates, src imports its siblings as top level modules
+from local_engine import LocalEngine
+from rotation import SlotManifest
+from datetime import datetime as dt
+from os.path import join, exists
+
+
+ROOT = join('test', 'test_data', 'checkpoint')
+SOURCE = join(ROOT, 'source')
+DEST = join(ROOT, 'dest')
+SNAPBACKS = join(DEST, '.snapbacks', 'test_directory')
+DATA_FILE = join(ROOT, 'last_snapback.yaml')
+
+
+def new_file(path, name, content=''):
+    if not exists(path): os.makedirs(path)
+    with open(join(path, name+'.txt'), 'w') as f: f.write(content)
+
+def read_file(path, name):
+    with open(join(path, name+'.txt'), 'r') as f: return f.read()
+
+def update(hour, now, rotation='move'):
+    data = LastSnapBackData(DATA_FILE).select_job('test_job')
+    update = SnapBackUpdate(SOURCE, DEST, 'test_directory', data.fork(),
+        engine=LocalEngine(), clock=lambda: now, rotation=rotation)
+    update.perform_update(hour)
+    return update
+
+
+def test_resume(monkeypatch):
+    '''
+    A run stopped by a failed operation is finished by the next run, which
+    neither redoes the operations made nor rotates the tier again
+    '''
+    if exists(ROOT): shutil.rmtree(ROOT)
+    os.makedirs(ROOT)
+    with open(DATA_FILE, 'w') as f: yaml.dump({}, f)
+
+    new_file(SOURCE, 'A', 'Version 1')
+    update('12', dt(2025, 3, 3, 12))
+    new_file(SOURCE, 'A', 'Version 2')
+    update('16', dt(2025, 3, 3, 16))
+    assert read_file(join(SNAPBACKS, 'daily.1'), 'A') == 'Version 1'
+
+    # The day rolls, and the rotation of daily.1 fails
+    move = LocalEngine.move
+    def failing_move(self, src, dst, **options):
+        if dst.endswith('daily.2'): raise OSError('Destination unavailable')
+        return move(self, src, dst, **options)
+    monkeypatch.setattr(LocalEngine, 'move', failing_move)
+    new_file(SOURCE, 'A', 'Version 3')
+    stopped = update('12', dt(2025, 3, 4, 12))
+
+    checkpoint = stopped.checkpoint.load()
+    assert repr(checkpoint['ops'][checkpoint['done']]) == 'move daily.1 -> daily.2'
+    assert read_file(join(SNAPBACKS, 'hourly.12'), 'A') == 'Version 2'
+    assert stopped.last_snapback_data['day'] == 3
+
+    monkeypatch.setattr(LocalEngine, 'move', move)
+    resumed = update('16', dt(2025, 3, 4, 16))
+    assert resumed.checkpoint.load() is None
+    assert resumed.failing_point is None
+    assert resumed.last_snapback_data['day'] == 4
+    assert read_file(join(SNAPBACKS, 'daily.2'), 'A') == 'Version 1'
+    assert read_file(join(SNAPBACKS, 'weekly.1'), 'A') == 'Version 2'
+    assert not exists(join(SNAPBACKS, 'daily.3'))
+
+
+def rotated_run(monkeypatch, fail=None) -> tuple:
+    '''
+    Back up three days with manifest rotation, the run of the third one
+    stopping at the rotation of the daily tier if fail, called with
+    monkeypatch, breaks it, and return the contents of every logical
+    snapback and the generations of the tiers
+    '''
+    if exists(ROOT): shutil.rmtree(ROOT)
+    os.makedirs(ROOT)
+    with open(DATA_FILE, 'w') as f: yaml.dump({}, f)
+
+    new_file(SOURCE, 'A', 'Version 1')
+    update('12', dt(2025, 3, 3, 12), 'manifest')
+    new_file(SOURCE, 'A', 'Version 2')
+    update('12', dt(2025, 3, 4, 12), 'manifest')
+
+    if fail: fail(monkeypatch)
+    new_file(SOURCE, 'A', 'Version 3')
+    stopped = update('12', dt(2025, 3, 5, 12), 'manifest')
+    if fail:
+        checkpoint = stopped.checkpoint.load()
+        assert repr(checkpoint['ops'][checkpoint['done']]) == 'rotate daily'
+        monkeypatch.undo()
+
+    last = update('16', dt(2025, 3, 5, 16), 'manifest')
+    assert last.checkpoint.load() is None
+    assert last.failing_point is None
+    return {
+        name: read_file(join(SNAPBACKS, slot), 'A')
+        for name, slot in last.manifest.tiers().items()
+        if exists(join(SNAPBACKS, slot, 'A.txt'))
+    }, last.manifest.generations
+
+
+def test_resume_saved_rotation(monkeypatch):
+    '''
+    A run that dies after saving the slot manifest of a rotation, before
+    its checkpoint records it, is resumed without rotating the tier again
+    '''
+    save = SlotManifest.save
+    def dying_save(self):
+        save(self)
+        raise OSError('Connection lost')
+    def fail(monkeypatch):
+        monkeypatch.setattr(SlotManifest, 'save', dying_save)
+    assert rotated_run(monkeypatch, fail) == rotated_run(monkeypatch)
+
+
+def test_failed_clear(monkeypatch):
+    '''
+    A rotation whose oldest slot can not be cleared fails without
+    reordering the slots, and is made again by the next run
+    '''
+    def failing_purge(self, path):
+        raise OSError('Permission denied')
+    def fail(monkeypatch):
+        monkeypatch.setattr(LocalEngine, 'purge', failing_purge)
+    assert rotated_run(monkeypatch, fail) == rotated_run(monkeypatch)
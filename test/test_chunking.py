@@ -0,0 +1,130 @@
+import io
+import os
+import json
+import random
+import time
+import shutil
+import pytest
+from src.chunking import *
+from src import chunking
+from src.local_engine import LocalEngine
+from os.path import join, exists
+
+
+ROOT = join('test', 'test_data', 'chunking')
+SOURCE = join(ROOT, 'source')
+DEST = join(ROOT, 'dest', 'test_directory')
+BACKUP_DIR = join(ROOT, 'dest', '.snapbacks', 'test_directory')
+TEMP = join(BACKUP_DIR, '.temp')
+CACHE = join(ROOT, 'chunks.json')
+AVERAGE = 1024
+
+
+def random_bytes(size, seed):
+    return random.Random(seed).randbytes(size)
+
+def write(name, data):
+    os.makedirs(SOURCE, exist_ok=True)
+    with open(join(SOURCE, name), 'wb') as f: f.write(data)
+    stat = os.stat(join(SOURCE, name))
+    return {name: [stat.st_size, stat.st_mtime_ns]}
+
+def new_store():
+    return ChunkStore(LocalEngine(), DEST, BACKUP_DIR, CACHE, 4 * AVERAGE, AVERAGE)
+
+def chunk_files():
+    return [f for _, _, files in os.walk(join(BACKUP_DIR, CHUNKS_DIR)) for f in files]
+
+def read_recipe(path):
+    with open(path, 'r') as f: return json.load(f)
+
+
+def test_content_defined_boundaries():
+    '''
+    Inserting bytes at the start only changes the chunks around the insertion
+    '''
+    data = random_bytes(200 * AVERAGE, 0)
+    chunks = list(iter_chunks(io.BytesIO(data), AVERAGE))
+    shifted = list(iter_chunks(io.BytesIO(b'inserted' + data), AVERAGE))
+
+    assert b''.join(chunks) == data
+    assert all(len(c) <= 4 * AVERAGE for c in chunks)
+    assert len(set(chunks) & set(shifted)) >= len(chunks) - 2
+
+
+def test_vectorised_boundaries(monkeypatch):
+    '''
+    The numpy search finds the boundaries of the byte by byte one
+    '''
+    if chunking.np is None: pytest.skip('numpy is not installed')
+    data = random_bytes(300 * AVERAGE, 2)
+    for average in (16, 100, AVERAGE):
+        chunks = list(iter_chunks(io.BytesIO(data), average))
+        with monkeypatch.context() as m:
+            m.setattr(chunking, 'np', None)
+            assert list(iter_chunks(io.BytesIO(data), average)) == chunks
+
+
+def test_throughput():
+    '''
+    Large files are chunked far faster than a byte by byte Python loop,
+    which runs at about 5 MB/s
+    '''
+    if chunking.np is None: pytest.skip('numpy is not installed')
+    data = random_bytes(32 << 20, 3)
+    start = time.perf_counter()
+    assert sum(len(c) for c in iter_chunks(io.BytesIO(data))) == len(data)
+    assert len(data) / (time.perf_counter() - start) > 25e6
+
+
+def test_delta_upload():
+    '''
+    Only the chunks of the modified region are uploaded and the old recipe
+    is moved to .temp
+    '''
+    if exists(ROOT): shutil.rmtree(ROOT)
+    data = random_bytes(100 * AVERAGE, 1)
+    entries = {**write('big.bin', data), **write('small.txt', b'small')}
+
+    store = new_store()
+    assert store.update(SOURCE, entries, TEMP)
+    first = read_recipe(join(DEST, 'big.bin' + RECIPE_SUFFIX))
+    uploaded = len(chunk_files())
+    assert uploaded == len({d for d, _ in first['chunks']})
+    assert not exists(join(DEST, 'small.txt' + RECIPE_SUFFIX))
+    assert not new_store().update(SOURCE, entries, TEMP), 'Nothing changed'
+
+    modified = data[:50 * AVERAGE] + b'modified' + data[50 * AVERAGE:]
+    entries.update(write('big.bin', modified))
+    assert new_store().update(SOURCE, entries, TEMP)
+    assert len(chunk_files()) - uploaded <= 3
+    assert read_recipe(join(TEMP, 'big.bin' + RECIPE_SUFFIX)) == first
+
+    out = io.BytesIO()
+    store.rebuild(read_recipe(join(DEST, 'big.bin' + RECIPE_SUFFIX)), out)
+    assert out.getvalue() == modified
+
+    # Deleted file: the recipe is moved to .temp
+    del entries['big.bin']
+    assert new_store().update(SOURCE, entries, TEMP)
+    assert not exists(join(DEST, 'big.bin' + RECIPE_SUFFIX))
+
+
+def test_garbage_collection():
+    '''
+    Chunks no longer referenced by any recipe are deleted
+    '''
+    if exists(ROOT): shutil.rmtree(ROOT)
+    entries = write('big.bin', random_bytes(20 * AVERAGE, 2))
+    store = new_store()
+    store.update(SOURCE, entries, TEMP)
+    first = read_recipe(join(DEST, 'big.bin' + RECIPE_SUFFIX))
+    entries = write('big.bin', random_bytes(20 * AVERAGE, 3))
+    store.update(SOURCE, entries, TEMP)
+    second = read_recipe(join(DEST, 'big.bin' + RECIPE_SUFFIX))
+
+    store.collect_garbage([first, second])
+    both = len(chunk_files())
+    store.collect_garbage([second])
+    assert sorted(chunk_files()) == sorted({d for d, _ in second['chunks']})
+    assert len(chunk_files()) < both
@@ -0,0 +1,119 @@
+import os
+import shutil
+import pytest
+from src.content_store import *
+from src.local_engine import LocalEngine
+from os.path import join, exists
+
+
+ROOT = join('test', 'test_data', 'content_store')
+BACKUP_DIR = join(ROOT, '.snapbacks', 'test_directory')
+TEMP = join(BACKUP_DIR, '.temp')
+
+
+def new_file(path, name, content=''):
+    if not exists(path): os.makedirs(path)
+    with open(join(path, name+'.txt'), 'w') as f: f.write(content)
+
+def blobs():
+    return [f for _, _, files in os.walk(join(BACKUP_DIR, BLOBS_DIR)) for f in files]
+
+
+def test_deduplication():
+    '''
+    The same contents are stored once, whatever the path or the snapback
+    '''
+    if exists(ROOT): shutil.rmtree(ROOT)
+    store = ContentStore(LocalEngine(), BACKUP_DIR)
+
+    new_file(TEMP, 'A', 'Same content')
+    new_file(TEMP, 'B', 'Same content')
+    store.ingest(TEMP)
+    store.copy('.temp', 'hourly.12')
+    store.accumulate('.temp', 'daily.1')
+    store.commit()
+
+    assert len(blobs()) == 1
+    assert not exists(join(TEMP, 'A.txt'))
+    assert store.tier('hourly.12').keys() == {'A.txt', 'B.txt'}
+    assert store.tier('daily.1')['A.txt']['blob'] == store.tier('daily.1')['B.txt']['blob']
+    assert store.tier('.temp') == {}
+
+    # Renamed file: its contents are already stored
+    new_file(TEMP, 'C', 'Same content')
+    store.ingest(TEMP)
+    store.accumulate('.temp', 'daily.1')
+    store.commit()
+    assert len(blobs()) == 1
+
+    reloaded = ContentStore(LocalEngine(), BACKUP_DIR)
+    assert reloaded.index == store.index
+
+
+def test_garbage_collection():
+    '''
+    Blobs are deleted once no snapback references them
+    '''
+    if exists(ROOT): shutil.rmtree(ROOT)
+    store = ContentStore(LocalEngine(), BACKUP_DIR)
+
+    new_file(TEMP, 'A', 'Old A')
+    store.ingest(TEMP)
+    store.accumulate('.temp', 'daily.1')
+    store.copy('daily.1', 'weekly.1')
+    store.commit()
+
+    store.move('daily.1', 'daily.2')
+    store.clear('daily.2')
+    store.commit()
+    assert len(blobs()) == 1, 'weekly.1 still references the blob'
+
+    store.clear('weekly.1')
+    store.commit()
+    assert blobs() == []
+
+
+def test_interrupted_ingest():
+    '''
+    An ingest that stops after saving the index is finished by the next
+    one, which stores the contents instead of deleting them
+    '''
+    if exists(ROOT): shutil.rmtree(ROOT)
+    new_file(TEMP, 'A', 'Content A')
+    new_file(TEMP, 'B', 'Content A')
+
+    class Crashing(LocalEngine):
+        def move_file(self, src, dst):
+            raise OSError('Killed')
+
+    with pytest.raises(OSError):
+        ContentStore(Crashing(), BACKUP_DIR).ingest(TEMP)
+    assert exists(join(TEMP, 'A.txt')) and exists(join(TEMP, 'B.txt'))
+
+    store = ContentStore(LocalEngine(), BACKUP_DIR)
+    assert store.tier('.temp').keys() == {'A.txt', 'B.txt'}
+    store.ingest(TEMP)
+    store.commit()
+    assert len(blobs()) == 1
+    assert not exists(join(TEMP, 'A.txt')) and not exists(join(TEMP, 'B.txt'))
+
+
+def test_unreadable_index():
+    '''
+    An index that can not be read fails the store instead of being taken
+    for an empty one and saved over
+    '''
+    if exists(ROOT): shutil.rmtree(ROOT)
+    new_file(TEMP, 'A', 'Content A')
+    store = ContentStore(LocalEngine(), BACKUP_DIR)
+    store.ingest(TEMP)
+    store.commit()
+    with open(join(BACKUP_DIR, INDEX_FILE)) as f: index = f.read()
+
+    class Unreachable(LocalEngine):
+        def read_file(self, path):
+            raise OSError('Timed out')
+
+    with pytest.raises(OSError):
+        ContentStore(Unreachable(), BACKUP_DIR)
+    with open(join(BACKUP_DIR, INDEX_FILE)) as f: assert f.read() == index
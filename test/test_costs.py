@@ -0,0 +1,67 @@
+import os
+import yaml
+import shutil
+from src.costs import *
+from src.metrics import Metrics
+from src.snapback import SnapBackUpdate, LastSnapBackData
+from local_engine import LocalEngine
+from datetime import datetime as dt
+from os.path import join, exists
+
+
+ROOT = join('test', 'test_data', 'costs')
+SOURCE = join(ROOT, 'source')
+DEST = join(ROOT, 'dest')
+DATA_FILE = join(ROOT, 'last_snapback.yaml')
+HISTORY_FILE = join(ROOT, 'costs.jsonl')
+
+
+def new_file(path, name, content=''):
+    if not exists(path): os.makedirs(path)
+    with open(join(path, name+'.txt'), 'w') as f: f.write(content)
+
+
+def test_ledger():
+    '''
+    The requests of each stage are estimated, kept on disk and projected
+    from the last updates, and spent from the budget of the run
+    '''
+    if exists(ROOT): shutil.rmtree(ROOT)
+    metrics = Metrics('job', 'dir')
+    with metrics.stage('move weekly.1 weekly.2') as record:
+        record.update(calls=1, listed=2500, renames=10, bytes=100)
+    ledger = CostLedger(HISTORY_FILE, budget=100)
+    ledger.record(metrics)
+
+    assert record['requests'] == 3 + 10 + 10 + 1
+    assert ledger.remaining() == 100 - 24
+    assert CostLedger(HISTORY_FILE).project('job', 'dir', 'move weekly.1 weekly.2') == 24
+    assert CostLedger(HISTORY_FILE).project('job', 'dir', 'copy .temp hourly.12', 2) == 2
+    assert totals(HISTORY_FILE) == {('job', 'dir'): [24, 100]}
+
+
+def test_budget():
+    '''
+    Over budget, the cold tiers do not roll and roll on a later run
+    '''
+    if exists(ROOT): shutil.rmtree(ROOT)
+    os.makedirs(ROOT)
+    with open(DATA_FILE, 'w') as f: yaml.dump({}, f)
+    new_file(SOURCE, 'A', 'Version 1')
+
+    def update(budget):
+        data = LastSnapBackData(DATA_FILE).select_job('test_job')
+        update = SnapBackUpdate(SOURCE, DEST, 'test_directory', data.fork(),
+            engine=LocalEngine(), ledger=CostLedger(HISTORY_FILE, budget),
+            clock=lambda: dt(2025, 3, 3, 12))
+        update.perform_update('12')
+        plan, = [r for r in update.metrics.stages if r['stage'] == 'plan']
+        return data.select_dir('test_directory'), plan
+
+    data, plan = update(0)
+    assert plan['deferred'] == ['year', 'month', 'week']
+    assert data['day'] == 3 and data['week'] == 0 and data['year'] == 0
+
+    data, plan = update(None)
+    assert 'deferred' not in plan
+    assert data['week'] == 10 and data['year'] == 2025
@@ -0,0 +1,66 @@
+import os
+from src.daemon import *
+from os.path import join, exists
+
+
+ROOT = join('test', 'test_data', 'daemon')
+
+
+class Clock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_slots():
+    daemon = SnapBackDaemon(['00', '12', '16', '20'], None)
+    now = dt(2025, 3, 1, 13, 30)
+    assert daemon.last_slot(now) == dt(2025, 3, 1, 12)
+    assert daemon.next_slot(now) == dt(2025, 3, 1, 16)
+    assert daemon.last_slot(dt(2025, 3, 1, 12)) == dt(2025, 3, 1, 12)
+    assert daemon.next_slot(dt(2025, 3, 1, 21)) == dt(2025, 3, 2, 0)
+    assert SnapBackDaemon(['12'], None).last_slot(dt(2025, 3, 1, 9)) == dt(2025, 2, 28, 12)
+
+
+def test_catch_up():
+    '''
+    Nothing runs on the first start, then every slot runs once, and only
+    the last of the slots missed while stopped is caught up
+    '''
+    if exists(join(ROOT, 'daemon.yaml')): os.remove(join(ROOT, 'daemon.yaml'))
+    os.makedirs(ROOT, exist_ok=True)
+    runs, clock = [], Clock(dt(2025, 3, 1, 13, 30))
+    daemon = SnapBackDaemon(['00', '12', '16', '20'], runs.append,
+        join(ROOT, 'daemon.yaml'), clock)
+
+    assert daemon.step() == 2.5 * 3600
+    assert runs == []
+
+    clock.now = dt(2025, 3, 1, 16, 0, 1)
+    assert daemon.step() == 0
+    assert daemon.step() > 0
+    assert runs == [dt(2025, 3, 1, 16)]
+
+    # Stopped for a day and a half
+    clock.now = dt(2025, 3, 3, 9)
+    daemon = SnapBackDaemon(['00', '12', '16', '20'], runs.append,
+        join(ROOT, 'daemon.yaml'), clock)
+    daemon.step()
+    daemon.step()
+    assert runs == [dt(2025, 3, 1, 16), dt(2025, 3, 3, 0)]
+
+
+def test_failed_run():
+    '''
+    A run that fails is not retried until the next slot
+    '''
+    def run(slot):
+        raise RuntimeError('rclone failed')
+    os.makedirs(ROOT, exist_ok=True)
+    daemon = SnapBackDaemon(['12'], run, join(ROOT, 'daemon.yaml'),
+        Clock(dt(2025, 3, 1, 12, 30)))
+    daemon._save(dt(2025, 2, 28, 12))
+    assert daemon.step() == 0
+    assert daemon.step() == 23.5 * 3600
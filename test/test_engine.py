@@ -0,0 +1,146 @@
+import os
+import shutil
+import pytest
+from src.engine import *
+from os.path import join, exists
+from concurrent.futures import ThreadPoolExecutor
+
+
+pytestmark = pytest.mark.skipif(
+    shutil.which('rclone') is None,
+    reason='rclone is not installed'
+)
+
+ROOT = join('test', 'test_data', 'engine')
+SOURCE = join(ROOT, 'source')
+DESTINATION = join(ROOT, 'destination')
+
+
+def new_file(path, name, content=''):
+    if not exists(path): os.makedirs(path)
+    with open(join(path, name+'.txt'), 'w') as f: f.write(content)
+
+def read_file(path, name):
+    with open(join(path, name+'.txt'), 'r') as f: return f.read()
+
+
+@pytest.fixture(params=['subprocess', 'daemon'])
+def engine(request):
+    if exists(ROOT): shutil.rmtree(ROOT)
+    with create_engine(request.param) as engine:
+        assert engine.name == request.param
+        yield engine
+
+
+def test_sync_with_backup_dir(engine):
+    '''
+    Replaced and deleted files must end up in the backup directory
+    '''
+    new_file(join(DESTINATION, 'main'), 'A', 'Old A')
+    new_file(join(DESTINATION, 'main'), 'C', 'Deleted C')
+    new_file(SOURCE, 'A', 'New A')
+    new_file(SOURCE, 'B', 'B')
+    new_file(join(SOURCE, 'excluded'), 'D', 'D')
+
+    engine.mkdir(temp := join(DESTINATION, '.temp'))
+    engine.sync(SOURCE, join(DESTINATION, 'main'),
+        backup_dir=temp, exclude=['excluded/**'], fast_list=True
+    )
+
+    assert read_file(join(DESTINATION, 'main'), 'A') == 'New A'
+    assert read_file(join(DESTINATION, 'main'), 'B') == 'B'
+    assert not exists(join(DESTINATION, 'main', 'excluded'))
+    assert read_file(temp, 'A') == 'Old A'
+    assert read_file(temp, 'C') == 'Deleted C'
+
+
+def test_tier_operations(engine):
+    '''
+    copy, copy ignoring existing files, move and delete between directories
+    '''
+    new_file(a := join(DESTINATION, 'a'), 'A', 'New A')
+    new_file(a, 'B', 'B')
+    new_file(b := join(DESTINATION, 'b'), 'A', 'Old A')
+
+    engine.copy(a, b, ignore_existing=True)
+    assert read_file(b, 'A') == 'Old A'
+    assert read_file(b, 'B') == 'B'
+
+    engine.delete(a)
+    assert not exists(join(a, 'A.txt'))
+
+    engine.move(b, c := join(DESTINATION, 'c'))
+    assert read_file(c, 'A') == 'Old A'
+    assert not exists(join(b, 'A.txt'))
+
+
+def test_stats(engine):
+    '''
+    Transfers return the stats rclone kept for them
+    '''
+    new_file(a := join(DESTINATION, 'a'), 'A', 'Twelve bytes')
+    new_file(a, 'B', 'B')
+
+    stats = engine.copy(a, b := join(DESTINATION, 'b'))
+    assert (stats['transfers'], stats['bytes']) == (2, 13)
+    assert engine.delete(b)['deletes'] == 2
+
+
+def test_accumulate(engine):
+    '''
+    New files are moved, files dst already has are discarded with src
+    '''
+    new_file(a := join(DESTINATION, 'a'), 'A', 'New A')
+    new_file(join(a, 'sub'), 'B', 'B')
+    new_file(b := join(DESTINATION, 'b'), 'A', 'Old A')
+
+    engine.accumulate(a, b)
+    assert read_file(b, 'A') == 'Old A'
+    assert read_file(join(b, 'sub'), 'B') == 'B'
+    assert not exists(a)
+    engine.purge(a)
+
+
+def test_iter_list(engine):
+    '''
+    Streamed listings hold the same entries as full ones, a missing
+    directory has none and a listing can be left unfinished
+    '''
+    new_file(join(SOURCE, 'sub'), 'A', 'A')
+    new_file(SOURCE, 'B', 'B')
+    assert sorted(e['Path'] for e in engine.iter_list(SOURCE)) == ['B.txt', 'sub/A.txt']
+    assert sorted(e['Path'] for e in engine.list(SOURCE)) == ['B.txt', 'sub/A.txt']
+    assert list(engine.iter_list(join(ROOT, 'missing'))) == []
+    listing = engine.iter_list(SOURCE)
+    assert next(listing)['Path'] in ('B.txt', 'sub/A.txt')
+    listing.close()
+
+
+def test_read_file(engine):
+    '''
+    Reading a file that does not exist returns None, any other error is
+    raised instead of being taken for a missing file
+    '''
+    new_file(SOURCE, 'A', 'Contents of A')
+    assert engine.read_file(join(SOURCE, 'A.txt')) == 'Contents of A'
+    assert engine.read_file(join(SOURCE, 'missing.txt')) is None
+    assert engine.read_file(join(ROOT, 'missing', 'A.txt')) is None
+    with pytest.raises(RcloneError):
+        engine.read_file('unconfigured-remote:A.txt')
+
+
+def test_private_directory():
+    '''
+    Workers sharing an engine create a single private directory, removed
+    when the engine is closed and created again if it is used after
+    '''
+    engine = SubprocessEngine()
+    with ThreadPoolExecutor(8) as pool:
+        files = list(pool.map(lambda _: engine._temp_file('.txt'), range(32)))
+    assert {os.path.dirname(file) for _, file in files} == {engine.tempdir}
+    for fd, _ in files: os.close(fd)
+    tempdir = engine.tempdir
+    engine.close()
+    assert engine.tempdir is None and not exists(tempdir)
+    engine._list_file(['A.txt'])
+    engine.close()
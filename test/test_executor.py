@@ -0,0 +1,56 @@
+import time
+import threading
+from src.executor import *
+
+
+def test_remote_limits():
+    '''
+    Check that no more tasks than the remote limit run at the same time
+    against the same remote, while different remotes run in parallel
+    '''
+    lock = threading.Lock()
+    running = {'a': 0, 'b': 0}
+    peak = {'a': 0, 'b': 0}
+
+    def task(remote):
+        with lock:
+            running[remote] += 1
+            peak[remote] = max(peak[remote], running[remote])
+        time.sleep(0.05)
+        with lock:
+            running[remote] -= 1
+
+    with SnapBackExecutor(max_workers=4, remote_limits={'a': 1}) as executor:
+        for _ in range(4):
+            executor.submit('a', task, 'a')
+            executor.submit('b', task, 'b')
+
+    assert peak['a'] == 1, 'Remote "a" should never run two tasks at once'
+    assert peak['b'] > 1, 'Remote "b" should run tasks concurrently'
+
+
+def test_wall_time():
+    '''
+    Check that the total time is close to the slowest task and not the sum
+    '''
+    start = time.time()
+    with SnapBackExecutor(max_workers=6) as executor:
+        for i in range(6):
+            executor.submit(f'remote{i % 3}', time.sleep, 0.1)
+    assert time.time() - start < 0.3
+
+
+def test_errors():
+    '''
+    Check that failing tasks are reported without stopping the others
+    '''
+    def fail(): raise RuntimeError('failure')
+
+    executor = SnapBackExecutor(max_workers=2)
+    executor.submit('a', fail)
+    ok = executor.submit('a', lambda: 'done')
+    errors = executor.wait()
+    executor.shutdown()
+
+    assert len(errors) == 1
+    assert ok.result() == 'done'
@@ -0,0 +1,76 @@
+import os
+import yaml
+import shutil
+from src.hash_cache import *
+from src.snapback import SnapBackUpdate, LastSnapBackData
+from local_engine import LocalEngine
+from os.path import join, exists
+
+
+ROOT = join('test', 'test_data', 'hash_cache')
+SOURCE = join(ROOT, 'source')
+DEST = join(ROOT, 'dest')
+DATA_FILE = join(ROOT, 'last_snapback.yaml')
+
+
+def new_file(path, name, content=''):
+    if not exists(path): os.makedirs(path)
+    with open(join(path, name+'.txt'), 'w') as f: f.write(content)
+
+def read_file(path, name):
+    with open(join(path, name+'.txt'), 'r') as f: return f.read()
+
+
+def test_cache():
+    '''
+    Files are only read again when their stat signature changed
+    '''
+    if exists(ROOT): shutil.rmtree(ROOT)
+    new_file(SOURCE, 'A', 'A')
+    new_file(SOURCE, 'B', 'B' * (2 << 20))
+    paths = {name: join(SOURCE, name + '.txt') for name in 'AB'}
+
+    with HashCache(join(ROOT, 'hashes.db'), large=1 << 20) as cache:
+        hashes = cache.hash_files(paths)
+        assert hashes['A'] == hash_file(paths['A'])
+        assert (cache.hits, cache.misses) == (0, 2)
+
+    with HashCache(join(ROOT, 'hashes.db')) as cache:
+        assert cache.hash_files(paths) == hashes
+        assert (cache.hits, cache.misses) == (2, 0)
+
+        os.utime(paths['A'], ns=(0, 0))
+        assert cache.hash(paths['A']) == hashes['A']
+        assert (cache.hits, cache.misses) == (2, 1)
+
+    with HashCache(join(ROOT, 'hashes.db'), 'md5') as cache:
+        assert cache.hash(paths['A']) == hash_file(paths['A'], 'md5')
+        assert cache.misses == 1
+
+
+def test_checksum_detection():
+    '''
+    Touched files are not transferred again, changed ones are
+    '''
+    if exists(ROOT): shutil.rmtree(ROOT)
+    os.makedirs(ROOT)
+    with open(DATA_FILE, 'w') as f: yaml.dump({}, f)
+
+    def update():
+        data = LastSnapBackData(DATA_FILE).select_job('test_job')
+        update = SnapBackUpdate(SOURCE, DEST, 'test_directory', data.fork(),
+            engine=LocalEngine(), change_detection='checksum')
+        update.perform_update('12')
+        return update
+
+    new_file(SOURCE, 'A', 'Version 1')
+    new_file(SOURCE, 'B', 'Version 1')
+    update()
+
+    os.utime(join(SOURCE, 'A.txt'), ns=(10**18, 10**18))
+    new_file(SOURCE, 'B', 'Version 2')
+    update()
+    temp = join(DEST, '.snapbacks', 'test_directory', 'hourly.12')
+    assert os.listdir(temp) == ['B.txt']
+    assert read_file(temp, 'B') == 'Version 1'
+    assert read_file(join(DEST, 'test_directory'), 'B') == 'Version 2'
@@ -0,0 +1,62 @@
+import os
+import shutil
+import pytest
+from src.listing_cache import *
+from local_engine import LocalEngine
+from os.path import join, exists
+
+
+ROOT = join('test', 'test_data', 'listing_cache')
+BACKUP = join(ROOT, '.snapbacks', 'dir')
+
+
+def new_file(path, name, content=''):
+    if not exists(path): os.makedirs(path)
+    with open(join(path, name+'.txt'), 'w') as f: f.write(content)
+
+
+def paths(engine, path):
+    return sorted((e['Path'], e['Size']) for e in engine.list(path))
+
+
+def test_listing_cache():
+    '''
+    Listings are answered from memory after the first one and stay the
+    ones the engine would give through the operations of an update
+    '''
+    if exists(ROOT): shutil.rmtree(ROOT)
+    new_file(join(BACKUP, '.temp'), 'A', 'A temp')
+    new_file(join(BACKUP, '.temp', 'sub'), 'B', 'B temp')
+    new_file(join(BACKUP, 'daily.1'), 'A', 'A daily')
+    new_file(join(BACKUP, 'daily.1'), 'C', 'C daily')
+    engine, real = ListingCache(LocalEngine()), LocalEngine()
+
+    def check():
+        for tier in ('.temp', 'daily.1', 'daily.2', 'hourly.12'):
+            assert paths(engine, join(BACKUP, tier)) == paths(real, join(BACKUP, tier))
+
+    engine.list(BACKUP)
+    check()
+    assert engine.misses == 1
+
+    engine.mkdir(join(BACKUP, 'hourly.12'))
+    engine.copy(join(BACKUP, '.temp'), join(BACKUP, 'hourly.12'))
+    check()
+    engine.move(join(BACKUP, 'daily.1'), join(BACKUP, 'daily.2'))
+    check()
+    engine.accumulate(join(BACKUP, '.temp'), join(BACKUP, 'daily.2'))
+    check()
+    engine.delete(join(BACKUP, 'hourly.12'), files_from=['sub/B.txt'])
+    engine.move_file(join(BACKUP, 'daily.2', 'C.txt'), join(BACKUP, 'daily.2', 'D.txt'))
+    engine.delete_file(join(BACKUP, 'daily.2', 'A.txt'))
+    check()
+    assert engine.misses == 1
+
+    engine.write_file(join(BACKUP, 'daily.2', 'E.txt'), 'written')
+    check()
+    assert engine.misses == 1 + 4
+
+    with pytest.raises(OSError):
+        engine.move_file(join(BACKUP, 'missing'), join(BACKUP, 'daily.2', 'F.txt'))
+    assert engine._view(join(BACKUP, 'daily.2')) is None
+    check()
@@ -0,0 +1,93 @@
+import os
+import time
+import shutil
+import pytest
+from src.local_engine import *
+from os.path import join, exists
+
+
+ROOT = join('test', 'test_data', 'local_engine')
+SOURCE = join(ROOT, 'source')
+DESTINATION = join(ROOT, 'destination')
+
+
+def new_file(path, name, content=''):
+    if not exists(path): os.makedirs(path)
+    with open(join(path, name+'.txt'), 'w') as f: f.write(content)
+
+def read_file(path, name):
+    with open(join(path, name+'.txt'), 'r') as f: return f.read()
+
+def inode(path, name):
+    return os.stat(join(path, name+'.txt')).st_ino
+
+
+def test_sync():
+    '''
+    Replaced and deleted files are renamed into the backup directory and
+    excluded files are left alone
+    '''
+    if exists(ROOT): shutil.rmtree(ROOT)
+    new_file(main := join(DESTINATION, 'main'), 'A', 'Old A')
+    new_file(main, 'C', 'Deleted C')
+    time.sleep(0.01)
+    new_file(SOURCE, 'A', 'New A')
+    new_file(SOURCE, 'B', 'B')
+    new_file(join(SOURCE, 'excluded'), 'D', 'D')
+    old_a = inode(main, 'A')
+
+    LocalEngine().sync(SOURCE, main,
+        backup_dir=(temp := join(DESTINATION, '.temp')),
+        exclude=['excluded/**'], links=True
+    )
+
+    assert read_file(main, 'A') == 'New A'
+    assert read_file(main, 'B') == 'B'
+    assert not exists(join(main, 'C.txt'))
+    assert not exists(join(main, 'excluded'))
+    assert read_file(temp, 'A') == 'Old A'
+    assert inode(temp, 'A') == old_a, 'The old version should be renamed, not copied'
+    assert read_file(temp, 'C') == 'Deleted C'
+
+
+def test_sync_unreadable_source(monkeypatch):
+    '''
+    Files of a source directory that can not be read are not deleted
+    '''
+    if exists(ROOT): shutil.rmtree(ROOT)
+    new_file(join(SOURCE, 'a'), 'A', 'A')
+    new_file(join(SOURCE, 'b'), 'B', 'B')
+    LocalEngine().sync(SOURCE, main := join(DESTINATION, 'main'))
+    scandir = os.scandir
+
+    def faulty(path):
+        if os.path.basename(path.rstrip('/')) == 'b': raise PermissionError(path)
+        return scandir(path)
+
+    monkeypatch.setattr(os, 'scandir', faulty)
+    with pytest.raises(OSError):
+        LocalEngine().sync(SOURCE, main)
+    assert read_file(join(main, 'b'), 'B') == 'B'
+
+
+def test_tiers_share_inodes():
+    '''
+    Copies and accumulations between snapbacks are hard links
+    '''
+    if exists(ROOT): shutil.rmtree(ROOT)
+    new_file(temp := join(DESTINATION, '.temp'), 'A', 'New A')
+    new_file(temp, 'B', 'B')
+    new_file(daily := join(DESTINATION, 'daily.1'), 'A', 'Old A')
+    engine = LocalEngine()
+
+    engine.copy(temp, hourly := join(DESTINATION, 'hourly.12'))
+    assert inode(hourly, 'A') == inode(temp, 'A')
+
+    engine.accumulate(temp, daily)
+    assert read_file(daily, 'A') == 'Old A'
+    assert inode(daily, 'B') == inode(hourly, 'B')
+    assert not exists(temp)
+
+    engine.move(daily, daily2 := join(DESTINATION, 'daily.2'))
+    assert read_file(daily2, 'A') == 'Old A'
+    assert not exists(join(daily, 'A.txt'))
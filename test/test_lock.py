@@ -0,0 +1,18 @@
+import os
+import pytest
+from src.lock import *
+from os.path import join
+
+
+ROOT = join('test', 'test_data', 'lock')
+
+
+def test_single_holder():
+    os.makedirs(ROOT, exist_ok=True)
+    file = join(ROOT, 'snapback.lock')
+    with FileLock(file, blocking=False):
+        assert FileLock(file).owner() == str(os.getpid())
+        with pytest.raises(Locked):
+            FileLock(file, blocking=False).acquire()
+    # Released at the end of the block
+    FileLock(file, blocking=False).acquire().release()
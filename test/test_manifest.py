@@ -0,0 +1,163 @@
+import os
+import time
+import shutil
+import pytest
+from src.manifest import *
+from os.path import join, exists
+
+
+ROOT = join('test', 'test_data', 'manifest')
+SOURCE = join(ROOT, 'source')
+DESTINATION = join(ROOT, 'destination')
+DIRECTORY = 'test_directory'
+
+
+def new_file(path, name, content=''):
+    if not exists(path): os.makedirs(path)
+    with open(join(path, name+'.txt'), 'w') as f: f.write(content)
+
+def read_file(path, name):
+    with open(join(path, name+'.txt'), 'r') as f: return f.read()
+
+
+def test_exclude_filter():
+    excluded = ExcludeFilter(['exclude1/*', '/top/**', '*.tmp'])
+    assert excluded('exclude1/A.txt')
+    assert excluded('sub/exclude1/A.txt')
+    assert not excluded('exclude1/sub/A.txt'), '* should not cross directories'
+    assert not excluded('exclude1', is_dir=True)
+    assert excluded('top', is_dir=True)
+    assert not excluded('sub/top', is_dir=True), '/ should anchor to the root'
+    assert excluded('a/b.tmp')
+
+
+def test_scan_and_diff():
+    if exists(ROOT): shutil.rmtree(ROOT)
+    new_file(SOURCE, 'A', 'A')
+    new_file(SOURCE, 'B', 'B')
+    new_file(join(SOURCE, 'exclude2'), 'C', 'C')
+
+    entries = scan(SOURCE, exclude=['exclude2/**'])
+    assert set(entries) == {'A.txt', 'B.txt'}
+
+    manifest = SourceManifest(file := join(ROOT, 'manifest.json'))
+    assert manifest.entries is None
+    manifest.save(entries)
+
+    time.sleep(0.01)
+    new_file(SOURCE, 'A', 'A modified')
+    os.remove(join(SOURCE, 'B.txt'))
+    new_file(join(SOURCE, 'sub'), 'D', 'D')
+
+    changed, deleted = SourceManifest(file).diff(scan(SOURCE, ['exclude2/**']))
+    assert sorted(changed) == ['A.txt', 'sub/D.txt']
+    assert deleted == ['B.txt']
+
+
+@pytest.mark.skipif(shutil.which('rclone') is None, reason='rclone is not installed')
+def test_incremental_sync():
+    '''
+    Only changed files are transferred, replaced and deleted files go to
+    .temp and a run without changes is skipped
+    '''
+    from src.snapback import SnapBackUpdate, LastSnapBackData
+
+    if exists(ROOT): shutil.rmtree(ROOT)
+    os.makedirs(ROOT)
+    new_file(SOURCE, 'A', 'Old A')
+    new_file(SOURCE, 'B', 'B')
+    data = LastSnapBackData(join(ROOT, 'last_snapback.yaml')).select_job('test_job')
+
+    def sync():
+        return SnapBackUpdate(SOURCE, DESTINATION, DIRECTORY, data,
+            change_detection='manifest')._sync()
+
+    assert sync()
+    assert exists(join(ROOT, 'last_snapback.manifests', 'test_job', DIRECTORY + '.json'))
+    assert not sync(), 'Nothing changed'
+
+    time.sleep(0.01)
+    new_file(SOURCE, 'A', 'New A')
+    os.remove(join(SOURCE, 'B.txt'))
+    assert sync()
+
+    temp = join(DESTINATION, '.snapbacks', DIRECTORY, '.temp')
+    assert read_file(join(DESTINATION, DIRECTORY), 'A') == 'New A'
+    assert not exists(join(DESTINATION, DIRECTORY, 'B.txt'))
+    assert read_file(temp, 'A') == 'Old A'
+    assert read_file(temp, 'B') == 'B'
+
+
+def test_incremental_sync_scan_errors(monkeypatch):
+    '''
+    Files missed by a scan with errors are not deleted and the manifest is
+    not saved
+    '''
+    from src.snapback import SnapBackUpdate, LastSnapBackData
+
+    if exists(ROOT): shutil.rmtree(ROOT)
+    os.makedirs(ROOT)
+    new_file(SOURCE, 'A', 'A')
+    new_file(join(SOURCE, 'b'), 'B', 'B')
+    data = LastSnapBackData(join(ROOT, 'last_snapback.yaml')).select_job('test_job')
+    manifest_file = join(ROOT, 'last_snapback.manifests', 'test_job', DIRECTORY + '.json')
+
+    def sync():
+        return SnapBackUpdate(SOURCE, DESTINATION, DIRECTORY, data,
+            change_detection='manifest')._sync()
+
+    assert sync()
+    saved = SourceManifest(manifest_file).entries
+    scandir = os.scandir
+
+    def faulty(path):
+        if os.path.basename(path.rstrip('/')) == 'b': raise PermissionError(path)
+        return scandir(path)
+
+    monkeypatch.setattr(os, 'scandir', faulty)
+    time.sleep(0.01)
+    new_file(SOURCE, 'C', 'C')
+    errors = []
+    assert SourceManifest(manifest_file).diff(scan(SOURCE, errors=errors), errors) == (['C.txt'], [])
+    assert sync()
+    assert read_file(join(DESTINATION, DIRECTORY, 'b'), 'B') == 'B'
+    assert read_file(join(DESTINATION, DIRECTORY), 'C') == 'C'
+    assert SourceManifest(manifest_file).entries == saved
+
+
+@pytest.mark.skipif(shutil.which('rclone') is None, reason='rclone is not installed')
+def test_incremental_sync_links():
+    '''
+    Symlinks, which rclone stores as <name>.rclonelink files, are
+    transferred, replaced and deleted like files
+    '''
+    from src.snapback import SnapBackUpdate, LastSnapBackData
+
+    if exists(ROOT): shutil.rmtree(ROOT)
+    os.makedirs(ROOT)
+    new_file(SOURCE, 'A', 'A')
+    new_file(SOURCE, 'B', 'B')
+    os.symlink('A.txt', join(SOURCE, 'L'))
+    data = LastSnapBackData(join(ROOT, 'last_snapback.yaml')).select_job('test_job')
+    main = join(DESTINATION, DIRECTORY)
+    temp = join(DESTINATION, '.snapbacks', DIRECTORY, '.temp')
+
+    def sync():
+        return SnapBackUpdate(SOURCE, DESTINATION, DIRECTORY, data,
+            change_detection='manifest', local_engine='rclone')._sync()
+
+    assert sync()
+    assert os.readlink(join(main, 'L')) == 'A.txt'
+
+    time.sleep(0.01)
+    os.remove(join(SOURCE, 'L'))
+    os.symlink('B.txt', join(SOURCE, 'L'))
+    assert sync()
+    assert os.readlink(join(main, 'L')) == 'B.txt'
+    assert os.readlink(join(temp, 'L')) == 'A.txt'
+
+    shutil.rmtree(temp)
+    os.remove(join(SOURCE, 'L'))
+    assert sync()
+    assert not os.path.lexists(join(main, 'L'))
+    assert os.readlink(join(temp, 'L')) == 'B.txt'
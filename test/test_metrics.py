@@ -0,0 +1,79 @@
+import os
+import json
+import shutil
+import pytest
+from src.metrics import *
+from src.local_engine import LocalEngine
+from os.path import join, exists
+
+
+ROOT = join('test', 'test_data', 'metrics')
+
+
+def new_file(path, name, content=''):
+    if not exists(path): os.makedirs(path)
+    with open(join(path, name+'.txt'), 'w') as f: f.write(content)
+
+
+def test_stages():
+    '''
+    Engine calls are counted in the stage running them, failures included
+    '''
+    if exists(ROOT): shutil.rmtree(ROOT)
+    new_file(a := join(ROOT, 'a'), 'A', 'Twelve bytes')
+    new_file(a, 'B', '')
+    metrics = Metrics('job', 'dir')
+    engine = MeteredEngine(LocalEngine(), metrics)
+
+    engine.list(a)
+    with metrics.stage('copy'):
+        engine.copy(a, join(ROOT, 'b'))
+    with pytest.raises(OSError):
+        with metrics.stage('move'):
+            engine.move_file(join(ROOT, 'missing'), join(ROOT, 'c'))
+    metrics.finish('move')
+
+    other, copy, move = metrics.stages
+    assert (other['stage'], other['calls'], other['listed']) == (OTHER, 1, 2)
+    assert (copy['calls'], copy['files'], copy['bytes']) == (1, 2, 12)
+    assert move['failed'] and move['errors'] == 1 and not copy['failed']
+    assert metrics.to_dict()['success'] is False
+
+
+def test_streamed_listing():
+    '''
+    A streamed listing is counted once consumed, in the stage consuming it
+    '''
+    if exists(ROOT): shutil.rmtree(ROOT)
+    new_file(a := join(ROOT, 'a'), 'A')
+    new_file(a, 'B')
+    metrics = Metrics('job', 'dir')
+    engine = MeteredEngine(LocalEngine(), metrics)
+
+    with metrics.stage('catalog'):
+        assert len(list(engine.iter_list(a))) == 2
+    catalog, = metrics.stages
+    assert (catalog['calls'], catalog['listed'], catalog['errors']) == (1, 2, 0)
+
+
+def test_export():
+    if exists(ROOT): shutil.rmtree(ROOT)
+    os.makedirs(ROOT)
+    metrics = Metrics('job', 'my "dir"')
+    for _ in range(2):
+        with metrics.stage('sync'):
+            metrics.count(calls=1, stats={'transfers': 3, 'bytes': 10})
+    metrics.finish()
+
+    export([metrics], {
+        'json_lines': (lines := join(ROOT, 'metrics.jsonl')),
+        'textfile': (textfile := join(ROOT, 'snapback.prom'))
+    })
+    with open(lines) as f:
+        assert json.loads(f.readline())['stages'][1]['files'] == 3
+    with open(textfile) as f:
+        text = f.read()
+    # Stages run twice are added up, a series can only appear once
+    assert 'snapback_stage_files{job="job",dir="my \\"dir\\"",stage="sync"} 6\n' in text
+    assert 'snapback_update_success{job="job",dir="my \\"dir\\""} 1\n' in text
+    assert 'sync' in summary([metrics])
@@ -0,0 +1,118 @@
+import os
+import yaml
+import shutil
+from src.packing import *
+from src.restore import SnapBackRestore
+from src.snapback import SnapBackUpdate, LastSnapBackData
+from local_engine import LocalEngine
+from datetime import datetime as dt
+from os.path import join, exists
+
+
+ROOT = join('test', 'test_data', 'packing')
+SOURCE = join(ROOT, 'source')
+DEST = join(ROOT, 'dest')
+SNAPBACKS = join(DEST, '.snapbacks', 'test_directory')
+TARGET = join(ROOT, 'target')
+DATA_FILE = join(ROOT, 'last_snapback.yaml')
+
+
+def new_file(path, name, content=''):
+    if not exists(path): os.makedirs(path)
+    with open(join(path, name+'.txt'), 'w') as f: f.write(content)
+
+def read_file(path, name):
+    with open(join(path, name+'.txt'), 'r') as f: return f.read()
+
+
+def test_pack():
+    '''
+    Small files are packed and read back one by one, and the files a
+    packed snapback holds win over the ones accumulated into it
+    '''
+    if exists(ROOT): shutil.rmtree(ROOT)
+    new_file(join(SNAPBACKS, 'monthly.1'), 'A', 'A monthly')
+    new_file(join(SNAPBACKS, 'monthly.1', 'sub'), 'B', 'B monthly')
+    new_file(join(SNAPBACKS, 'monthly.1'), 'Large', 'L' * 200)
+    packs = PackStore(LocalEngine(), SNAPBACKS, max_size=100)
+
+    assert packs.pack('monthly.1') == 2
+    assert sorted(os.listdir(join(SNAPBACKS, 'monthly.1'))) == ['.packs', 'Large.txt']
+    files = packs.files('monthly.1')
+    assert sorted(files) == ['A.txt', 'sub/B.txt']
+    assert packs.read(files['sub/B.txt']) == b'B monthly'
+
+    new_file(join(SNAPBACKS, 'weekly.1'), 'A', 'A weekly')
+    new_file(join(SNAPBACKS, 'weekly.1'), 'C', 'C weekly')
+    packs.pack('weekly.1')
+    new_file(join(SNAPBACKS, 'weekly.1', 'sub'), 'B', 'B weekly')
+    packs.merge('weekly.1', 'monthly.1')
+    files = packs.files('monthly.1')
+    assert sorted(files) == ['A.txt', 'C.txt', 'sub/B.txt']
+    assert packs.read(files['A.txt']) == b'A monthly'
+    assert not os.listdir(join(SNAPBACKS, 'weekly.1', '.packs'))
+    assert not exists(join(SNAPBACKS, 'weekly.1', 'sub', 'B.txt'))
+
+
+def test_repack():
+    '''
+    Packing the files moved into a snapback that already holds packs
+    drops the versions they replace, so every path has a single entry
+    '''
+    if exists(ROOT): shutil.rmtree(ROOT)
+    new_file(join(SNAPBACKS, 'monthly.1'), 'A', 'A old')
+    new_file(join(SNAPBACKS, 'monthly.1'), 'B', 'B old')
+    packs = PackStore(LocalEngine(), SNAPBACKS, max_size=100)
+    packs.pack('monthly.1')
+
+    new_file(join(SNAPBACKS, 'monthly.1'), 'A', 'A new')
+    new_file(join(SNAPBACKS, 'monthly.1'), 'C', 'C new')
+    new_file(join(SNAPBACKS, 'monthly.1'), 'Large', 'L' * 200)
+    assert packs.pack('monthly.1') == 2
+    indexes = packs.indexes('monthly.1')
+    assert sorted(path for index in indexes.values() for path in index['files']) == \
+        ['A.txt', 'B.txt', 'C.txt']
+    files = packs.files('monthly.1')
+    assert packs.read(files['A.txt']) == b'A new'
+    assert packs.read(files['B.txt']) == b'B old'
+
+    # A large file moved in stays loose and replaces the packed version
+    new_file(join(SNAPBACKS, 'monthly.1'), 'B', 'B' * 200)
+    assert packs.pack('monthly.1') == 0
+    assert sorted(packs.files('monthly.1')) == ['A.txt', 'C.txt']
+
+    # Of the packs holding the same path, the newest one wins
+    new_file(join(ROOT, 'staging'), 'A', 'A newest')
+    packs._write_pack(join(ROOT, 'staging'), 'monthly.1',
+        [{'Path': 'A.txt', 'ModTime': '2025-03-03T12:00:00+00:00'}])
+    assert packs.read(packs.files('monthly.1')['A.txt']) == b'A newest'
+
+
+def test_update_restore():
+    '''
+    The files accumulated into a packed tier are packed and restored
+    '''
+    if exists(ROOT): shutil.rmtree(ROOT)
+    os.makedirs(ROOT)
+    with open(DATA_FILE, 'w') as f: yaml.dump({}, f)
+
+    def update(hour, now):
+        data = LastSnapBackData(DATA_FILE).select_job('test_job')
+        SnapBackUpdate(SOURCE, DEST, 'test_directory', data.fork(), engine=LocalEngine(),
+            pack={'tiers': ['weekly']}, clock=lambda: now).perform_update(hour)
+
+    new_file(SOURCE, 'A', 'Version 1')
+    new_file(SOURCE, 'B', 'Version 1')
+    update('12', dt(2025, 3, 3, 12))
+    new_file(SOURCE, 'A', 'Version 2')
+    new_file(SOURCE, 'B', 'Version 2')
+    update('16', dt(2025, 3, 3, 16))
+    new_file(SOURCE, 'A', 'Version 3')
+    new_file(SOURCE, 'B', 'Version 3')
+    update('12', dt(2025, 3, 4, 12))
+
+    assert os.listdir(join(SNAPBACKS, 'weekly.1')) == ['.packs']
+    restore = SnapBackRestore(DEST, 'test_directory', engine=LocalEngine())
+    assert restore.restore('weekly.1', TARGET, hour=13) == []
+    assert read_file(TARGET, 'A') == 'Version 2'
+    assert read_file(TARGET, 'B') == 'Version 2'
@@ -0,0 +1,66 @@
+from src.planner import *
+
+
+ALL_TIERS = {f'{tier}.{i}' for tier, n in TIERS.items() for i in range(1, n+1)}
+
+
+def kinds(ops):
+    return [repr(op) for op in ops if op.kind != 'state']
+
+
+def test_schedule():
+    '''
+    Without knowledge the plan is the sequence of the update
+    '''
+    ops = schedule('hourly.12', {'day': 5}, 'move')
+    assert kinds(ops) == [
+        'copy .temp -> hourly.12',
+        'move daily.2 -> daily.3',
+        'move daily.1 -> daily.2',
+        'accumulate .temp -> daily.1',
+        'accumulate daily.1 -> weekly.1',
+    ]
+    assert kinds(schedule(None, {}, 'move')) == ['accumulate .temp -> daily.1']
+
+
+def test_mkdir():
+    '''
+    Sources are created unless known to hold files, and only once
+    '''
+    ops = optimize(schedule('hourly.12', {}, 'move'))
+    assert kinds(ops) == ['copy .temp -> hourly.12', 'accumulate .temp -> daily.1']
+
+    ops = optimize(schedule(None, {'day': 5}, 'move'))
+    assert [repr(op) for op in ops].count('mkdir daily.1') == 1
+    assert optimize(schedule(None, {'day': 5}, 'move'), storage='content')[0].kind != 'mkdir'
+
+
+def test_empty_temp():
+    '''
+    Nothing is copied or accumulated from an empty .temp, the rotations
+    and state changes still happen
+    '''
+    ops = plan('hourly.12', {'day': 5}, 'manifest', empty={'.temp'})
+    assert kinds(ops) == ['rotate daily'], 'daily.1 is empty after the rotation'
+    assert Operation('state', 'day', value=5) in ops
+
+
+def test_fusion():
+    '''
+    Accumulating into empty snapbacks becomes a single move
+    '''
+    ops = plan(None, {'day': 5}, 'move', empty=ALL_TIERS, full={'.temp'})
+    assert kinds(ops) == ['move .temp -> weekly.1']
+    assert cost(ops) < cost(schedule(None, {'day': 5}, 'move'))
+
+    # Unknown weekly.1: the files are accumulated straight from .temp
+    ops = plan(None, {'day': 5}, 'move', empty=ALL_TIERS - {'weekly.1'}, full={'.temp'})
+    assert kinds(ops) == ['accumulate .temp -> weekly.1']
+
+
+def test_dependencies():
+    ops = plan('hourly.12', {'day': 5}, 'manifest')
+    rotate = next(i for i, op in enumerate(ops) if op.kind == 'rotate')
+    state = next(op for op in ops if op.kind == 'state')
+    assert rotate in state.deps
+    assert all(j < i for i, op in enumerate(ops) for j in op.deps)
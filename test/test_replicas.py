@@ -0,0 +1,69 @@
+import os
+import yaml
+import shutil
+import replicas
+from src.snapback import SnapBackJob, LastSnapBackData
+from datetime import datetime as dt
+from os.path import join, exists
+
+
+ROOT = join('test', 'test_data', 'replicas')
+SOURCE = join(ROOT, 'source')
+DATA_FILE = join(ROOT, 'last_snapback.yaml')
+
+
+def new_file(path, name, content=''):
+    if not exists(path): os.makedirs(path)
+    with open(join(path, name+'.txt'), 'w') as f: f.write(content)
+
+def read_file(path, name):
+    with open(join(path, name+'.txt'), 'r') as f: return f.read()
+
+def run(job_data, hour, now):
+    data = LastSnapBackData(DATA_FILE)
+    SnapBackJob('test_job', job_data, data, clock=lambda: now).perform(hour)
+    return data
+
+
+def test_names():
+    job_data = {'destination': ['remote:backup', 'nas:/srv/backup']}
+    assert replicas.replicas('job', job_data) == [
+        ('job', 'remote:backup'), ('job@nas_srv_backup', 'nas:/srv/backup')
+    ]
+    assert replicas.destinations({'destination': 'remote:backup'}) == ['remote:backup']
+
+
+def test_replication(monkeypatch):
+    '''
+    Every replica gets the files and its own snapbacks and state, while the
+    source is scanned once per run
+    '''
+    scans = []
+    scan = replicas.scan_tree
+    monkeypatch.setattr(replicas, 'scan_tree', lambda *args: scans.append(args) or scan(*args))
+
+    for replication in replicas.REPLICATIONS:
+        if exists(ROOT): shutil.rmtree(ROOT)
+        os.makedirs(ROOT)
+        with open(DATA_FILE, 'w') as f: yaml.dump({}, f)
+        dests = [join(ROOT, 'primary'), join(ROOT, 'replica')]
+        job_data = {
+            'destination': dests,
+            'replication': replication,
+            'change_detection': 'manifest',
+            'directories': {'test_directory': SOURCE}
+        }
+
+        new_file(SOURCE, 'A', 'Version 1')
+        run(job_data, '12', dt(2025, 3, 3, 12))
+        new_file(SOURCE, 'A', 'Version 2')
+        scans.clear()
+        data = run(job_data, '16', dt(2025, 3, 3, 16))
+        assert len(scans) == 1
+
+        for dest in dests:
+            assert read_file(join(dest, 'test_directory'), 'A') == 'Version 2'
+            assert read_file(join(dest, '.snapbacks', 'test_directory', 'hourly.16'), 'A') == 'Version 1'
+        for name, _ in replicas.replicas('test_job', job_data):
+            assert data.data[name]['test_directory']['day'] == 3
+            assert data.data[name]['test_directory']['success']
@@ -0,0 +1,74 @@
+import os
+import shutil
+from src.restore import *
+from src.local_engine import LocalEngine
+from os.path import join, exists
+
+
+ROOT = join('test', 'test_data', 'restore')
+DEST = join(ROOT, 'dest')
+BACKUP_DIR = join(DEST, '.snapbacks', 'test_directory')
+TARGET = join(ROOT, 'target')
+
+
+def new_file(path, name, content=''):
+    if not exists(path): os.makedirs(path)
+    with open(join(path, name+'.txt'), 'w') as f: f.write(content)
+
+def read(name):
+    with open(join(TARGET, name+'.txt'), 'r') as f: return f.read()
+
+def setup_destination():
+    '''
+    A is modified every day, B was deleted two days ago, C created today
+    '''
+    if exists(ROOT): shutil.rmtree(ROOT)
+    new_file(join(DEST, 'test_directory'), 'A', 'A today')
+    new_file(join(DEST, 'test_directory'), 'C', 'C today')
+    new_file(join(BACKUP_DIR, 'daily.1'), 'A', 'A yesterday')
+    new_file(join(BACKUP_DIR, 'daily.2'), 'A', 'A two days ago')
+    new_file(join(BACKUP_DIR, 'daily.2'), 'B', 'B two days ago')
+    new_file(join(BACKUP_DIR, 'daily.2', 'sub'), 'D', 'D two days ago')
+
+
+def test_snapback_order():
+    order = snapback_order(13)
+    assert order[:4] == ['hourly.12', 'hourly.24', 'hourly.20', 'hourly.16']
+    assert order.index('daily.1') < order.index('daily.3') < order.index('weekly.1')
+
+
+def test_point_in_time():
+    '''
+    Older snapbacks win over the main directory and newer snapbacks
+    '''
+    setup_destination()
+    restore = SnapBackRestore(DEST, 'test_directory', engine=LocalEngine())
+
+    assert restore.restore('daily.1', TARGET, hour=13) == []
+    assert read('A') == 'A yesterday'
+    assert not exists(join(TARGET, 'B.txt'))
+
+    assert restore.restore('daily.2', TARGET, hour=13) == []
+    assert read('A') == 'A two days ago'
+    assert read('B') == 'B two days ago'
+    assert read('C') == 'C today'
+
+
+def test_include():
+    setup_destination()
+    restore = SnapBackRestore(DEST, 'test_directory', engine=LocalEngine())
+
+    restore.restore('daily.3', TARGET, include=['sub/**'], hour=13)
+    assert os.listdir(TARGET) == ['sub']
+    assert os.listdir(join(TARGET, 'sub')) == ['D.txt']
+
+
+def test_verify():
+    setup_destination()
+    restore = SnapBackRestore(DEST, 'test_directory', engine=LocalEngine())
+    restore.restore('daily.2', TARGET, hour=13)
+
+    with HashCache(join(ROOT, 'hashes.db')) as hash_cache:
+        assert restore.verify('daily.2', TARGET, hash_cache, hour=13) == []
+        new_file(TARGET, 'B', 'B corrupted')
+        assert restore.verify('daily.2', TARGET, hash_cache, hour=13) == ['B.txt']
@@ -0,0 +1,70 @@
+import os
+import shutil
+import pytest
+from src.rotation import *
+from src.engine import SubprocessEngine, RcloneError
+from os.path import join, exists
+
+
+pytestmark = pytest.mark.skipif(
+    shutil.which('rclone') is None,
+    reason='rclone is not installed'
+)
+
+BACKUP_DIR = join('test', 'test_data', 'rotation')
+
+
+def new_file(path, name, content=''):
+    if not exists(path): os.makedirs(path)
+    with open(join(path, name+'.txt'), 'w') as f: f.write(content)
+
+
+def test_split_name():
+    assert split_name('daily.2/') == ('daily', 2)
+    assert split_name('hourly.12') == ('hourly.12', None)
+    assert split_name('.temp/') == ('.temp', None)
+
+
+def test_rotate():
+    '''
+    Rotating a tier reorders the slots, clears the oldest one and
+    persists the new mapping on the remote
+    '''
+    if exists(BACKUP_DIR): shutil.rmtree(BACKUP_DIR)
+    engine = SubprocessEngine()
+    for i in (1, 2, 3):
+        new_file(join(BACKUP_DIR, f'daily.{i}'), 'A', f'daily.{i}')
+
+    manifest = SlotManifest.load(engine, BACKUP_DIR)
+    assert manifest.resolve('daily.1/') == 'daily.1'
+    assert manifest.resolve('hourly.12') == 'hourly.12'
+
+    manifest.rotate('daily', lambda slot: engine.purge(join(BACKUP_DIR, slot)))
+
+    assert not exists(join(BACKUP_DIR, 'daily.3')), 'Oldest slot should be cleared'
+    assert manifest.resolve('daily.1') == 'daily.3'
+    assert manifest.resolve('daily.2') == 'daily.1'
+    assert manifest.resolve('daily.3') == 'daily.2'
+
+    reloaded = SlotManifest.load(engine, BACKUP_DIR)
+    assert reloaded.tiers() == manifest.tiers()
+    assert reloaded.generations['daily'] == 1
+
+    # A resumed run repeating the rotation finds it already applied
+    assert not reloaded.rotate('daily', lambda slot: engine.purge(join(BACKUP_DIR, slot)), 1)
+    assert reloaded.resolve('daily.1') == 'daily.3'
+    assert exists(join(BACKUP_DIR, 'daily.1', 'A.txt'))
+    assert reloaded.rotate('daily', lambda slot: engine.purge(join(BACKUP_DIR, slot)), 2)
+    assert reloaded.resolve('daily.1') == 'daily.2'
+
+
+def test_unreadable_manifest():
+    '''
+    A manifest that exists but can not be read is not taken for a new one
+    '''
+    class Unreachable(SubprocessEngine):
+        def read_file(self, path):
+            raise RcloneError('Timed out')
+
+    with pytest.raises(RcloneError):
+        SlotManifest.load(Unreachable(), BACKUP_DIR)
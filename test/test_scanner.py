@@ -0,0 +1,81 @@
+import os
+import shutil
+from contextlib import contextmanager
+from src.scanner import *
+from src.manifest import scan, SourceManifest
+from os.path import join, exists
+
+
+ROOT = join('test', 'test_data', 'scanner')
+SOURCE = join(ROOT, 'source')
+
+
+def new_file(path, name, content=''):
+    if not exists(path): os.makedirs(path)
+    with open(join(path, name+'.txt'), 'w') as f: f.write(content)
+
+
+def test_scan_tree():
+    '''
+    The threaded walk finds the same files as the single threaded one,
+    without entering excluded directories, and reads back as a mapping
+    '''
+    if exists(ROOT): shutil.rmtree(ROOT)
+    for i in range(20):
+        new_file(join(SOURCE, f'dir{i}', 'sub'), f'F{i}', 'x' * i)
+        new_file(join(SOURCE, f'dir{i}'), 'é', 'accent')
+    new_file(join(SOURCE, 'cache', 'deep'), 'C', 'cached')
+    new_file(SOURCE, 'top', 'top')
+    exclude = ['cache/**', '**/F3.txt']
+
+    result = scan_tree(SOURCE, exclude, workers=4)
+    assert result == scan(SOURCE, exclude)
+    assert len(result) == 40
+    assert result['dir5/sub/F5.txt'][0] == 5
+    assert 'dir3/sub/F3.txt' not in result
+    assert 'cache/' not in result.dirs
+    assert result.stats['files'] == 40
+    assert result.stats['dirs'] == 41
+    assert result.stats['errors'] == 0
+    assert result.rate > 0
+
+    manifest = SourceManifest(join(ROOT, 'manifest.json'))
+    manifest.save(result)
+    assert SourceManifest(manifest.file).entries == dict(result.items())
+
+
+def test_scan_errors(monkeypatch):
+    '''
+    Paths that can not be read are reported as errors of the scan, and the
+    rest of their directory is still walked
+    '''
+    if exists(ROOT): shutil.rmtree(ROOT)
+    for name in 'ABC': new_file(join(SOURCE, 'a'), name)
+    new_file(join(SOURCE, 'b'), 'D')
+    scandir = os.scandir
+
+    class Entry:
+        def __init__(self, entry):
+            self.entry, self.name = entry, entry.name
+        def is_dir(self, **kwargs):
+            return self.entry.is_dir(**kwargs)
+        def is_symlink(self):
+            return self.entry.is_symlink()
+        def stat(self, **kwargs):
+            if self.name == 'B.txt': raise FileNotFoundError(self.name)
+            return self.entry.stat(**kwargs)
+
+    @contextmanager
+    def faulty(path):
+        if os.path.basename(path.rstrip('/')) == 'b': raise PermissionError(path)
+        with scandir(path) as it: yield map(Entry, it)
+
+    monkeypatch.setattr(os, 'scandir', faulty)
+    result = scan_tree(SOURCE, workers=2)
+    assert sorted(result) == ['a/A.txt', 'a/C.txt']
+    assert sorted(result.errors) == ['a/B.txt', 'b/']
+    assert result.stats['errors'] == 2
+
+    errors = []
+    assert scan(SOURCE, errors=errors) == dict(result.items())
+    assert sorted(errors) == sorted(result.errors)
@@ -0,0 +1,51 @@
+import shutil
+from src.tuning import *
+from src.metrics import new_record
+from os.path import join, exists
+
+
+ROOT = join('test', 'test_data', 'tuning')
+FILE = join(ROOT, 'tuning.json')
+
+
+def stage(name, bytes, seconds, files=100, errors=0):
+    return {**new_record(name), 'bytes': bytes, 'seconds': seconds, 'files': files, 'errors': errors}
+
+
+def test_tuning():
+    '''
+    Transfers climb while the throughput keeps up, turn back when it drops,
+    are halved on errors and stay within the bounds, per remote and kind
+    '''
+    if exists(ROOT): shutil.rmtree(ROOT)
+    tuner = Tuner(FILE, {'remotes': {'usb': {'transfers': [1, 2]}}})
+    assert tuner.settings('gdrive', 'sync') == DEFAULTS
+
+    tuner.record('gdrive', [stage('sync', 1 << 30, 10), stage('copy daily.1 weekly.1', 1, 1)])
+    assert tuner.settings('gdrive', 'sync')['transfers'] == 5
+    assert tuner.settings('gdrive', 'sync')['checkers'] == 10
+    assert tuner.settings('gdrive', 'copy') == DEFAULTS
+
+    tuner.record('gdrive', [stage('sync', 1 << 30, 20)])
+    assert tuner.settings('gdrive', 'sync')['transfers'] == 4
+    tuner.record('gdrive', [stage('sync', 1 << 30, 20, errors=5)])
+    assert tuner.settings('gdrive', 'sync')['transfers'] == 2
+
+    tuner.record('usb', [stage('sync', 1 << 30, 10)])
+    assert tuner.settings('usb', 'sync')['transfers'] == 2
+    assert Tuner(FILE).settings('gdrive', 'sync')['transfers'] == 2
+
+
+def test_workloads():
+    '''
+    Directories backed up to the same remote are tuned apart, so a small
+    one does not look like a drop in the throughput of a large one
+    '''
+    if exists(ROOT): shutil.rmtree(ROOT)
+    tuner = Tuner(FILE)
+    for _ in range(2):
+        tuner.record('gdrive', [stage('sync', 4 << 30, 10)], 'job/large')
+        tuner.record('gdrive', [stage('sync', 64 << 20, 10)], 'job/small')
+    assert tuner.settings('gdrive', 'sync', 'job/large')['transfers'] == 6
+    assert tuner.settings('gdrive', 'sync', 'job/small')['transfers'] == 6
+    assert tuner.settings('gdrive', 'sync') == DEFAULTS
@@ -0,0 +1,92 @@
+import os
+import sys
+import time
+import shutil
+import threading
+import pytest
+from src.watcher import *
+from src.manifest import scan, rescan
+from os.path import join, exists
+
+
+pytestmark = pytest.mark.skipif(
+    not sys.platform.startswith('linux'),
+    reason='inotify is only available on Linux'
+)
+
+ROOT = join('test', 'test_data', 'watcher')
+SOURCE = join(ROOT, 'source')
+JOURNAL = join(ROOT, 'journal', 'test_directory.journal')
+
+
+def new_file(path, name, content=''):
+    if not exists(path): os.makedirs(path)
+    with open(join(path, name+'.txt'), 'w') as f: f.write(content)
+
+
+def test_journal():
+    '''
+    Changes made while the watcher runs are journaled, and the journal is
+    only trusted while it covers the whole time since the last sync
+    '''
+    if exists(ROOT): shutil.rmtree(ROOT)
+    new_file(SOURCE, 'A', 'A')
+    new_file(join(SOURCE, 'sub'), 'B', 'B')
+    new_file(join(SOURCE, 'excluded'), 'C', 'C')
+    before = scan(SOURCE, ['excluded/**'])
+
+    watcher = Watcher({JOURNAL: (SOURCE, ['excluded/**'])}, flush_interval=0.05)
+    thread = threading.Thread(target=watcher.run)
+    thread.start()
+    try:
+        time.sleep(0.2)
+        synced_ns = time.time_ns()
+        new_file(SOURCE, 'A', 'A modified')
+        new_file(join(SOURCE, 'excluded'), 'C', 'C modified')
+        new_file(join(SOURCE, 'new', 'deep'), 'D', 'D')
+        shutil.rmtree(join(SOURCE, 'sub'))
+        time.sleep(0.3)
+    finally:
+        watcher.stop()
+        thread.join()
+
+    journal = ChangeJournal(JOURNAL)
+    assert journal.read(since_ns=0) == (None, None), 'Started after the sync'
+
+    paths, offset = journal.read(since_ns=synced_ns)
+    assert 'A.txt' in paths
+    assert not any(p.startswith('excluded') for p in paths)
+
+    after = rescan(SOURCE, paths, before, ['excluded/**'])
+    assert after == scan(SOURCE, ['excluded/**'])
+
+    journal.commit(offset)
+    assert journal.read(since_ns=synced_ns)[0] == [], 'Synced paths are dropped'
+
+
+def test_overflow():
+    '''
+    An overflowed journal falls back to a full scan
+    '''
+    if exists(ROOT): shutil.rmtree(ROOT)
+    journal = ChangeJournal(JOURNAL)
+    journal.start(os.getpid(), 0)
+    assert journal.append(['A.txt', 'B.txt'], max_entries=3)
+    assert not journal.append(['C.txt', 'D.txt'], max_entries=3)
+    paths, offset = journal.read(since_ns=1)
+    assert paths is None
+
+    journal.commit(offset)
+    assert journal.read(since_ns=1)[0] == []
+
+
+def test_pid_alive(monkeypatch):
+    '''
+    The watcher is probed with signal 0 on POSIX and never killed elsewhere
+    '''
+    assert pid_alive(os.getpid())
+    def kill(pid, signal):
+        raise AssertionError('os.kill terminates the process on Windows')
+    monkeypatch.setattr(os, 'kill', kill)
+    monkeypatch.setattr(os, 'name', 'nt')
+    assert not pid_alive(os.getpid())